@@ -31,15 +31,26 @@ References:
 
 
 from abc import ABC, abstractmethod
-from ctypes import addressof, Structure, c_byte, c_char, c_uint, c_uint8, c_uint16, c_int32, c_uint32, c_uint64, c_void_p
+from ctypes import addressof, Structure, c_byte, c_char, c_uint, c_uint8, c_uint16, c_int32, c_uint32, c_uint64, c_void_p, sizeof
 from fcntl import ioctl
+import errno
 import mmap
 import os
 import resource
-
-from ioctl_opt import IOR, IOW
+import threading
+from time import monotonic, perf_counter_ns, sleep
+import weakref
 
 from . import *
+from .arena import FreeList, align
+from .index import AddressIndex
+
+
+# The ioctl numbers are precomputed as _IOR/_IOW of asm-generic/ioctl.h, i.e.
+# dir << 30 | size << 16 | magic << 8 | cmd, so that they are not computed on
+# import, and they are checked against ioctl_opt in tests/test_ioctl.py.
+# The sizes of the structures which contain a pointer depend on its size.
+_LP64 = sizeof(c_void_p) == 8
 
 
 class dma_buf:
@@ -79,21 +90,53 @@ class dma_buf:
             ('flags', c_uint64),
         ]
 
-    __IOCTL_SYNC = IOW(__MAGIC, __CMD_SYNC, __st_sync)
+    __IOCTL_SYNC = 0x40086200
 
+    # flags -> argument, which is shared because the kernel only reads it.
+    __sync_args = {}
+
+    # The ioctl arguments of these are for rpi_vcsm.bench, which passes a no-op
+    # to measure the overhead of the calls.
     @staticmethod
-    def ioctl_sync(*, fd, flags):
-        s = dma_buf.__st_sync(flags=flags)
+    def ioctl_sync(*, fd, flags, ioctl=ioctl):
+        s = dma_buf.__sync_args.get(flags)
+        if s is None:
+            s = dma_buf.__sync_args.setdefault(flags,
+                                               dma_buf.__st_sync(flags=flags))
         ioctl(fd, dma_buf.__IOCTL_SYNC, s)
 
+    @staticmethod
+    def prepare_sync(*, flags):
+        '''Return an argument for ioctl_sync_many, which can be reused.'''
+        return dma_buf.__st_sync(flags=flags)
+
+    @staticmethod
+    def ioctl_sync_many(fd_args, *, ioctl=ioctl):
+        '''Issue a SYNC ioctl for each (fd, prepared argument) pair.'''
+        request = dma_buf.__IOCTL_SYNC
+        for fd, s in fd_args:
+            ioctl(fd, request, s)
+
 
 class raw(ABC):
 
-    @staticmethod
-    def align(u, a):
-        assert isinstance(u, int) and u >= 0
-        assert isinstance(a, int) and a >= 1
-        return (u + (a - 1)) & ~(a - 1)
+    # The system calls are made through these attributes, so that they can be
+    # replaced for each instance by set_stats.
+    _ioctl = staticmethod(ioctl)
+    _mmap = staticmethod(mmap.mmap)
+    _sync = staticmethod(dma_buf.ioctl_sync)
+    _sync_many = staticmethod(dma_buf.ioctl_sync_many)
+
+    def set_stats(self, stats):
+        '''Record the latency of the system calls to stats, or stop recording
+        if stats is None.'''
+        for attr, op in [('_ioctl', 'ioctl'), ('_mmap', 'mmap'),
+                         ('_sync', 'sync'), ('_sync_many', 'sync')]:
+            self.__dict__.pop(attr, None)
+            if stats is not None:
+                setattr(self, attr, stats.timed(op, getattr(self, attr)))
+
+    align = staticmethod(align)
 
     @abstractmethod
     def __init__(self):
@@ -104,7 +147,11 @@ class raw(ABC):
         pass
 
     @abstractmethod
-    def alloc(self, *, size, cached, name):
+    def alloc(self, *, size, cached, name, map=True):
+        pass
+
+    @abstractmethod
+    def map(self, *, handle, size):
         pass
 
     @abstractmethod
@@ -162,6 +209,9 @@ class raw_vcsm(raw):
     - https://github.com/raspberrypi/userland/blob/master/host_applications/linux/libs/sm/user-vcsm.c
     '''
 
+    driver = 'vcsm'
+    uses_cma = False
+
     __MAGIC = ord('I')
 
     __CMD_ALLOC = 0x5a
@@ -218,42 +268,52 @@ class raw_vcsm(raw):
 
         _fields_ = [
             # user -> kernel
-            ('op_count', c_uint8),  # Must be 1 for now.
+            # The number of blocks which follow, up to __MAX_OP_COUNT.
+            ('op_count', c_uint8),
             ('zero', c_uint8 * 3),
             ('s', st_clean_invalid_block),
         ]
 
-    __IOCTL_ALLOC = IOR(__MAGIC, __CMD_ALLOC, __st_alloc)
-    __IOCTL_LOCK = IOR(__MAGIC, __CMD_LOCK, __st_lock_unlock)
-    __IOCTL_UNLOCK = IOR(__MAGIC, __CMD_UNLOCK, __st_lock_unlock)
-    __IOCTL_FREE = IOR(__MAGIC, __CMD_FREE, __st_free)
-    __IOCTL_MAP_VC_ADDR_FR_HDL = IOR(__MAGIC, __CMD_MAPPED_VC_ADDR_FROM_HDL,
-                                     __st_map)
-    __IOCTL_CLEAN_INVALID2 = IOR(__MAGIC, __CMD_CLEAN_INVALID2,
-                                 __st_clean_invalid2)
+    __IOCTL_ALLOC = 0x8030495a
+    __IOCTL_LOCK = 0x8008495c
+    __IOCTL_UNLOCK = 0x8008495e
+    __IOCTL_FREE = 0x80044961
+    __IOCTL_MAP_VC_ADDR_FR_HDL = 0x8010496a
+    __IOCTL_CLEAN_INVALID2 = 0x80204970 if _LP64 else 0x80144970
+
+    __MAX_OP_COUNT = 2 ** 8 - 1
+    __MAX_BLOCK_COUNT = 2 ** 16 - 1
 
     def __ioctl_alloc(self, *, size, num, cached, name):
-        s = self.__st_alloc(size=size, num=num, cached=cached, name=name)
-        ioctl(self.__fd, self.__IOCTL_ALLOC, s)
+        # The argument is reused for each thread instead of built for each
+        # call.
+        s = getattr(self.__tls, 'alloc', None)
+        if s is None:
+            s = self.__tls.alloc = self.__st_alloc()
+        s.size = size
+        s.num = num
+        s.cached = cached
+        s.name = name
+        self._ioctl(self.__fd, self.__IOCTL_ALLOC, s)
         return s.handle
 
     def __ioctl_lock(self, *, handle):
         s = self.__st_lock_unlock(handle=handle)
-        ioctl(self.__fd, self.__IOCTL_LOCK, s)
+        self._ioctl(self.__fd, self.__IOCTL_LOCK, s)
         return s.addr
 
     def __ioctl_unlock(self, *, handle):
         s = self.__st_lock_unlock(handle=handle)
-        ioctl(self.__fd, self.__IOCTL_UNLOCK, s)
+        self._ioctl(self.__fd, self.__IOCTL_UNLOCK, s)
         return s.addr
 
     def __ioctl_free(self, *, handle):
         s = self.__st_free(handle=handle)
-        ioctl(self.__fd, self.__IOCTL_FREE, s)
+        self._ioctl(self.__fd, self.__IOCTL_FREE, s)
 
     def __ioctl_map_vc_addr_fr_hdl(self, *, pid, handle):
         s = self.__st_map(pid=pid, handle=handle)
-        ioctl(self.__fd, self.__IOCTL_MAP_VC_ADDR_FR_HDL, s)
+        self._ioctl(self.__fd, self.__IOCTL_MAP_VC_ADDR_FR_HDL, s)
         return s.addr
 
     def __ioctl_clean_invalid2(self, *, invalidate_mode, block_count,
@@ -264,44 +324,114 @@ class raw_vcsm(raw):
                 invalidate_mode=invalidate_mode, block_count=block_count,
                 start_address=start_address, block_size=block_size,
                 inter_block_stride=inter_block_stride))
-        ioctl(self.__fd, self.__IOCTL_CLEAN_INVALID2, s)
+        self._ioctl(self.__fd, self.__IOCTL_CLEAN_INVALID2, s)
+
+    def __ioctl_clean_invalid2_many(self, *, blocks):
+        # The kernel reads op_count blocks which follow the header, so a
+        # structure with an array of the blocks is built for each count.
+        op_count = len(blocks)
+        st = self.__st_clean_invalid2_many.get(op_count)
+        if st is None:
+            st = type('st_clean_invalid2', (Structure,), {
+                '_fields_': [
+                    ('op_count', c_uint8),
+                    ('zero', c_uint8 * 3),
+                    ('s', self.__st_clean_invalid2.st_clean_invalid_block
+                     * op_count),
+                ],
+            })
+            self.__st_clean_invalid2_many[op_count] = st
+        s = st(op_count=op_count)
+        for b, (invalidate_mode, block_count, start_address, block_size,
+                inter_block_stride) in zip(s.s, blocks):
+            b.invalidate_mode = invalidate_mode
+            b.block_count = block_count
+            b.start_address = start_address
+            b.block_size = block_size
+            b.inter_block_stride = inter_block_stride
+        self._ioctl(self.__fd, self.__IOCTL_CLEAN_INVALID2, s)
 
     def __init__(self, *, path=None):
         if path is None:
             path = '/dev/vcsm'
+        self.__st_clean_invalid2_many = {}
+        self.__tls = threading.local()
         self.__fd = os.open(path, os.O_NONBLOCK | os.O_RDWR)
 
     def close(self):
         os.close(self.__fd)
         del self.__fd
 
-    def alloc(self, *, size, cached, name):
+    def alloc(self, *, size, cached, name, map=True):
         size = self.align(size, resource.getpagesize())
         name = bytes(name, 'ascii')
 
         handle = self.__ioctl_alloc(size=size, num=1, cached=cached, name=name)
+        # The driver reports a failure with the null handle.
+        if handle == 0:
+            raise OSError(errno.ENOMEM, os.strerror(errno.ENOMEM))
 
-        usr_buf = mmap.mmap(fileno=self.__fd, length=size,
-                            flags=mmap.MAP_SHARED,
-                            prot=mmap.PROT_READ | mmap.PROT_WRITE,
-                            offset=handle)
-
-        usr_ptr = self.__ioctl_lock(handle=handle)
+        if map:
+            usr_ptr, usr_buf = self.map(handle=handle, size=size)
+        else:
+            usr_ptr, usr_buf = None, None
 
         bus_ptr = self.__ioctl_map_vc_addr_fr_hdl(pid=os.getpid(),
                                                   handle=handle)
 
         return handle, bus_ptr, usr_ptr, usr_buf
 
+    def map(self, *, handle, size):
+        size = self.align(size, resource.getpagesize())
+
+        usr_buf = self._mmap(fileno=self.__fd, length=size,
+                             flags=mmap.MAP_SHARED,
+                             prot=mmap.PROT_READ | mmap.PROT_WRITE,
+                             offset=handle)
+
+        usr_ptr = self.__ioctl_lock(handle=handle)
+
+        return usr_ptr, usr_buf
+
     def free(self, *, handle, usr_buf):
-        usr_buf.close()
-        self.__ioctl_unlock(handle=handle)
+        if usr_buf is not None:
+            usr_buf.close()
+            self.__ioctl_unlock(handle=handle)
         self.__ioctl_free(handle=handle)
 
-    def clean_invalid(self, *, op, usr_ptr, size):
-        self.__ioctl_clean_invalid2(invalidate_mode=op, block_count=1,
-                                    start_address=usr_ptr, block_size=size,
-                                    inter_block_stride=0)
+    def clean_invalid(self, *, op, usr_ptr, size, block_count=1,
+                      inter_block_stride=0):
+        '''
+        Operate on block_count blocks of size bytes, each of which starts
+        inter_block_stride bytes after the previous one.
+        block_count of a block is 16-bit, so more blocks are split into
+        several blocks of the ioctl.
+        '''
+        if block_count < 1:
+            raise ValueError(f'block_count must be positive: {block_count}')
+        if block_count <= self.__MAX_BLOCK_COUNT:
+            self.__ioctl_clean_invalid2(invalidate_mode=op,
+                                        block_count=block_count,
+                                        start_address=usr_ptr, block_size=size,
+                                        inter_block_stride=inter_block_stride)
+            return
+        n = self.__MAX_BLOCK_COUNT
+        self.__clean_invalid_blocks([
+            (op, min(n, block_count - i), usr_ptr + i * inter_block_stride,
+             size, inter_block_stride)
+            for i in range(0, block_count, n)])
+
+    def clean_invalid_many(self, *, ops):
+        '''Issue all of (op, usr_ptr, size) in as few ioctls as op_count
+        allows.'''
+        self.__clean_invalid_blocks([
+            (op, 1, usr_ptr, size, 0) for op, usr_ptr, size in ops
+            if op != CACHE_OP_NOP])
+
+    def __clean_invalid_blocks(self, blocks):
+        n = self.__MAX_OP_COUNT
+        for i in range(0, len(blocks), n):
+            self.__ioctl_clean_invalid2_many(blocks=blocks[i:i + n])
 
 
 class raw_vcsm_cma(raw):
@@ -353,6 +483,9 @@ class raw_vcsm_cma(raw):
     - https://github.com/raspberrypi/userland/blob/master/host_applications/linux/libs/sm/user-vcsm.c
     '''
 
+    driver = 'vcsm-cma'
+    uses_cma = True
+
     __MAGIC = ord('J')
     __CMD_ALLOC = 0x5a
     __CMD_CLEAN_INVALID2 = 0x5c
@@ -388,26 +521,42 @@ class raw_vcsm_cma(raw):
             ('s', st_clean_invalid_block),
         ]
 
-    __IOCTL_ALLOC = IOR(__MAGIC, __CMD_ALLOC, __st_alloc)
-    __IOCTL_CLEAN_INVALID2 = IOR(__MAGIC, __CMD_CLEAN_INVALID2,
-                                 __st_clean_invalid2)
+    __IOCTL_ALLOC = 0x80404a5a
+    __IOCTL_CLEAN_INVALID2 = 0x80204a5c if _LP64 else 0x801c4a5c
 
     def __ioctl_alloc(self, *, size, num, cached, pad, name):
-        s = self.__st_alloc(size=size, num=num, cached=cached, pad=pad,
-                            name=name)
-        ioctl(self.__fd, self.__IOCTL_ALLOC, s)
+        # The argument is reused for each thread instead of built for each
+        # call.
+        s = getattr(self.__tls, 'alloc', None)
+        if s is None:
+            s = self.__tls.alloc = self.__st_alloc()
+        s.size = size
+        s.num = num
+        s.cached = cached
+        s.pad = pad
+        s.name = name
+        self._ioctl(self.__fd, self.__IOCTL_ALLOC, s)
         return s.handle, s.vc_handle, s.dma_addr
 
     def __init__(self, *, path=None):
         if path is None:
             path = '/dev/vcsm-cma'
+        self.__tls = threading.local()
         self.__fd = os.open(path, os.O_NONBLOCK | os.O_RDWR)
+        start = dma_buf.prepare_sync(
+            flags=dma_buf.SYNC_START | dma_buf.SYNC_RW)
+        end = dma_buf.prepare_sync(flags=dma_buf.SYNC_END | dma_buf.SYNC_RW)
+        self.__sync_args = {
+            CACHE_OP_INVALIDATE: start,
+            CACHE_OP_CLEAN: end,
+            CACHE_OP_FLUSH: end,
+        }
 
     def close(self):
         os.close(self.__fd)
         del self.__fd
 
-    def alloc(self, *, size, cached, name):
+    def alloc(self, *, size, cached, name, map=True):
         size_aligned = self.align(size, resource.getpagesize())
         name = bytes(name, 'ascii')
 
@@ -416,21 +565,29 @@ class raw_vcsm_cma(raw):
                                                         pad=0, name=name)
         assert 0 <= bus_ptr < 2 ** 32
 
-        usr_buf = mmap.mmap(fileno=handle, length=size, flags=mmap.MAP_SHARED,
-                            prot=mmap.PROT_READ | mmap.PROT_WRITE, offset=0)
+        if map:
+            usr_ptr, usr_buf = self.map(handle=handle, size=size)
+        else:
+            usr_ptr, usr_buf = None, None
+
+        return handle, bus_ptr, usr_ptr, usr_buf
 
-        dma_buf.ioctl_sync(fd=handle,
-                           flags=dma_buf.SYNC_START | dma_buf.SYNC_RW)
+    def map(self, *, handle, size):
+        usr_buf = self._mmap(fileno=handle, length=size, flags=mmap.MAP_SHARED,
+                             prot=mmap.PROT_READ | mmap.PROT_WRITE, offset=0)
+
+        self._sync(fd=handle, flags=dma_buf.SYNC_START | dma_buf.SYNC_RW)
 
         # The reference to this intermediate buffer is immediately removed, but
         # as long as the usr_buf is living, the memory address does not change.
         usr_ptr = addressof(c_byte.from_buffer(usr_buf))
 
-        return handle, bus_ptr, usr_ptr, usr_buf
+        return usr_ptr, usr_buf
 
     def free(self, *, handle, usr_buf):
-        dma_buf.ioctl_sync(fd=handle, flags=dma_buf.SYNC_END | dma_buf.SYNC_RW)
-        usr_buf.close()
+        if usr_buf is not None:
+            self._sync(fd=handle, flags=dma_buf.SYNC_END | dma_buf.SYNC_RW)
+            usr_buf.close()
         os.close(handle)
 
     def clean_invalid(self, *, op, handle):
@@ -440,25 +597,679 @@ class raw_vcsm_cma(raw):
             flags = dma_buf.SYNC_START | dma_buf.SYNC_RW
         elif op == CACHE_OP_CLEAN or op == CACHE_OP_FLUSH:
             flags = dma_buf.SYNC_END | dma_buf.SYNC_RW
-        dma_buf.ioctl_sync(fd=handle, flags=flags)
+        self._sync(fd=handle, flags=flags)
+
+    def clean_invalid_many(self, *, ops):
+        '''Issue a sync for each of (op, handle) with prepared arguments.'''
+        args = self.__sync_args
+        self._sync_many([(handle, args[op]) for op, handle in ops
+                                 if op != CACHE_OP_NOP])
+
+
+class raw_emulated(raw):
+
+    '''
+    A software stand-in for the VCSM-CMA driver.
+
+    Memory is backed by memfd files, of which descriptors are used as handles
+    like the dma-buf descriptors of VCSM-CMA, and fake bus addresses are
+    allocated from a fixed range so that they are stable and unique while the
+    buffers are alive.
+    No kernel driver is involved, so this can be used to test and benchmark the
+    Python-side code on any Linux machine.
+
+    The ioctls which the real driver would have issued are counted in
+    ioctl_counts, and the latency of each of them can be emulated with the
+    latency argument, which is either seconds for all ioctls or a dict of
+    seconds for each ioctl name ('alloc' and 'sync').
+    '''
+
+    driver = 'emulated'
+    uses_cma = True
+
+    BUS_BASE = 0xc0000000
+    BUS_SIZE = 0x3f000000
+
+    def __init__(self, *, latency=None):
+        if latency is None:
+            latency = {}
+        elif not isinstance(latency, dict):
+            latency = {'alloc': latency, 'sync': latency}
+        self.latency = latency
+        self.ioctl_counts = {'alloc': 0, 'sync': 0}
+        self.__bus = FreeList(self.BUS_SIZE)
+        self.__bus_sizes = {}
+        self.__lock = threading.Lock()
+
+    def __emulate(self, name):
+        with self.__lock:
+            self.ioctl_counts[name] += 1
+        t = self.latency.get(name)
+        if t:
+            sleep(t)
+
+    def _ioctl(self, fd, request, arg):
+        self.__emulate(request)
+
+    def _sync(self, *, fd, flags):
+        self.__emulate('sync')
+
+    def _sync_many(self, fd_args):
+        for fd, s in fd_args:
+            self.__emulate('sync')
+
+    def close(self):
+        pass
+
+    def alloc(self, *, size, cached, name, map=True):
+        assert cached in [CACHE_NONE, CACHE_HOST, CACHE_VC, CACHE_BOTH]
+        size_aligned = self.align(size, resource.getpagesize())
+
+        self._ioctl(None, 'alloc', None)
+        with self.__lock:
+            offset = self.__bus.alloc(size_aligned, resource.getpagesize())
+        if offset is None:
+            raise OSError(errno.ENOMEM, os.strerror(errno.ENOMEM))
+        try:
+            handle = os.memfd_create(name, os.MFD_CLOEXEC)
+            try:
+                os.ftruncate(handle, size_aligned)
+            except BaseException:
+                os.close(handle)
+                raise
+        except BaseException:
+            with self.__lock:
+                self.__bus.free(offset, size_aligned)
+            raise
+        bus_ptr = self.BUS_BASE + offset
+        self.__bus_sizes[handle] = (offset, size_aligned)
+
+        if map:
+            usr_ptr, usr_buf = self.map(handle=handle, size=size)
+        else:
+            usr_ptr, usr_buf = None, None
+
+        return handle, bus_ptr, usr_ptr, usr_buf
+
+    def map(self, *, handle, size):
+        usr_buf = self._mmap(fileno=handle, length=size, flags=mmap.MAP_SHARED,
+                             prot=mmap.PROT_READ | mmap.PROT_WRITE, offset=0)
+
+        self._sync(fd=handle, flags=dma_buf.SYNC_START | dma_buf.SYNC_RW)
+
+        usr_ptr = addressof(c_byte.from_buffer(usr_buf))
+
+        return usr_ptr, usr_buf
+
+    def free(self, *, handle, usr_buf):
+        if usr_buf is not None:
+            self._sync(fd=handle, flags=dma_buf.SYNC_END | dma_buf.SYNC_RW)
+            usr_buf.close()
+        offset, size_aligned = self.__bus_sizes.pop(handle)
+        os.close(handle)
+        with self.__lock:
+            self.__bus.free(offset, size_aligned)
+
+    def clean_invalid(self, *, op, handle):
+        assert handle in self.__bus_sizes
+        if op == CACHE_OP_NOP:
+            return
+        self._sync(fd=handle, flags=dma_buf.SYNC_RW)
+
+    def clean_invalid_many(self, *, ops):
+        self._sync_many([(handle, None) for op, handle in ops
+                         if op != CACHE_OP_NOP])
+
+
+IO_CHUNK_SIZE = 8 * 2 ** 20
+
+PRESSURE_POLL_INTERVAL = 0.05
+
+
+def read_cma_info(path='/proc/meminfo'):
+    '''Return a (CmaTotal, CmaFree) tuple in bytes read from the meminfo file at
+    path, or None if the kernel does not report them.'''
+    info = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ['CmaTotal', 'CmaFree']:
+                    value = value.split()
+                    info[key] = int(value[0]) * (1024 if value[1:] else 1)
+    except FileNotFoundError:
+        return None
+    if len(info) != 2:
+        return None
+    return info['CmaTotal'], info['CmaFree']
+
+
+# The paths at which the VCSM-CMA device is found.
+_probed = set()
+
+
+def probe_driver(*, path_vcsm_cma=None, reprobe=False):
+    '''Return the driver which VCSM uses unless forced, which is 'vcsm-cma' if
+    its device exists or 'vcsm' otherwise.
+    Only a device found is cached for each path, so that a device which
+    appears later (e.g. by loading the module) is found, and reprobe discards
+    it.'''
+    if path_vcsm_cma is None:
+        path_vcsm_cma = '/dev/vcsm-cma'
+    if reprobe:
+        _probed.discard(path_vcsm_cma)
+    elif path_vcsm_cma in _probed:
+        return 'vcsm-cma'
+    if not os.path.exists(path_vcsm_cma):
+        return 'vcsm'
+    _probed.add(path_vcsm_cma)
+    return 'vcsm-cma'
+
+
+class VCSMBuffer:
+
+    '''
+    A buffer allocated by VCSM.malloc.
+
+    The mapped memory can be accessed in place through view (or
+    as_memoryview) and as_ndarray without copying it.
+    On Python 3.12 or later, the buffer itself also supports the buffer
+    protocol, e.g. memoryview(buf); on earlier versions, pass buf.view
+    instead.
+    Views must be released before the buffer is freed.
+
+    Each buffer tracks which side owns it so that redundant cache operations
+    are elided:
+    - CPU_DIRTY: the CPU owns it and may have written to it.
+    - CPU_CLEAN: the CPU owns it and has only read from it.
+    - DEVICE: the device (VideoCore) owns it.
+    clean (end_cpu_access) hands the buffer to the device and is issued only
+    from CPU_DIRTY, and invalidate (begin_cpu_access) takes it back to the CPU
+    and is issued only from DEVICE.
+    Thus the CPU must not write to the buffer after clean without calling
+    invalidate or begin_cpu_access first, and should declare read-only
+    accesses with begin_cpu_access(write=False) so that the following clean is
+    elided.
+    Buffers with CACHE_NONE never issue cache operations.
+
+    mapping tells when the buffer is mapped to the CPU:
+    - 'eager': on allocation.
+    - 'lazy': on the first access to usr_ptr, usr_buf or the views, or on
+      begin_cpu_access.
+    - 'never': the buffer is only accessed by the device, and accessing it
+      from the CPU raises ValueError.
+    Unmapped buffers are owned by the device and issue no cache operations.
+    '''
+
+    CPU_DIRTY = 'cpu-dirty'
+    CPU_CLEAN = 'cpu-clean'
+    DEVICE = 'device'
+
+    __slots__ = ('owner', 'handle', 'offset', 'bus_ptr', '__usr_ptr',
+                 '__usr_buf', 'size', 'cached', 'state', 'mapping')
+
+    def __init__(self, *, owner, handle, bus_ptr, usr_ptr, usr_buf, size,
+                 cached, mapping='eager', offset=0):
+        assert mapping in ['eager', 'lazy', 'never']
+        self.owner = owner
+        self.handle = handle
+        # The offset of the buffer in the allocation of handle.
+        self.offset = offset
+        self.bus_ptr = bus_ptr
+        self.__usr_ptr = usr_ptr
+        self.__usr_buf = usr_buf
+        self.size = size
+        self.cached = cached
+        self.mapping = mapping
+        self.state = self.CPU_DIRTY if usr_buf is not None else self.DEVICE
+
+    def __repr__(self):
+        usr_ptr = 'unmapped' if self.__usr_ptr is None \
+            else f'0x{self.__usr_ptr:x}'
+        return f'<VCSMBuffer handle={self.handle}' \
+               f' bus_ptr=0x{self.bus_ptr:08x} usr_ptr={usr_ptr}' \
+               f' size={self.size}>'
+
+    def get_driver(self):
+        return self.owner.get_driver()
+
+    def is_mapped(self):
+        return self.__usr_buf is not None
+
+    def map(self):
+        '''Map the buffer to the CPU if it is not mapped yet.'''
+        if self.__usr_buf is not None:
+            return
+        if self.mapping == 'never':
+            raise ValueError('The buffer is allocated with mapping=never')
+        self.__usr_ptr, self.__usr_buf = \
+            self.owner.map(handle=self.handle, size=self.size)
+        # The mapping is synchronized with the device by the driver.
+        self.state = self.CPU_DIRTY
+
+    @property
+    def usr_ptr(self):
+        self.map()
+        return self.__usr_ptr
+
+    @property
+    def usr_buf(self):
+        self.map()
+        return self.__usr_buf
+
+    def __len__(self):
+        return self.size
+
+    def __buffer__(self, flags):
+        return self.as_memoryview()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.free()
+        return exc_value is None
+
+    def as_memoryview(self):
+        view = memoryview(self.usr_buf)
+        return view if len(view) == self.size else view[:self.size]
+
+    @property
+    def view(self):
+        '''A memoryview of the buffer, which can be used wherever the buffer
+        protocol is needed on any Python version.'''
+        return self.as_memoryview()
+
+    def as_ndarray(self, shape=None, dtype='uint8', strides=None, offset=0):
+        import numpy
+        dtype = numpy.dtype(dtype)
+        if shape is None:
+            shape = ((self.size - offset) // dtype.itemsize,)
+        return numpy.ndarray(shape, dtype=dtype, buffer=self.as_memoryview(),
+                             offset=offset, strides=strides)
+
+    def free(self):
+        self.owner.free(handle=self.handle, usr_buf=self.__usr_buf)
+
+    def readinto_from(self, fd, *, offset=0, length=None, file_offset=None,
+                      chunk_size=IO_CHUNK_SIZE):
+        '''
+        Read up to length bytes from fd (a descriptor or an object with
+        fileno) directly into the buffer from offset, in chunks of chunk_size
+        bytes.
+        The data is read at file_offset with preadv if it is given, or at the
+        current position otherwise, until length bytes are read or EOF is
+        reached.
+        The buffer is cleaned after the read.
+        Returns the number of bytes read.
+        '''
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        if length is None:
+            length = self.size - offset
+        assert offset >= 0 and length >= 0 and offset + length <= self.size
+
+        self.begin_cpu_access(write=True)
+        done = 0
+        with self.as_memoryview() as view:
+            while done < length:
+                start = offset + done
+                n = min(chunk_size, length - done)
+                with view[start:start + n] as chunk:
+                    if file_offset is None:
+                        n = os.readv(fd, [chunk])
+                    else:
+                        n = os.preadv(fd, [chunk], file_offset + done)
+                if n == 0:
+                    break
+                done += n
+        self.end_cpu_access()
+        return done
+
+    def write_to(self, fd, *, offset=0, length=None, file_offset=None,
+                 chunk_size=IO_CHUNK_SIZE):
+        '''
+        Write length bytes of the buffer from offset directly to fd (a
+        descriptor or an object with fileno), in chunks of chunk_size bytes.
+        The data is written at file_offset with pwritev if it is given, or at
+        the current position otherwise.
+        Returns the number of bytes written.
+        '''
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        if length is None:
+            length = self.size - offset
+        assert offset >= 0 and length >= 0 and offset + length <= self.size
+
+        self.begin_cpu_access(write=False)
+        done = 0
+        with self.as_memoryview() as view:
+            while done < length:
+                start = offset + done
+                n = min(chunk_size, length - done)
+                with view[start:start + n] as chunk:
+                    if file_offset is None:
+                        done += os.writev(fd, [chunk])
+                    else:
+                        done += os.pwritev(fd, [chunk], file_offset + done)
+        return done
+
+    @classmethod
+    def step(cls, state, *, op, write=True):
+        '''Return whether an ownership state requires op, regardless of the
+        cache mode, and the state after op.'''
+        if op == CACHE_OP_CLEAN:
+            return state == cls.CPU_DIRTY, cls.DEVICE
+        elif op == CACHE_OP_INVALIDATE:
+            needed = state == cls.DEVICE
+            if write:
+                return needed, cls.CPU_DIRTY
+            return needed, cls.CPU_CLEAN if needed else state
+        elif op == CACHE_OP_FLUSH:
+            return state != cls.CPU_CLEAN, \
+                cls.CPU_DIRTY if write else cls.CPU_CLEAN
+        return False, state
+
+    def needs(self, op):
+        '''Return whether the ownership state requires op, regardless of the
+        cache mode.'''
+        return self.step(self.state, op=op)[0]
+
+    def transition(self, *, op, write=True):
+        '''Update the ownership state for op and return whether op needs to be
+        issued.'''
+        needed, self.state = self.step(self.state, op=op, write=write)
+        return needed and self.cached != CACHE_NONE
+
+    def clean_invalidate(self, *, op, write=True):
+        return self.owner.clean_invalidate_buffer(self, op=op, write=write)
+
+    def invalidate(self):
+        return self.clean_invalidate(op=CACHE_OP_INVALIDATE)
+
+    def clean(self):
+        return self.clean_invalidate(op=CACHE_OP_CLEAN)
+
+    def begin_cpu_access(self, *, write=True):
+        self.map()
+        return self.clean_invalidate(op=CACHE_OP_INVALIDATE, write=write)
+
+    def end_cpu_access(self):
+        return self.clean_invalidate(op=CACHE_OP_CLEAN)
+
+
+class VCSMBufferGroup:
+
+    '''
+    Equally-sized VCSMBuffers allocated at once by VCSM.malloc_many.
+
+    The buffers are slots of a single allocation, of which bus and user
+    addresses are offset by stride bytes from each other.
+    Each buffer can be freed on its own, and the allocation is freed when all
+    of them are freed; free frees all the buffers which are not freed yet.
+    Cache operations are performed on each slot on the plain VCSM driver, and
+    on the whole allocation on the other drivers.
+    '''
+
+    def __init__(self, vcsm, mem, *, count, size, stride, cached):
+        self.vcsm = vcsm
+        self.handle, self.bus_ptr, self.usr_ptr, self.usr_buf = mem
+        self.stride = stride
+        self.__view = memoryview(self.usr_buf)
+        self.__lock = threading.Lock()
+        self.buffers = []
+        for i in range(count):
+            offset = i * stride
+            self.buffers.append(VCSMBuffer(
+                owner=self, handle=self.handle, bus_ptr=self.bus_ptr + offset,
+                usr_ptr=self.usr_ptr + offset,
+                usr_buf=self.__view[offset:offset + size], size=size,
+                cached=cached, offset=offset))
+        # id(usr_buf) of the buffers which are not freed yet.
+        self.__live = {id(buf.usr_buf): buf for buf in self.buffers}
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def __getitem__(self, i):
+        return self.buffers[i]
+
+    def __iter__(self):
+        return iter(self.buffers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.free()
+        return exc_value is None
+
+    def get_live_count(self):
+        return len(self.__live)
+
+    def free(self, *, handle=None, usr_buf=None):
+        '''Free the buffer of usr_buf, or all the buffers if it is None.'''
+        with self.__lock:
+            if usr_buf is None:
+                views = [buf.usr_buf for buf in self.__live.values()]
+                self.__live.clear()
+            else:
+                assert handle == self.handle
+                views = [self.__live.pop(id(usr_buf)).usr_buf]
+            for view in views:
+                view.release()
+            if self.__live or self.__view is None:
+                return
+            self.__view.release()
+            self.__view = None
+        self.vcsm.free(handle=self.handle, usr_buf=self.usr_buf)
+
+    def map(self, *, handle, size):
+        raise ValueError('Buffers of a group are always mapped')
+
+    def get_driver(self):
+        return self.vcsm.get_driver()
+
+    def clean_invalidate(self, *, op, handle=None, usr_ptr=None, size=None):
+        self.vcsm.clean_invalidate(op=op, handle=handle, usr_ptr=usr_ptr,
+                                   size=size)
+
+    def clean_invalidate_buffer(self, buf, *, op, write=True):
+        return self.vcsm.clean_invalidate_buffer(buf, op=op, write=write)
+
+    def begin_cpu_access(self, buf, *, write=True):
+        return self.vcsm.begin_cpu_access(buf, write=write)
+
+    def end_cpu_access(self, buf):
+        return self.vcsm.end_cpu_access(buf)
+
+    def observe_access(self, buf, *, read_bytes=0, write_bytes=0):
+        self.vcsm.observe_access(buf, read_bytes=read_bytes,
+                                 write_bytes=write_bytes)
+
+
+class _ThreadCache:
+
+    # The buffers cached by a thread, which other threads also release on
+    # trim_caches.
+
+    __slots__ = ('lock', 'buffers', 'count')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (cached, size, mapped) -> list of (handle, bus_ptr, usr_ptr, usr_buf)
+        self.buffers = {}
+        self.count = 0
+
+
+class _ThreadCacheOwner:
+
+    # Referred to only by the thread-local storage, so that it is collected
+    # when the thread exits.
+
+    __slots__ = ('__weakref__',)
 
 
 class VCSM:
 
-    def __init__(self, *, force=None, path_vcsm=None, path_vcsm_cma=None):
-        assert force in [None, 'vcsm', 'vcsm-cma']
+    '''
+    The entry point of the library.
+
+    All the methods can be called from multiple threads at once.
+    close waits for the operations in progress on the other threads, and
+    operations started after close raise ValueError.
+
+    If thread_cache is positive, up to that number of freed buffers are kept
+    in a cache local to each thread, and up to global_cache buffers which
+    overflow the thread caches are kept in a cache shared among threads.
+    The next allocation of the same page-aligned size and cache mode reuses
+    them without calling the driver.
+    The buffers in the caches are released with trim_caches or close.
+
+    Allocations can be limited by budget, the number of bytes this object may
+    hold including the caches, and by low_water, the number of bytes of
+    CmaFree in path_meminfo which must be left for the other drivers on the
+    system (e.g. camera and display).
+    When an allocation would exceed either of them, the caches are released
+    first, and then the pressure policy is applied, which is given for each
+    call or defaults to that of the constructor:
+    - 'fail': raise OSError with ENOMEM.
+    - 'block': wait for other threads to free buffers up to timeout seconds,
+      and then raise OSError with ENOMEM.
+    - A callable: call it with the number of missing bytes so that it can
+      evict buffers, and retry once.
+    get_headroom reports how many bytes can be allocated before that happens.
+
+    If deferred_free is True, free only queues the buffer, and a background
+    thread returns queued buffers to the driver in batches, so that the
+    munmap and the ioctls are kept off the thread which frees.
+    Queued buffers are still counted as used until they are returned, and
+    they are returned on the allocating thread first under memory pressure.
+    reclaim returns them on the calling thread, and close returns all of them
+    before closing the driver.
+
+    The user and bus addresses of the live buffers are kept in index, an
+    AddressIndex, so that addresses inside them are translated by to_bus,
+    to_usr and owner in O(log n).
+
+    If observer is set, such as by rpi_vcsm.tune.CacheTuner, the cache
+    operations and the CPU accesses reported by observe_access are passed to
+    its observe_sync(name, *, op, tracked) and observe_access(name, *,
+    read_bytes, write_bytes) with the names of the allocations.
+    tracked tells whether the operation is on a VCSMBuffer, whose ownership
+    state elides it with CACHE_NONE, and operations on VCSMBuffers are
+    observed if their state requires them, whether they are elided or not.
+    '''
 
+    def __init__(self, *, force=None, path_vcsm=None, path_vcsm_cma=None,
+                 emulated_latency=None, stats=None, thread_cache=0,
+                 global_cache=0, budget=None, low_water=None,
+                 pressure='fail', timeout=None, path_meminfo='/proc/meminfo',
+                 deferred_free=False):
+        assert force in [None, 'vcsm', 'vcsm-cma', 'emulated']
+        assert thread_cache >= 0 and global_cache >= 0
+        assert pressure in ['fail', 'block'] or callable(pressure)
+
+        if force == 'emulated':
+            self.raw = raw_emulated(latency=emulated_latency)
+        else:
+            self.__open(force=force, path_vcsm=path_vcsm,
+                        path_vcsm_cma=path_vcsm_cma)
+
+        self.cache_op_counts = {'issued': 0, 'elided': 0}
+        self.__counts_lock = threading.Lock()
+
+        self.stats = stats
+        if stats is not None:
+            self.raw.set_stats(stats)
+        self.observer = None
+
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+        self.__inflight = 0
+        # Frees are still accepted while closing, until closed.
+        self.__closing = False
+        self.__closed = False
+
+        self.thread_cache = thread_cache
+        self.global_cache = global_cache
+        self.__caching = thread_cache > 0 or global_cache > 0
+        self.__tls = threading.local()
+        # The _ThreadCache of all the live threads, and the global cache,
+        # which is a dict of (cached, size, mapped) -> list of (handle,
+        # bus_ptr, usr_ptr, usr_buf).
+        self.__thread_caches = []
+        self.__global_cache = {}
+        self.__global_count = 0
+        # The caches on top of this VCSM registered by add_cache.
+        self.__caches = weakref.WeakSet()
+        # handle -> ((cached, size, mapped), (handle, bus_ptr, usr_ptr,
+        # usr_buf)) of the buffers allocated while caching is enabled.
+        self.__live = {}
+
+        self.budget = budget
+        self.low_water = low_water
+        self.pressure = pressure
+        self.timeout = timeout
+        self.path_meminfo = path_meminfo
+        self.__freed = threading.Condition(self.__lock)
+        # handle -> page-aligned size of all the buffers held, and the bytes
+        # admitted but not allocated by the driver yet.
+        self.__sizes = {}
+        # handle -> name of the buffers held, for the observer.
+        self.__names = {}
+        self.__used = 0
+        self.__pending = 0
+
+        self.deferred_free = deferred_free
+        self.__reclaim = threading.Condition(self.__lock)
+        self.__reclaimer = None
+        self.__reclaim_stop = False
+        # (handle, usr_buf) of the buffers queued to be freed.
+        self.__deferred = []
+        self.__deferred_bytes = 0
+
+        self.index = AddressIndex()
+
+    def __open(self, *, force, path_vcsm, path_vcsm_cma):
+        driver = force
+        if driver is None:
+            driver = probe_driver(path_vcsm_cma=path_vcsm_cma)
         try:
-            if force != 'vcsm':
+            if driver == 'vcsm-cma':
                 self.raw = raw_vcsm_cma(path=path_vcsm_cma)
-        except FileNotFoundError as e:
+                return
+        except FileNotFoundError:
             if force == 'vcsm-cma':
-                raise e
-
-        if not hasattr(self, 'raw'):
-            self.raw = raw_vcsm(path=path_vcsm)
+                raise
+            # The device is gone since it was probed.
+            probe_driver(path_vcsm_cma=path_vcsm_cma, reprobe=True)
+        self.raw = raw_vcsm(path=path_vcsm)
 
     def close(self):
+        with self.__lock:
+            if self.__closing:
+                return
+            self.__closing = True
+            # Blocking admissions fail rather than wait for frees forever.
+            self.__freed.notify_all()
+            while self.__inflight:
+                self.__idle.wait()
+            self.__closed = True
+            reclaimer = self.__reclaimer
+            self.__reclaim_stop = True
+            self.__reclaim.notify_all()
+
+        if reclaimer is not None:
+            reclaimer.join()
+        self.__reclaim_batch()
+
+        for cache in self.__thread_caches:
+            self.__release_thread_cache(cache)
+        self.__thread_caches.clear()
+        self.__release(self.__global_cache)
+        self.__global_count = 0
+
         self.raw.close()
         del self.raw
 
@@ -470,22 +1281,608 @@ class VCSM:
         return exc_value is None
 
     def get_driver(self):
-        return 'vcsm' if isinstance(self.raw, raw_vcsm) else 'vcsm-cma'
-
-    def malloc_cache(self, *, size, cached, name):
-        return self.raw.alloc(size=size, cached=cached, name=name)
+        return self.raw.driver
+
+    def __begin(self, *, freeing=False):
+        # Must be paired with __end in a finally clause.
+        with self.__lock:
+            if self.__closed or self.__closing and not freeing:
+                raise ValueError('Operation on a closed VCSM')
+            self.__inflight += 1
+        return None if self.stats is None else perf_counter_ns()
+
+    def __end(self, op, start):
+        if start is not None:
+            self.stats.record(op, perf_counter_ns() - start)
+        with self.__lock:
+            self.__inflight -= 1
+            if self.__closing and not self.__inflight:
+                self.__idle.notify_all()
+
+    def __thread_cache(self):
+        try:
+            return self.__tls.cache
+        except AttributeError:
+            pass
+        cache = _ThreadCache()
+        with self.__lock:
+            self.__thread_caches.append(cache)
+        self.__tls.cache = cache
+        # The cache is dropped when the owner is collected on thread exit.
+        owner = self.__tls.owner = _ThreadCacheOwner()
+        weakref.finalize(owner, self.__drop_thread_cache, cache).atexit = False
+        return cache
+
+    def __drop_thread_cache(self, cache):
+        with self.__lock:
+            if self.__closing:
+                # It is released by close.
+                return
+            self.__thread_caches.remove(cache)
+            self.__inflight += 1
+        try:
+            self.__release_thread_cache(cache)
+        finally:
+            self.__end('free', None)
+
+    def __release_thread_cache(self, cache):
+        with cache.lock:
+            buffers = cache.buffers
+            cache.buffers = {}
+            cache.count = 0
+        return self.__release(buffers)
+
+    def __cache_get(self, key):
+        cache = self.__thread_cache()
+        with cache.lock:
+            buffers = cache.buffers.get(key)
+            if buffers:
+                cache.count -= 1
+                return buffers.pop()
+        with self.__lock:
+            buffers = self.__global_cache.get(key)
+            if buffers:
+                self.__global_count -= 1
+                return buffers.pop()
+        return None
+
+    def __cache_put(self, key, mem):
+        cache = self.__thread_cache()
+        with cache.lock:
+            if cache.count < self.thread_cache:
+                cache.buffers.setdefault(key, []).append(mem)
+                cache.count += 1
+                return True
+        with self.__lock:
+            if self.__global_count < self.global_cache:
+                self.__global_cache.setdefault(key, []).append(mem)
+                self.__global_count += 1
+                return True
+        return False
+
+    def __release(self, cache):
+        # Returns the number of bytes released.
+        n = 0
+        for (cached, size, mapped), buffers in cache.items():
+            for handle, bus_ptr, usr_ptr, usr_buf in buffers:
+                self.__free(handle, usr_buf)
+                n += size
+        cache.clear()
+        return n
+
+    def add_cache(self, cache):
+        '''
+        Register a cache of buffers on top of this VCSM, such as VCSMPool, so
+        that trim_caches, and thus memory pressure, releases its idle buffers
+        with cache.trim(max_bytes=0), which returns the number of bytes
+        released.
+        The cache is held weakly.
+        '''
+        with self.__lock:
+            self.__caches.add(cache)
+
+    def remove_cache(self, cache):
+        with self.__lock:
+            self.__caches.discard(cache)
+
+    def trim_caches(self):
+        '''Release the idle buffers of the caches registered by add_cache,
+        then those in the caches of all the threads and in the global cache,
+        and return the number of bytes released.'''
+        with self.__lock:
+            caches = list(self.__caches)
+        # The buffers of the registered caches are cached by this VCSM when
+        # they are freed if caching is enabled, so they are released first and
+        # counted once below.
+        n = 0
+        for cache in caches:
+            released = cache.trim(max_bytes=0)
+            if not self.__caching:
+                n += released
+        with self.__lock:
+            caches = list(self.__thread_caches)
+            cache = self.__global_cache
+            self.__global_cache = {}
+            self.__global_count = 0
+        n += self.__release(cache)
+        for cache in caches:
+            n += self.__release_thread_cache(cache)
+        return n
+
+    def get_used_bytes(self):
+        '''Return the number of bytes held, including the caches.'''
+        return self.__used
+
+    def get_cma_info(self):
+        '''Return a (CmaTotal, CmaFree) tuple in bytes, or None if the driver
+        does not allocate from CMA or the kernel does not report it.'''
+        if not self.raw.uses_cma:
+            return None
+        return read_cma_info(self.path_meminfo)
+
+    def __headroom(self, cma_info):
+        # Must be called with the lock held.
+        headroom = []
+        if self.budget is not None:
+            headroom.append(self.budget - self.__used - self.__pending)
+        if self.low_water is not None and cma_info is not None:
+            headroom.append(cma_info[1] - self.low_water - self.__pending)
+        return min(headroom) if headroom else None
+
+    def get_headroom(self):
+        '''Return the number of bytes which can be allocated before the budget
+        or the low-water mark is reached, or None if neither applies.'''
+        cma_info = self.get_cma_info()
+        with self.__lock:
+            return self.__headroom(cma_info)
+
+    def __admit(self, size, pressure, timeout):
+        # Reserves size bytes as pending, which must be settled by __alloc.
+        if pressure is None:
+            pressure = self.pressure
+        if timeout is None:
+            timeout = self.timeout
+        assert pressure in ['fail', 'block'] or callable(pressure)
+        evicted = False
+        deadline = None
+        while True:
+            cma_info = None if self.low_water is None else self.get_cma_info()
+            with self.__lock:
+                headroom = self.__headroom(cma_info)
+                if headroom is None or size <= headroom:
+                    self.__pending += size
+                    return
+
+            if self.__deferred and self.__reclaim_batch():
+                continue
+            # Buffers freed by the eviction callback or by other threads may
+            # also have been cached.
+            if self.trim_caches():
+                continue
+
+            if pressure == 'block':
+                now = monotonic()
+                if deadline is None and timeout is not None:
+                    deadline = now + timeout
+                if deadline is not None and now >= deadline:
+                    pressure = 'fail'
+                else:
+                    wait = PRESSURE_POLL_INTERVAL
+                    if deadline is not None:
+                        wait = min(wait, deadline - now)
+                    # CmaFree may also be raised by other processes, so it is
+                    # polled as well as waiting for frees.
+                    with self.__lock:
+                        if self.__closing:
+                            raise ValueError('The VCSM is closed while'
+                                             ' waiting for memory')
+                        self.__freed.wait(wait)
+                    continue
+            elif pressure != 'fail' and not evicted:
+                evicted = True
+                pressure(size - headroom)
+                continue
+
+            raise OSError(errno.ENOMEM,
+                          f'Allocating {size} bytes exceeds the VCSM budget or '
+                          f'the low-water mark by {size - headroom} bytes')
+
+    def malloc_cache(self, *, size, cached, name, pressure=None, timeout=None,
+                     map='eager'):
+        '''
+        Allocate a buffer and return a (handle, bus_ptr, usr_ptr, usr_buf)
+        tuple.
+        pressure and timeout override those of the constructor for this call.
+        If map is 'never', the buffer is not mapped to the CPU, and usr_ptr
+        and usr_buf are None; it can be mapped later with the map method.
+        '''
+        assert map in ['eager', 'never']
+        start = self.__begin()
+        try:
+            if not self.__caching:
+                mem = self.__alloc(size, cached, name, pressure, timeout,
+                                   map == 'eager')
+            else:
+                key = (cached, self.raw.align(size, resource.getpagesize()),
+                       map == 'eager')
+                mem = self.__cache_get(key)
+                if mem is None:
+                    mem = self.__alloc(key[1], cached, name, pressure,
+                                       timeout, key[2])
+                else:
+                    if mem[3] is not None:
+                        mem[3].seek(0)
+                    if self.stats is not None:
+                        # Attribute the reused buffer to the new name.
+                        self.stats.record_free(driver=self.raw.driver,
+                                               handle=mem[0])
+                        self.stats.record_alloc(driver=self.raw.driver,
+                                                handle=mem[0], name=name,
+                                                size=key[1])
+                self.__live[mem[0]] = (key, mem)
+
+            handle, bus_ptr, usr_ptr, usr_buf = mem
+            self.__names[handle] = name
+            self.index.add(handle=handle, bus_ptr=bus_ptr, usr_ptr=usr_ptr,
+                           size=self.__sizes[handle])
+            return mem
+        finally:
+            self.__end('alloc', start)
+
+    def __alloc(self, size, cached, name, pressure, timeout, map):
+        size_aligned = self.raw.align(size, resource.getpagesize())
+        self.__admit(size_aligned, pressure, timeout)
+        try:
+            mem = self.raw.alloc(size=size, cached=cached, name=name, map=map)
+        except BaseException:
+            with self.__lock:
+                self.__pending -= size_aligned
+                self.__freed.notify_all()
+            raise
+        with self.__lock:
+            self.__pending -= size_aligned
+            self.__used += size_aligned
+            self.__sizes[mem[0]] = size_aligned
+        if self.stats is not None:
+            self.stats.record_alloc(driver=self.raw.driver, handle=mem[0],
+                                    name=name, size=size_aligned)
+        return mem
+
+    def malloc(self, *, size, cached, name, pressure=None, timeout=None,
+               map='eager'):
+        '''
+        The same as malloc_cache, but returns a VCSMBuffer.
+        map is 'eager', 'lazy' or 'never'; a 'lazy' buffer is mapped to the
+        CPU on its first CPU access, so that allocating buffers only accessed
+        by the device costs only the allocation ioctl.
+        '''
+        assert map in ['eager', 'lazy', 'never']
+        handle, bus_ptr, usr_ptr, usr_buf = \
+            self.malloc_cache(size=size, cached=cached, name=name,
+                              pressure=pressure, timeout=timeout,
+                              map='eager' if map == 'eager' else 'never')
+        return VCSMBuffer(owner=self, handle=handle, bus_ptr=bus_ptr,
+                          usr_ptr=usr_ptr, usr_buf=usr_buf, size=size,
+                          cached=cached, mapping=map)
+
+    def malloc_many(self, *, count, size, cached, name, alignment=None,
+                    pressure=None, timeout=None):
+        '''
+        Allocate count buffers of size bytes at once and return them as a
+        VCSMBufferGroup.
+        The buffers are slots of a single allocation, each of which starts at
+        a multiple of alignment, which defaults to the page size, so that
+        setting up many buffers costs a single round trip to the driver.
+        '''
+        assert count >= 1
+        if alignment is None:
+            alignment = resource.getpagesize()
+        stride = self.raw.align(size, alignment)
+        mem = self.malloc_cache(size=stride * (count - 1) + size,
+                                cached=cached, name=name, pressure=pressure,
+                                timeout=timeout)
+        return VCSMBufferGroup(self, mem, count=count, size=size,
+                               stride=stride, cached=cached)
+
+    def map(self, *, handle, size):
+        '''Map a buffer allocated with map='never' to the CPU and return a
+        (usr_ptr, usr_buf) tuple.'''
+        self.__begin()
+        try:
+            usr_ptr, usr_buf = self.raw.map(handle=handle, size=size)
+            self.index.set_usr_ptr(handle=handle, usr_ptr=usr_ptr)
+            if self.__caching:
+                (cached, size_aligned, mapped), mem = self.__live[handle]
+                assert not mapped
+                self.__live[handle] = ((cached, size_aligned, True),
+                                       (handle, mem[1], usr_ptr, usr_buf))
+            return usr_ptr, usr_buf
+        finally:
+            # The mmap is recorded by the raw driver.
+            self.__end('mmap', None)
 
     def free(self, *, handle, usr_buf):
-        self.raw.free(handle=handle, usr_buf=usr_buf)
+        start = self.__begin(freeing=True)
+        try:
+            self.index.remove(handle=handle)
+            self.__names.pop(handle, None)
+            if self.__caching:
+                key, mem = self.__live.pop(handle)
+                assert mem[3] is usr_buf
+                if self.__cache_put(key, mem):
+                    return
+            if self.deferred_free:
+                self.__free_later(handle, usr_buf)
+            else:
+                self.__free(handle, usr_buf)
+        finally:
+            self.__end('free', start)
+
+    def __free_later(self, handle, usr_buf):
+        with self.__lock:
+            self.__deferred.append((handle, usr_buf))
+            self.__deferred_bytes += self.__sizes[handle]
+            if self.__reclaimer is None:
+                self.__reclaimer = threading.Thread(
+                    target=self.__reclaim_loop, name='rpi_vcsm.reclaim',
+                    daemon=True)
+                self.__reclaimer.start()
+            self.__reclaim.notify()
+
+    def __reclaim_loop(self):
+        while True:
+            with self.__lock:
+                while not self.__deferred and not self.__reclaim_stop:
+                    self.__reclaim.wait()
+                if not self.__deferred:
+                    return
+            self.__reclaim_batch()
+
+    def __reclaim_batch(self):
+        # Returns the number of bytes released.
+        with self.__lock:
+            batch = self.__deferred
+            self.__deferred = []
+        n = 0
+        for handle, usr_buf in batch:
+            with self.__lock:
+                size = self.__sizes[handle]
+            try:
+                self.__free(handle, usr_buf)
+            finally:
+                with self.__lock:
+                    self.__deferred_bytes -= size
+            n += size
+        return n
+
+    def reclaim(self):
+        '''Return the buffers queued by deferred free to the driver on the
+        calling thread, and return the number of bytes released.'''
+        self.__begin(freeing=True)
+        try:
+            return self.__reclaim_batch()
+        finally:
+            # The frees are recorded when they are queued.
+            self.__end('free', None)
+
+    def to_bus(self, usr_addr):
+        '''Return the bus address of a user address inside a live buffer.'''
+        return self.index.to_bus(usr_addr)
+
+    def to_usr(self, bus_addr):
+        '''Return the user address of a bus address inside a live buffer.'''
+        return self.index.to_usr(bus_addr)
+
+    def owner(self, *, usr_addr=None, bus_addr=None):
+        '''Return the handle of the live buffer which contains either a user or
+        a bus address.'''
+        return self.index.owner(usr_addr=usr_addr, bus_addr=bus_addr)
+
+    def get_deferred_bytes(self):
+        '''Return the number of bytes queued by deferred free.'''
+        return self.__deferred_bytes
+
+    def __free(self, handle, usr_buf):
+        # The handle may be reused by another thread as soon as the driver
+        # frees it, so it is forgotten before that.
+        with self.__lock:
+            size = self.__sizes.pop(handle)
+        if self.stats is not None:
+            self.stats.record_free(driver=self.raw.driver, handle=handle)
+        try:
+            self.raw.free(handle=handle, usr_buf=usr_buf)
+        finally:
+            with self.__lock:
+                self.__used -= size
+                self.__freed.notify_all()
+
+    def load_file(self, path, *, cached, name, chunk_size=IO_CHUNK_SIZE):
+        '''Allocate a VCSMBuffer of the size of the file at path and read the
+        whole file into it.
+        Raises ValueError if the file is empty, as no buffer can be empty.'''
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                raise ValueError(f'{path} is empty')
+            buf = self.malloc(size=size, cached=cached, name=name)
+            try:
+                n = buf.readinto_from(fd, file_offset=0, chunk_size=chunk_size)
+                if n != size:
+                    raise EOFError(f'{path} is truncated while reading')
+            except BaseException:
+                buf.free()
+                raise
+        finally:
+            os.close(fd)
+        return buf
 
     def clean_invalidate(self, *, op, handle=None, usr_ptr=None, size=None):
-        if isinstance(self.raw, raw_vcsm):
-            assert usr_ptr is not None
-            assert size is not None
-            self.raw.clean_invalid(op=op, usr_ptr=usr_ptr, size=size)
-        else:
-            assert handle is not None
-            self.raw.clean_invalid(op=op, handle=handle)
+        if self.observer is not None:
+            self.__observe_sync(op, handle, usr_ptr, False)
+        self.__clean_invalidate(op, handle, usr_ptr, size)
+
+    def __clean_invalidate(self, op, handle, usr_ptr, size):
+        start = self.__begin()
+        try:
+            if isinstance(self.raw, raw_vcsm):
+                assert usr_ptr is not None
+                assert size is not None
+                self.raw.clean_invalid(op=op, usr_ptr=usr_ptr, size=size)
+            else:
+                assert handle is not None
+                self.raw.clean_invalid(op=op, handle=handle)
+        finally:
+            self.__end('clean_invalidate', start)
+
+    def __observe_sync(self, op, handle, usr_ptr, tracked):
+        observer = self.observer
+        if observer is None or op == CACHE_OP_NOP:
+            return
+        try:
+            if handle is None:
+                handle = self.index.owner(usr_addr=usr_ptr)
+            name = self.__names[handle]
+        except KeyError:
+            return
+        observer.observe_sync(name, op=op, tracked=tracked)
+
+    def observe_access(self, buf, *, read_bytes=0, write_bytes=0):
+        '''Report the bytes the CPU read from and wrote to a VCSMBuffer to the
+        observer.'''
+        observer = self.observer
+        if observer is None:
+            return
+        name = self.__names.get(buf.handle)
+        if name is not None:
+            observer.observe_access(name, read_bytes=read_bytes,
+                                    write_bytes=write_bytes)
+
+    def __track(self, buf, op, write):
+        # Returns whether op is needed on buf and updates its state.
+        if op == CACHE_OP_NOP:
+            return False
+        if self.observer is not None and buf.needs(op):
+            self.__observe_sync(op, buf.handle, None, True)
+        issued = buf.transition(op=op, write=write)
+        with self.__counts_lock:
+            self.cache_op_counts['issued' if issued else 'elided'] += 1
+        return issued
+
+    def clean_invalidate_buffer(self, buf, *, op, write=True):
+        '''
+        Perform a cache operation on a VCSMBuffer only if its ownership state
+        requires it.
+        write tells whether the CPU writes to the buffer after invalidate or
+        flush.
+        Returns True if the operation is issued.
+        '''
+        if not buf.is_mapped() or not self.__track(buf, op, write):
+            return False
+        self.__clean_invalidate(op, buf.handle, buf.usr_ptr, buf.size)
+        return True
+
+    def begin_cpu_access(self, buf, *, write=True):
+        return self.clean_invalidate_buffer(buf, op=CACHE_OP_INVALIDATE,
+                                            write=write)
+
+    def end_cpu_access(self, buf):
+        return self.clean_invalidate_buffer(buf, op=CACHE_OP_CLEAN)
+
+    def clean_invalidate_range(self, *, op, offset, length, handle=None,
+                               usr_ptr=None, size=None):
+        '''
+        Perform a cache operation on length bytes from offset of a buffer.
+
+        The plain VCSM driver operates only on the range.
+        The dma-buf sync of the other drivers always operates on the whole
+        buffer, so the whole buffer is operated instead.
+        Returns True if only the range is operated, and False otherwise.
+        '''
+        assert offset >= 0 and length >= 0
+        assert size is None or offset + length <= size
+        start = self.__begin()
+        try:
+            if isinstance(self.raw, raw_vcsm):
+                assert usr_ptr is not None
+                if length:
+                    self.raw.clean_invalid(op=op, usr_ptr=usr_ptr + offset,
+                                           size=length)
+                return True
+            else:
+                assert handle is not None
+                self.raw.clean_invalid(op=op, handle=handle)
+                return False
+        finally:
+            self.__end('clean_invalidate', start)
+
+    def clean_invalidate_2d(self, *, op, rows, row_bytes, stride, offset=0,
+                            handle=None, usr_ptr=None, size=None):
+        '''
+        Perform a cache operation on a 2D region of a buffer, which consists of
+        rows of row_bytes bytes, each of which starts stride bytes after the
+        previous one, beginning at offset.
+
+        The plain VCSM driver operates only on the rows with a strided block.
+        The dma-buf sync of the other drivers always operates on the whole
+        buffer, so the whole buffer is operated instead.
+        Returns True if only the region is operated, and False otherwise.
+        '''
+        assert offset >= 0 and rows >= 0 and 0 <= row_bytes <= stride
+        assert size is None or rows == 0 \
+            or offset + (rows - 1) * stride + row_bytes <= size
+        start = self.__begin()
+        try:
+            if isinstance(self.raw, raw_vcsm):
+                assert usr_ptr is not None
+                if rows and row_bytes:
+                    self.raw.clean_invalid(op=op, usr_ptr=usr_ptr + offset,
+                                           size=row_bytes, block_count=rows,
+                                           inter_block_stride=stride)
+                return True
+            else:
+                assert handle is not None
+                self.raw.clean_invalid(op=op, handle=handle)
+                return False
+        finally:
+            self.__end('clean_invalidate', start)
+
+    def clean_invalidate_many(self, ops):
+        '''
+        Perform cache operations on many buffers at once.
+
+        ops is a list of (buffer, op), where buffer is a VCSMBuffer or a
+        (handle, bus_ptr, usr_ptr, usr_buf) tuple returned by malloc_cache and
+        op is one of CACHE_OP_*.
+        The whole of each buffer is operated.
+        Operations on VCSMBuffer which are not required by its state are
+        elided, and those on unmapped buffers are skipped.
+        The plain VCSM driver takes all of the operations in a single ioctl.
+        '''
+        items = []
+        for buf, op in ops:
+            if isinstance(buf, VCSMBuffer):
+                if buf.is_mapped() and self.__track(buf, op, True):
+                    items.append((op, buf.handle, buf.usr_ptr, buf.size))
+            else:
+                handle, bus_ptr, usr_ptr, usr_buf = buf
+                if usr_buf is None:
+                    continue
+                if self.observer is not None:
+                    self.__observe_sync(op, handle, usr_ptr, False)
+                items.append((op, handle, usr_ptr, len(usr_buf)))
+
+        start = self.__begin()
+        try:
+            if isinstance(self.raw, raw_vcsm):
+                self.raw.clean_invalid_many(ops=[
+                    (op, usr_ptr, size)
+                    for op, handle, usr_ptr, size in items])
+            else:
+                self.raw.clean_invalid_many(ops=[
+                    (op, handle) for op, handle, usr_ptr, size in items])
+        finally:
+            self.__end('clean_invalidate', start)
 
     def invalidate(self, *, handle=None, usr_ptr=None, size=None):
         self.clean_invalidate(op=CACHE_OP_INVALIDATE, handle=handle,
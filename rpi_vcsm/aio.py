@@ -0,0 +1,148 @@
+'''
+asyncio integration of VCSM.
+
+AsyncVCSM runs allocations, frees, cache operations and copies, which may block
+for milliseconds on large buffers, on a bounded executor so that they do not
+stall the event loop.
+An operation which is cancelled while it is running on the executor still runs
+to completion; a buffer allocated by a cancelled malloc is freed in the
+background, so that handles and mappings are never leaked.
+'''
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+
+from .VCSM import VCSM
+from .transfer import copy_in, copy_out
+
+
+class AsyncVCSMBuffer:
+
+    '''
+    A VCSMBuffer allocated by AsyncVCSM.malloc.
+
+    The attributes of the underlying VCSMBuffer, which is also available as
+    buffer, can be read through this object.
+    '''
+
+    __slots__ = ('avcsm', 'buffer')
+
+    def __init__(self, avcsm, buffer):
+        self.avcsm = avcsm
+        self.buffer = buffer
+
+    def __getattr__(self, name):
+        return getattr(self.buffer, name)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.free()
+        return False
+
+    async def free(self):
+        await self.avcsm.free(self)
+
+    async def clean(self):
+        return await self.avcsm.clean(self)
+
+    async def invalidate(self):
+        return await self.avcsm.invalidate(self)
+
+    async def copy_in(self, src, *, offset=0):
+        return await self.avcsm.copy_in(self, src, offset=offset)
+
+    async def copy_out(self, dst, *, offset=0):
+        return await self.avcsm.copy_out(self, dst, offset=offset)
+
+
+class AsyncVCSM:
+
+    '''
+    An asyncio facade over VCSM.
+
+    If vcsm is None, a VCSM is opened with the keyword arguments and closed
+    with this object.
+    The operations run on an executor of max_workers threads, which defaults to
+    the number of CPUs.
+    '''
+
+    def __init__(self, vcsm=None, *, max_workers=None, **kwargs):
+        self.__owns_vcsm = vcsm is None
+        self.vcsm = VCSM(**kwargs) if vcsm is None else vcsm
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='rpi_vcsm.aio')
+        # Allocations of which awaiting tasks are cancelled.
+        self.__orphans = set()
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        # Orphaned buffers are submitted to be freed when their allocations
+        # complete, and then the executor waits for the operations which are
+        # still running, including those of which awaiting tasks are
+        # cancelled.
+        if self.__orphans:
+            await asyncio.wait(self.__orphans)
+        await loop.run_in_executor(None, self.executor.shutdown)
+        if self.__owns_vcsm:
+            self.vcsm.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    async def __run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor,
+                                      partial(func, *args, **kwargs))
+        # The operation cannot be stopped once it is started, so the caller is
+        # cancelled but the future runs to completion.
+        return await asyncio.shield(future)
+
+    def __free_orphan(self, future):
+        self.__orphans.discard(future)
+        if not future.cancelled() and future.exception() is None:
+            self.executor.submit(future.result().free)
+
+    async def malloc(self, *, size, cached, name):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.executor,
+            partial(self.vcsm.malloc, size=size, cached=cached, name=name))
+        try:
+            buffer = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            self.__orphans.add(future)
+            future.add_done_callback(self.__free_orphan)
+            raise
+        return AsyncVCSMBuffer(self, buffer)
+
+    @staticmethod
+    def __buffer(buf):
+        return buf.buffer if isinstance(buf, AsyncVCSMBuffer) else buf
+
+    async def free(self, buf):
+        await self.__run(self.__buffer(buf).free)
+
+    async def clean(self, buf):
+        return await self.__run(self.__buffer(buf).clean)
+
+    async def invalidate(self, buf):
+        return await self.__run(self.__buffer(buf).invalidate)
+
+    async def copy_in(self, buf, src, *, offset=0):
+        return await self.__run(copy_in, self.__buffer(buf), src,
+                                offset=offset)
+
+    async def copy_out(self, buf, dst, *, offset=0):
+        return await self.__run(copy_out, self.__buffer(buf), dst,
+                                offset=offset)
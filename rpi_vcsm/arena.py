@@ -0,0 +1,158 @@
+'''
+A sub-allocator that carves many small buffers out of one large VCSM block.
+
+Each allocation through the drivers is page-aligned and costs its own handle and
+mapping.
+VCSMArena allocates one block with VCSM.malloc_cache and hands out sub-ranges of
+it with a configurable alignment.
+Freed ranges are coalesced with their neighbors so that long-running processes
+do not fragment the block.
+'''
+
+
+from bisect import bisect_left
+
+from . import *
+
+
+def align(u, a):
+    '''Round u up to a multiple of a, which must be a power of two.'''
+    assert isinstance(u, int) and u >= 0
+    assert isinstance(a, int) and a >= 1
+    return (u + (a - 1)) & ~(a - 1)
+
+
+class FreeList:
+
+    '''
+    Free ranges of [0, size), sorted by offset and coalesced on free.
+    '''
+
+    def __init__(self, size):
+        assert isinstance(size, int) and size >= 0
+        self.__offsets = [0] if size else []
+        self.__sizes = [size] if size else []
+        self.free_bytes = size
+
+    def alloc(self, size, alignment=1):
+        '''Return the offset of the first free range that fits, or None.'''
+        assert isinstance(size, int) and size >= 1
+        assert alignment & (alignment - 1) == 0
+
+        for i, (offset, free_size) in enumerate(zip(self.__offsets,
+                                                    self.__sizes)):
+            start = align(offset, alignment)
+            end = start + size
+            if end > offset + free_size:
+                continue
+
+            tail = offset + free_size - end
+            if start == offset:
+                del self.__offsets[i], self.__sizes[i]
+            else:
+                self.__sizes[i] = start - offset
+                i += 1
+            if tail:
+                self.__offsets.insert(i, end)
+                self.__sizes.insert(i, tail)
+
+            self.free_bytes -= size
+            return start
+
+        return None
+
+    def free(self, offset, size):
+        assert isinstance(size, int) and size >= 1
+
+        i = bisect_left(self.__offsets, offset)
+        assert i == len(self.__offsets) or offset + size <= self.__offsets[i]
+        assert i == 0 or self.__offsets[i - 1] + self.__sizes[i - 1] <= offset
+
+        self.free_bytes += size
+
+        if i > 0 and self.__offsets[i - 1] + self.__sizes[i - 1] == offset:
+            i -= 1
+            offset = self.__offsets[i]
+            size += self.__sizes[i]
+            del self.__offsets[i], self.__sizes[i]
+        if i < len(self.__offsets) and offset + size == self.__offsets[i]:
+            size += self.__sizes[i]
+            del self.__offsets[i], self.__sizes[i]
+
+        self.__offsets.insert(i, offset)
+        self.__sizes.insert(i, size)
+
+    def ranges(self):
+        return list(zip(self.__offsets, self.__sizes))
+
+
+class VCSMArena:
+
+    def __init__(self, vcsm, *, size, cached, name, alignment=64):
+        assert alignment >= 1 and alignment & (alignment - 1) == 0
+
+        self.vcsm = vcsm
+        self.alignment = alignment
+
+        self.handle, self.bus_ptr, self.usr_ptr, self.usr_buf = \
+            vcsm.malloc_cache(size=size, cached=cached, name=name)
+        self.size = size
+
+        self.__view = memoryview(self.usr_buf)
+        self.__free_list = FreeList(size)
+        # offset -> (size, view) of the live sub-ranges.
+        self.__live = {}
+
+    def close(self):
+        for size, view in self.__live.values():
+            view.release()
+        self.__live.clear()
+        self.__view.release()
+        self.vcsm.free(handle=self.handle, usr_buf=self.usr_buf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return exc_value is None
+
+    def get_free_bytes(self):
+        return self.__free_list.free_bytes
+
+    def alloc(self, *, size, alignment=None):
+        '''Return (offset, bus_ptr, usr_ptr, usr_view) of a new sub-range.'''
+        if alignment is None:
+            alignment = self.alignment
+        size = align(size, alignment)
+
+        offset = self.__free_list.alloc(size, alignment)
+        if offset is None:
+            raise MemoryError(f'No free range of {size} bytes in the arena')
+
+        view = self.__view[offset:offset + size]
+        self.__live[offset] = (size, view)
+        return offset, self.bus_ptr + offset, self.usr_ptr + offset, view
+
+    def free(self, *, offset):
+        size, view = self.__live.pop(offset)
+        view.release()
+        self.__free_list.free(offset, size)
+
+    def clean_invalidate(self, *, op, offset=None):
+        '''Perform a cache operation on the sub-range at offset, or on the whole
+        block if offset is None.'''
+        if offset is None:
+            self.vcsm.clean_invalidate(op=op, handle=self.handle,
+                                       usr_ptr=self.usr_ptr, size=self.size)
+            return
+        length, view = self.__live[offset]
+        self.vcsm.clean_invalidate_range(op=op, offset=offset, length=length,
+                                         handle=self.handle,
+                                         usr_ptr=self.usr_ptr, size=self.size)
+
+    def invalidate(self, *, offset=None):
+        self.clean_invalidate(op=CACHE_OP_INVALIDATE, offset=offset)
+
+    def clean(self, *, offset=None):
+        self.clean_invalidate(op=CACHE_OP_CLEAN, offset=offset)
@@ -0,0 +1,424 @@
+'''
+Benchmarks of the drivers.
+
+    $ python3 -m rpi_vcsm.bench [--driver DRIVER ...] [--format json|csv]
+                                [--output FILE] [--baseline FILE]
+                                [--startup] [--calls]
+
+The following are measured for each driver and cache mode:
+- alloc, free: latency of malloc_cache and free over a sweep of sizes.
+- clean, invalidate: latency of the cache operations over the sizes.
+- read, write, copy: throughput of copying from a buffer to host memory, from
+  host memory to a buffer, and from a buffer to another.
+- churn: latency of alloc and free of random small sizes interleaved with each
+  other, as in tests/test_alloc.py.
+
+With --startup, the following are also measured:
+- import: time to import rpi_vcsm.VCSM in a new interpreter, as reported by
+  python3 -X importtime.
+- open: latency of opening and closing a VCSM for each driver.
+
+With --calls, the argument setup of the ioctls is measured per call with a
+no-op ioctl, so that the overhead of the library is not hidden by the driver,
+which the emulated driver bypasses:
+- alloc_args: the VCSM-CMA alloc argument reused for each thread, and
+  alloc_args_built: the same argument built for each call.
+- sync_args: the dma-buf sync argument shared for each flags, and
+  sync_args_built: the same argument built for each call.
+- sync_many: a sync of clean_invalid_many with the prepared arguments.
+
+Each result carries the percentiles of the samples, in ns for latencies and in
+MB/s for throughputs.
+Passing the JSON output of a previous run as --baseline compares the medians
+against it, and the command exits with status 1 if any of them is worse than
+the baseline by more than --threshold.
+The emulated driver, which is selected with --driver emulated, can be used to
+measure the overhead of the library itself.
+'''
+
+
+import argparse
+from ctypes import addressof, c_byte, memmove
+import csv
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from time import perf_counter_ns
+
+from . import *
+from .VCSM import VCSM, dma_buf, raw_vcsm_cma
+
+
+DRIVERS = ['vcsm', 'vcsm-cma', 'emulated']
+CACHED = {
+    'none': CACHE_NONE,
+    'host': CACHE_HOST,
+    'vc': CACHE_VC,
+    'both': CACHE_BOTH,
+}
+SIZES = [2 ** 12, 2 ** 16, 2 ** 20, 2 ** 24]
+PERCENTILES = [50, 90, 99]
+FIELDS = ['bench', 'driver', 'cached', 'size', 'unit', 'n', 'min',
+          'p50', 'p90', 'p99', 'max', 'mean']
+
+
+def percentile(samples, q):
+    '''The q-th percentile of the sorted samples by the nearest rank.'''
+    rank = -(-q * len(samples) // 100)
+    return samples[max(rank, 1) - 1]
+
+
+def summarize(samples, **key):
+    samples = sorted(samples)
+    result = dict(key)
+    result['n'] = len(samples)
+    result['min'] = samples[0]
+    for q in PERCENTILES:
+        result[f'p{q}'] = percentile(samples, q)
+    result['max'] = samples[-1]
+    result['mean'] = sum(samples) / len(samples)
+    return result
+
+
+def parse_size(s):
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    s = s.strip().upper()
+    if s[-1:] in units:
+        return int(s[:-1]) * units[s[-1]]
+    return int(s)
+
+
+def bench_alloc(vcsm, *, cached, size, repeat):
+    t_alloc, t_free = [], []
+    for i in range(repeat):
+        start = perf_counter_ns()
+        handle, bus_ptr, usr_ptr, usr_buf = \
+            vcsm.malloc_cache(size=size, cached=cached, name='bench')
+        t_alloc.append(perf_counter_ns() - start)
+
+        start = perf_counter_ns()
+        vcsm.free(handle=handle, usr_buf=usr_buf)
+        t_free.append(perf_counter_ns() - start)
+    return {'alloc': t_alloc, 'free': t_free}
+
+
+def bench_cache_op(vcsm, *, cached, size, repeat):
+    handle, bus_ptr, usr_ptr, usr_buf = \
+        vcsm.malloc_cache(size=size, cached=cached, name='bench')
+    t_clean, t_invalidate = [], []
+    try:
+        for i in range(repeat):
+            start = perf_counter_ns()
+            vcsm.clean(handle=handle, usr_ptr=usr_ptr, size=size)
+            t_clean.append(perf_counter_ns() - start)
+
+            start = perf_counter_ns()
+            vcsm.invalidate(handle=handle, usr_ptr=usr_ptr, size=size)
+            t_invalidate.append(perf_counter_ns() - start)
+    finally:
+        vcsm.free(handle=handle, usr_buf=usr_buf)
+    return {'clean': t_clean, 'invalidate': t_invalidate}
+
+
+def bench_throughput(vcsm, *, cached, size, repeat):
+    mems = [vcsm.malloc_cache(size=size, cached=cached, name='bench')
+            for i in range(2)]
+    host = bytearray(b'\x5a' * size)
+    host_ptr = addressof(c_byte.from_buffer(host))
+    src_ptr, dst_ptr = mems[0][2], mems[1][2]
+    copies = {
+        'read': (host_ptr, src_ptr),
+        'write': (src_ptr, host_ptr),
+        'copy': (dst_ptr, src_ptr),
+    }
+    results = {bench: [] for bench in copies}
+    try:
+        # Fault in the pages.
+        memmove(src_ptr, host_ptr, size)
+        memmove(dst_ptr, host_ptr, size)
+        for i in range(repeat):
+            for bench, (dst, src) in copies.items():
+                start = perf_counter_ns()
+                memmove(dst, src, size)
+                t = perf_counter_ns() - start
+                results[bench].append(size / max(t, 1) * 1e3)
+    finally:
+        for handle, bus_ptr, usr_ptr, usr_buf in mems:
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+    return results
+
+
+def bench_churn(vcsm, *, cached, maxsize=65536, n=100, live=16, seed=42):
+    rng = random.Random(seed)
+    t_alloc, t_free = [], []
+    mems = []
+
+    def free_one():
+        handle, bus_ptr, usr_ptr, usr_buf = \
+            mems.pop(rng.randrange(len(mems)))
+        start = perf_counter_ns()
+        vcsm.free(handle=handle, usr_buf=usr_buf)
+        t_free.append(perf_counter_ns() - start)
+
+    try:
+        for i in range(n):
+            if len(mems) >= live:
+                free_one()
+            size = rng.randint(1, maxsize)
+            start = perf_counter_ns()
+            mems.append(vcsm.malloc_cache(size=size, cached=cached,
+                                          name='bench'))
+            t_alloc.append(perf_counter_ns() - start)
+        while mems:
+            free_one()
+    finally:
+        for handle, bus_ptr, usr_ptr, usr_buf in mems:
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+    return {'churn_alloc': t_alloc, 'churn_free': t_free}
+
+
+def bench_import(*, repeat):
+    # The path of this package is passed so that the same one is imported.
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    t_import = []
+    # The first run is discarded, which may write the bytecode caches.
+    for i in range(repeat + 1):
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                            'import rpi_vcsm.VCSM'],
+                           env=env, stderr=subprocess.PIPE, text=True,
+                           check=True)
+        us = None
+        for line in p.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'rpi_vcsm.VCSM':
+                us = int(fields[1])
+        if us is None:
+            raise RuntimeError('No import time of rpi_vcsm.VCSM is reported'
+                               ' by python3 -X importtime')
+        if i:
+            t_import.append(us * 1000)
+    return {'import': t_import}
+
+
+def bench_open(*, driver, repeat, emulated_latency=None):
+    t_open = []
+    for i in range(repeat):
+        start = perf_counter_ns()
+        VCSM(force=driver, emulated_latency=emulated_latency).close()
+        t_open.append(perf_counter_ns() - start)
+    return {'open': t_open}
+
+
+def bench_calls(*, repeat, n=1000):
+    types = {}
+
+    def ioctl(fd, request, arg):
+        types.setdefault(request, type(arg))
+
+    def per_call(f):
+        samples = []
+        for i in range(repeat):
+            start = perf_counter_ns()
+            for j in range(n):
+                f()
+            samples.append((perf_counter_ns() - start) / n)
+        return samples
+
+    results = {}
+    # The device is replaced with a file, to which no ioctl is issued.
+    with tempfile.TemporaryFile() as f:
+        raw = raw_vcsm_cma(path=f'/proc/self/fd/{f.fileno()}')
+        try:
+            fd = f.fileno()
+            raw._ioctl = ioctl
+            alloc = raw._raw_vcsm_cma__ioctl_alloc
+            kwargs = {'size': 4096, 'num': 1, 'cached': CACHE_NONE, 'pad': 0,
+                      'name': b'bench'}
+            alloc(**kwargs)
+            (request, st_alloc), = types.items()
+
+            # As the method did before the argument was reused.
+            def alloc_built(*, size, num, cached, pad, name):
+                s = st_alloc(size=size, num=num, cached=cached, pad=pad,
+                             name=name)
+                raw._ioctl(fd, request, s)
+                return s.handle, s.vc_handle, s.dma_addr
+
+            results['alloc_args'] = per_call(lambda: alloc(**kwargs))
+            results['alloc_args_built'] = per_call(
+                lambda: alloc_built(**kwargs))
+
+            types.clear()
+            flags = dma_buf.SYNC_END | dma_buf.SYNC_RW
+            dma_buf.ioctl_sync(fd=fd, flags=flags, ioctl=ioctl)
+            (request, st_sync), = types.items()
+            results['sync_args'] = per_call(
+                lambda: dma_buf.ioctl_sync(fd=fd, flags=flags, ioctl=ioctl))
+
+            def sync_built(*, fd, flags):
+                ioctl(fd, request, st_sync(flags=flags))
+
+            results['sync_args_built'] = per_call(
+                lambda: sync_built(fd=fd, flags=flags))
+
+            raw._sync_many = \
+                lambda fd_args: dma_buf.ioctl_sync_many(fd_args, ioctl=ioctl)
+            ops = [(CACHE_OP_CLEAN, fd)]
+            results['sync_many'] = per_call(
+                lambda: raw.clean_invalid_many(ops=ops))
+        finally:
+            raw.close()
+    return results
+
+
+def run(*, drivers=DRIVERS, cached=list(CACHED), sizes=SIZES, repeat=20,
+        emulated_latency=None, startup=False, calls=False, log=sys.stderr):
+    '''Run the benchmarks and return a list of results, each of which is a dict
+    with the keys in FIELDS.'''
+    results = []
+    if startup:
+        print('Running import', file=log)
+        for bench, s in bench_import(repeat=repeat).items():
+            results.append(summarize(s, bench=bench, driver=None, cached=None,
+                                     size=0, unit='ns'))
+    if calls:
+        print('Running calls', file=log)
+        for bench, s in bench_calls(repeat=repeat).items():
+            results.append(summarize(s, bench=bench, driver='vcsm-cma',
+                                     cached=None, size=0, unit='ns'))
+    for driver in drivers:
+        try:
+            vcsm = VCSM(force=driver, emulated_latency=emulated_latency)
+        except OSError as e:
+            print('Skipping driver', driver, e, file=log)
+            continue
+        with vcsm:
+            if startup:
+                for bench, s in bench_open(
+                        driver=driver, repeat=repeat,
+                        emulated_latency=emulated_latency).items():
+                    results.append(summarize(s, bench=bench, driver=driver,
+                                             cached=None, size=0, unit='ns'))
+            for name in cached:
+                mode = CACHED[name]
+                print('Running driver', driver, 'cached', name, file=log)
+                for size in sizes:
+                    key = {'driver': driver, 'cached': name, 'size': size}
+                    for func, unit in [(bench_alloc, 'ns'),
+                                       (bench_cache_op, 'ns'),
+                                       (bench_throughput, 'MB/s')]:
+                        samples = func(vcsm, cached=mode, size=size,
+                                       repeat=repeat)
+                        for bench, s in samples.items():
+                            results.append(summarize(s, bench=bench, unit=unit,
+                                                     **key))
+                key = {'driver': driver, 'cached': name, 'size': 0}
+                for bench, s in bench_churn(vcsm, cached=mode).items():
+                    results.append(summarize(s, bench=bench, unit='ns', **key))
+    return results
+
+
+def compare(results, baseline, *, threshold):
+    '''
+    Compare the medians of results to those of baseline, and return a list of
+    (result, baseline result, ratio) of which the ratio is worse than 1 +
+    threshold, where the ratio is new / old for latencies and old / new for
+    throughputs.
+    '''
+    def key(r):
+        return (r['bench'], r['driver'], r['cached'], r['size'])
+
+    old = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = old.get(key(r))
+        if b is None:
+            continue
+        if r['unit'] == 'ns':
+            ratio = r['p50'] / max(b['p50'], 1)
+        else:
+            ratio = b['p50'] / max(r['p50'], 1e-9)
+        if ratio > 1 + threshold:
+            regressions.append((r, b, ratio))
+    return regressions
+
+
+def write(results, f, *, fmt):
+    if fmt == 'json':
+        json.dump({
+            'platform': {
+                'machine': platform.machine(),
+                'release': platform.release(),
+                'python': platform.python_version(),
+            },
+            'results': results,
+        }, f, indent=2)
+        f.write('\n')
+    else:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m rpi_vcsm.bench',
+                                     description='Benchmark the VCSM drivers.')
+    parser.add_argument('--driver', action='append', choices=DRIVERS,
+                        help='driver to run (default: all available)')
+    parser.add_argument('--cached', action='append', choices=list(CACHED),
+                        help='cache mode to run (default: all)')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma-separated sizes, with optional K/M/G '
+                             'suffixes')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of samples for each result')
+    parser.add_argument('--emulated-latency', type=float, default=None,
+                        help='seconds of latency injected into each ioctl of '
+                             'the emulated driver')
+    parser.add_argument('--startup', action='store_true',
+                        help='also measure the import and open times')
+    parser.add_argument('--calls', action='store_true',
+                        help='also measure the argument setup of the ioctls '
+                             'with a no-op ioctl')
+    parser.add_argument('--format', choices=['json', 'csv'], default='json')
+    parser.add_argument('--output', default='-',
+                        help='output file (default: stdout)')
+    parser.add_argument('--baseline',
+                        help='JSON output of a previous run to compare to')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='tolerated relative regression (default: 0.1)')
+    args = parser.parse_args(argv)
+
+    results = run(drivers=args.driver or DRIVERS,
+                  cached=args.cached or list(CACHED),
+                  sizes=[parse_size(s) for s in args.sizes.split(',')],
+                  repeat=args.repeat, emulated_latency=args.emulated_latency,
+                  startup=args.startup, calls=args.calls)
+
+    if args.output == '-':
+        write(results, sys.stdout, fmt=args.format)
+    else:
+        with open(args.output, 'w', newline='') as f:
+            write(results, f, fmt=args.format)
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, threshold=args.threshold)
+    for r, b, ratio in regressions:
+        print('Regression: %s driver=%s cached=%s size=%d: p50 %g -> %g %s'
+              % (r['bench'], r['driver'], r['cached'], r['size'], b['p50'],
+                 r['p50'], r['unit']), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
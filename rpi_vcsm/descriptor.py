@@ -0,0 +1,142 @@
+'''
+Tables of fixed-layout descriptors, such as DMA control blocks, in VCSM memory.
+
+A table is an array of a NumPy structured dtype on a VCSM buffer.
+write takes a column array (or a scalar) for each field, builds the entries in
+host memory in one vectorized pass, fills the field which points to the next
+entry with the bus addresses of the chained entries, and copies the result into
+the buffer with a single clean at the end, so that thousands of descriptors are
+written without a Python loop.
+
+build does the same without VCSM for a given bus address, so that the bytes
+written can be verified off-device.
+
+close frees the buffer once the views of the entries held by the user are
+gone, so that the memory is never unmapped under them.
+
+This module requires NumPy.
+'''
+
+
+import weakref
+
+import numpy
+
+from . import *
+from .arena import align
+
+
+# The control block of the DMA controller of BCM2835 and its successors, which
+# must be 32-byte aligned.
+DMA_CB = numpy.dtype([
+    ('ti', '<u4'),
+    ('source_ad', '<u4'),
+    ('dest_ad', '<u4'),
+    ('txfr_len', '<u4'),
+    ('stride', '<u4'),
+    ('nextconbk', '<u4'),
+    ('reserved', '<u4', (2,)),
+])
+
+
+def padded(dtype, alignment):
+    '''Return dtype of which itemsize is padded to a multiple of alignment.'''
+    dtype = numpy.dtype(dtype)
+    itemsize = align(dtype.itemsize, alignment)
+    if itemsize == dtype.itemsize:
+        return dtype
+    return numpy.dtype({
+        'names': list(dtype.names),
+        'formats': [dtype.fields[name][0] for name in dtype.names],
+        'offsets': [dtype.fields[name][1] for name in dtype.names],
+        'itemsize': itemsize,
+    })
+
+
+def build(columns, *, count, bus_ptr, dtype=DMA_CB, alignment=32,
+          next_field='nextconbk', chain='linear'):
+    '''
+    Return a structured array of count entries of dtype padded to alignment,
+    of which fields are filled with columns, a dict of field name -> array or
+    scalar.
+    If chain is 'linear', next_field of each entry is set to the bus address of
+    the next entry, on the assumption that the table is placed at bus_ptr, and
+    that of the last entry to 0.
+    If chain is 'ring', that of the last entry is set to the first entry.
+    If chain is None, next_field is left as given in columns.
+    '''
+    assert chain in ['linear', 'ring', None]
+    dtype = padded(dtype, alignment)
+    entries = numpy.zeros(count, dtype=dtype)
+    for name, column in columns.items():
+        entries[name] = column
+    if chain is not None and count:
+        entries[next_field][:-1] = bus_ptr + dtype.itemsize * \
+            numpy.arange(1, count, dtype=numpy.uint64)
+        entries[next_field][-1] = bus_ptr if chain == 'ring' else 0
+    return entries
+
+
+class DescriptorTable:
+
+    '''
+    A table of count descriptors of dtype, each of which is padded to
+    alignment, on a buffer allocated with VCSM.malloc_cache.
+    The buffer is uncached by default, which is required by engines which do
+    not snoop the CPU caches.
+    '''
+
+    def __init__(self, vcsm, *, count, dtype=DMA_CB, alignment=32,
+                 cached=CACHE_NONE, name='descriptor', next_field='nextconbk'):
+        assert alignment >= 1 and alignment & (alignment - 1) == 0
+
+        self.vcsm = vcsm
+        self.count = count
+        self.dtype = padded(dtype, alignment)
+        self.alignment = alignment
+        self.next_field = next_field
+        self.size = self.dtype.itemsize * count
+
+        self.handle, self.bus_ptr, self.usr_ptr, self.usr_buf = \
+            vcsm.malloc_cache(size=self.size, cached=cached, name=name)
+        assert self.bus_ptr % alignment == 0
+
+        # frombuffer exports the buffer through a memoryview, which all the
+        # views of the entries share as their base.
+        self.entries = numpy.frombuffer(self.usr_buf, dtype=self.dtype,
+                                        count=count)
+
+    def close(self):
+        if self.entries is None:
+            return
+        base = weakref.ref(self.entries.base)
+        self.entries = None
+        if base() is None:
+            self.vcsm.free(handle=self.handle, usr_buf=self.usr_buf)
+        else:
+            weakref.finalize(base(), self.vcsm.free, handle=self.handle,
+                             usr_buf=self.usr_buf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return exc_value is None
+
+    def get_bus_ptr(self, index):
+        '''Return the bus address of the entry at index.'''
+        return self.bus_ptr + self.dtype.itemsize * index
+
+    def write(self, *, chain='linear', **columns):
+        '''
+        Fill all the entries with columns as build does, and clean the buffer.
+        Returns the bus address of the first entry.
+        '''
+        self.entries[:] = build(columns, count=self.count,
+                                bus_ptr=self.bus_ptr, dtype=self.dtype,
+                                alignment=self.alignment,
+                                next_field=self.next_field, chain=chain)
+        self.vcsm.clean(handle=self.handle, usr_ptr=self.usr_ptr,
+                        size=self.size)
+        return self.bus_ptr
@@ -0,0 +1,187 @@
+'''
+Simultaneous use of the plain VCSM and VCSM-CMA drivers.
+
+On kernels which provide both drivers, VCSM uses only VCSM-CMA, which leaves the
+GPU-side memory area of gpu_mem= idle while CMA may run out.
+DualVCSM opens a VCSM for each driver and places each allocation in one of
+them:
+- An allocation of which name matches a pattern in names (fnmatch) is placed
+  in the driver given for it.
+- Otherwise, an allocation of size_threshold bytes or larger is placed in
+  large, and a smaller one in default.
+- A placement callable, if given, decides instead of them, which is called
+  with size, cached and name and returns 'vcsm' or 'vcsm-cma'.
+If spill is True, an allocation which fails in the chosen driver is retried in
+the other one.
+
+Buffers returned by malloc are owned by the VCSM of their driver, so that
+freeing them and cache operations on them are routed to it; buf.get_driver()
+tells which one.
+Buffers returned by malloc_cache are routed by the address index of each
+VCSM, with their handles, or with their user addresses if both drivers have
+a buffer of the same handle.
+'''
+
+
+from fnmatch import fnmatchcase
+import threading
+
+from . import *
+from .VCSM import VCSM, VCSMBuffer
+
+
+DRIVERS = ['vcsm', 'vcsm-cma']
+
+
+class DualVCSM:
+
+    '''
+    vcsm and vcsm_cma are the VCSM objects of each driver, which are opened
+    with the paths and the other keyword arguments if they are None, and
+    closed with this object.
+    '''
+
+    def __init__(self, *, vcsm=None, vcsm_cma=None, default='vcsm-cma',
+                 size_threshold=None, large='vcsm', names=None, placement=None,
+                 spill=True, path_vcsm=None, path_vcsm_cma=None, **kwargs):
+        assert default in DRIVERS and large in DRIVERS
+
+        self.__owned = []
+        if vcsm is None:
+            vcsm = VCSM(force='vcsm', path_vcsm=path_vcsm, **kwargs)
+            self.__owned.append(vcsm)
+        if vcsm_cma is None:
+            try:
+                vcsm_cma = VCSM(force='vcsm-cma', path_vcsm_cma=path_vcsm_cma,
+                                **kwargs)
+            except BaseException:
+                for v in self.__owned:
+                    v.close()
+                raise
+            self.__owned.append(vcsm_cma)
+        self.pools = {'vcsm': vcsm, 'vcsm-cma': vcsm_cma}
+
+        self.default = default
+        self.size_threshold = size_threshold
+        self.large = large
+        self.names = {} if names is None else dict(names)
+        self.placement = placement
+        self.spill = spill
+
+        self.__lock = threading.Lock()
+        # id(usr_buf) -> pool of the buffers allocated by malloc_cache.
+        self.__by_usr_buf = {}
+
+    def close(self):
+        for vcsm in self.__owned:
+            vcsm.close()
+        self.__owned.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return exc_value is None
+
+    def place(self, *, size, cached, name):
+        '''Return the driver in which an allocation is placed first.'''
+        if self.placement is not None:
+            driver = self.placement(size=size, cached=cached, name=name)
+            assert driver in DRIVERS
+            return driver
+        for pattern, driver in self.names.items():
+            if fnmatchcase(name, pattern):
+                return driver
+        if self.size_threshold is not None and size >= self.size_threshold:
+            return self.large
+        return self.default
+
+    def __alloc(self, method, size, cached, name, kwargs):
+        driver = self.place(size=size, cached=cached, name=name)
+        try:
+            return self.pools[driver], getattr(self.pools[driver], method)(
+                size=size, cached=cached, name=name, **kwargs)
+        except OSError:
+            if not self.spill:
+                raise
+        other = DRIVERS[1 - DRIVERS.index(driver)]
+        return self.pools[other], getattr(self.pools[other], method)(
+            size=size, cached=cached, name=name, **kwargs)
+
+    def malloc(self, *, size, cached, name, **kwargs):
+        '''Allocate a VCSMBuffer owned by the VCSM of the placed driver.'''
+        pool, buf = self.__alloc('malloc', size, cached, name, kwargs)
+        return buf
+
+    def malloc_cache(self, *, size, cached, name, **kwargs):
+        if kwargs.get('map', 'eager') == 'never':
+            raise ValueError('Use malloc for unmapped buffers')
+        pool, mem = self.__alloc('malloc_cache', size, cached, name, kwargs)
+        with self.__lock:
+            self.__by_usr_buf[id(mem[3])] = pool
+        return mem
+
+    def free(self, *, handle, usr_buf):
+        with self.__lock:
+            pool = self.__by_usr_buf.pop(id(usr_buf))
+        pool.free(handle=handle, usr_buf=usr_buf)
+
+    def get_pool(self, *, handle=None, usr_ptr=None):
+        '''
+        Return the VCSM of a buffer allocated by malloc_cache, which is looked
+        up by usr_ptr if it is given, and by handle otherwise.
+        usr_ptr is required if both drivers have a buffer of the handle.
+        '''
+        if usr_ptr is not None:
+            for pool in self.pools.values():
+                try:
+                    pool.index.owner(usr_addr=usr_ptr)
+                except KeyError:
+                    continue
+                return pool
+            raise KeyError(f'0x{usr_ptr:x} is not in any allocation')
+        pools = [pool for pool in self.pools.values() if handle in pool.index]
+        if not pools:
+            raise KeyError(f'No buffer of handle {handle}')
+        if len(pools) > 1:
+            raise ValueError(f'Both drivers have a buffer of handle {handle}; '
+                             'usr_ptr is required')
+        return pools[0]
+
+    def get_usage(self):
+        '''Return a dict of driver -> {'used': bytes held, 'headroom': bytes
+        which can be allocated before the limits or None}.'''
+        return {
+            driver: {'used': pool.get_used_bytes(),
+                     'headroom': pool.get_headroom()}
+            for driver, pool in self.pools.items()
+        }
+
+    def clean_invalidate(self, *, op, handle=None, usr_ptr=None, size=None):
+        self.get_pool(handle=handle, usr_ptr=usr_ptr).clean_invalidate(
+            op=op, handle=handle, usr_ptr=usr_ptr, size=size)
+
+    def clean_invalidate_buffer(self, buf, *, op, write=True):
+        return buf.owner.clean_invalidate_buffer(buf, op=op, write=write)
+
+    def clean_invalidate_many(self, ops):
+        '''The same as VCSM.clean_invalidate_many, which issues the operations
+        on each driver at once.'''
+        grouped = {}
+        for buf, op in ops:
+            if isinstance(buf, VCSMBuffer):
+                pool = buf.owner
+            else:
+                pool = self.get_pool(handle=buf[0], usr_ptr=buf[2])
+            grouped.setdefault(id(pool), (pool, []))[1].append((buf, op))
+        for pool, pool_ops in grouped.values():
+            pool.clean_invalidate_many(pool_ops)
+
+    def invalidate(self, *, handle=None, usr_ptr=None, size=None):
+        self.clean_invalidate(op=CACHE_OP_INVALIDATE, handle=handle,
+                              usr_ptr=usr_ptr, size=size)
+
+    def clean(self, *, handle=None, usr_ptr=None, size=None):
+        self.clean_invalidate(op=CACHE_OP_CLEAN, handle=handle,
+                              usr_ptr=usr_ptr, size=size)
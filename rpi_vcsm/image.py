@@ -0,0 +1,199 @@
+'''
+Multi-plane image buffers.
+
+VCSMImage allocates all the planes of an image in one VCSM block, each of which
+starts at a multiple of plane_alignment and has rows of a multiple of
+stride_alignment bytes, so that the layout matches what the camera, the ISP
+and the GPU expect without computing offsets by hand.
+The planes are exposed with their bus addresses, user pointers and strides, and
+as NumPy views which share the memory.
+
+The block is a VCSMBuffer, and cache operations can be performed on a single
+plane.
+The plain VCSM driver operates only on the rows of the plane with a strided
+block, and the dma-buf sync of the other drivers operates on the whole block.
+Each plane tracks its ownership state with the rules of VCSMBuffer, so that
+redundant operations are elided; cache operations must thus be performed
+through the image rather than its buffer.
+'''
+
+
+from . import *
+from .arena import align
+from .VCSM import VCSMBuffer
+
+
+# format -> list of (plane name, horizontal subsampling, vertical subsampling,
+# bytes per sample)
+FORMATS = {
+    'GRAY8': [('Y', 1, 1, 1)],
+    'RGB24': [('RGB', 1, 1, 3)],
+    'BGR24': [('BGR', 1, 1, 3)],
+    'RGBA32': [('RGBA', 1, 1, 4)],
+    'BGRA32': [('BGRA', 1, 1, 4)],
+    'YUYV': [('YUYV', 1, 1, 2)],
+    'YUV420': [('Y', 1, 1, 1), ('U', 2, 2, 1), ('V', 2, 2, 1)],
+    'YVU420': [('Y', 1, 1, 1), ('V', 2, 2, 1), ('U', 2, 2, 1)],
+    'YUV422': [('Y', 1, 1, 1), ('U', 2, 1, 1), ('V', 2, 1, 1)],
+    'NV12': [('Y', 1, 1, 1), ('UV', 2, 2, 2)],
+    'NV21': [('Y', 1, 1, 1), ('VU', 2, 2, 2)],
+}
+
+
+class Plane:
+
+    '''
+    A plane of a VCSMImage, of which rows are row_bytes bytes of width samples
+    and start stride bytes after each other from offset in the block.
+    state is the ownership state of the plane, one of VCSMBuffer.CPU_DIRTY,
+    CPU_CLEAN and DEVICE.
+    '''
+
+    __slots__ = ('name', 'offset', 'width', 'height', 'components',
+                 'row_bytes', 'stride', 'size', 'bus_ptr', 'usr_ptr', 'state')
+
+    def __init__(self, *, name, offset, width, height, components, stride,
+                 bus_ptr, usr_ptr, state=VCSMBuffer.CPU_DIRTY):
+        self.name = name
+        self.offset = offset
+        self.width = width
+        self.height = height
+        self.components = components
+        self.row_bytes = width * components
+        self.stride = stride
+        self.size = stride * height
+        self.bus_ptr = bus_ptr
+        self.usr_ptr = usr_ptr
+        self.state = state
+
+    def __repr__(self):
+        return f'<Plane {self.name} {self.width}x{self.height}' \
+               f' stride={self.stride} offset={self.offset}>'
+
+
+def layout(format, width, height, *, stride_alignment=64, plane_alignment=64):
+    '''Return a list of (name, offset, width, height, components, stride) of
+    the planes of format and the total size in bytes.'''
+    assert stride_alignment >= 1 \
+        and stride_alignment & (stride_alignment - 1) == 0
+    assert plane_alignment >= 1 \
+        and plane_alignment & (plane_alignment - 1) == 0
+    assert width >= 1 and height >= 1
+
+    planes = []
+    offset = 0
+    for name, hsub, vsub, components in FORMATS[format]:
+        offset = align(offset, plane_alignment)
+        w = -(-width // hsub)
+        h = -(-height // vsub)
+        stride = align(w * components, stride_alignment)
+        planes.append((name, offset, w, h, components, stride))
+        offset += stride * h
+    return planes, offset
+
+
+class VCSMImage:
+
+    def __init__(self, vcsm, *, format, width, height, cached, name,
+                 stride_alignment=64, plane_alignment=64):
+        self.vcsm = vcsm
+        self.format = format
+        self.width = width
+        self.height = height
+
+        layouts, self.size = layout(format, width, height,
+                                    stride_alignment=stride_alignment,
+                                    plane_alignment=plane_alignment)
+
+        self.buffer = vcsm.malloc(size=self.size, cached=cached, name=name)
+        self.handle = self.buffer.handle
+        self.bus_ptr = self.buffer.bus_ptr
+        self.usr_ptr = self.buffer.usr_ptr
+        self.usr_buf = self.buffer.usr_buf
+        self.__view = memoryview(self.usr_buf)
+
+        self.planes = [
+            Plane(name=name, offset=offset, width=w, height=h,
+                  components=components, stride=stride,
+                  bus_ptr=self.bus_ptr + offset, usr_ptr=self.usr_ptr + offset,
+                  state=self.buffer.state)
+            for name, offset, w, h, components, stride in layouts
+        ]
+
+    def close(self):
+        self.__view.release()
+        self.buffer.free()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return exc_value is None
+
+    def get_plane(self, plane):
+        '''Return the Plane of an index or a name.'''
+        if isinstance(plane, Plane):
+            return plane
+        if isinstance(plane, str):
+            for p in self.planes:
+                if p.name == plane:
+                    return p
+            raise KeyError(f'No plane {plane} in {self.format}')
+        return self.planes[plane]
+
+    def as_ndarray(self, plane):
+        '''
+        Return a NumPy view of a plane, of which shape is (height, width) or
+        (height, width, components) if the plane has interleaved components.
+        The view must be deleted before the image is closed.
+        '''
+        import numpy
+        p = self.get_plane(plane)
+        if p.components == 1:
+            shape, strides = (p.height, p.width), (p.stride, 1)
+        else:
+            shape = (p.height, p.width, p.components)
+            strides = (p.stride, p.components, 1)
+        return numpy.ndarray(shape, dtype=numpy.uint8, buffer=self.__view,
+                             offset=p.offset, strides=strides)
+
+    def clean_invalidate(self, *, op, plane=None, write=True):
+        '''
+        Perform a cache operation on the rows of a plane, or on the whole block
+        if plane is None, unless the states of the planes operated tell that it
+        is not needed.
+        Returns True if only the rows of the plane are operated.
+        '''
+        whole = plane is None or self.vcsm.get_driver() != 'vcsm'
+        planes = self.planes if whole else [self.get_plane(plane)]
+        needed = False
+        for p in planes:
+            n, p.state = VCSMBuffer.step(p.state, op=op, write=write)
+            needed = needed or n
+        if not needed or self.buffer.cached == CACHE_NONE:
+            return not whole
+
+        if whole:
+            self.vcsm.clean_invalidate(op=op, handle=self.handle,
+                                       usr_ptr=self.usr_ptr, size=self.size)
+        else:
+            p = planes[0]
+            self.vcsm.clean_invalidate_2d(
+                op=op, rows=p.height, row_bytes=p.row_bytes, stride=p.stride,
+                offset=p.offset, handle=self.handle, usr_ptr=self.usr_ptr,
+                size=self.size)
+        return not whole
+
+    def invalidate(self, *, plane=None, write=True):
+        return self.clean_invalidate(op=CACHE_OP_INVALIDATE, plane=plane,
+                                     write=write)
+
+    def clean(self, *, plane=None):
+        return self.clean_invalidate(op=CACHE_OP_CLEAN, plane=plane)
+
+    def begin_cpu_access(self, *, plane=None, write=True):
+        return self.invalidate(plane=plane, write=write)
+
+    def end_cpu_access(self, *, plane=None):
+        return self.clean(plane=plane)
@@ -0,0 +1,162 @@
+'''
+Translation between user and bus addresses of live allocations.
+
+AddressIndex keeps the allocations sorted by user address and by bus address,
+so that an address inside any of them is translated with a binary search.
+The vectorized variants translate a whole NumPy array of addresses at once
+with numpy.searchsorted.
+
+VCSM keeps an AddressIndex of its allocations up to date on malloc and free,
+which is available as VCSM.index.
+'''
+
+
+from bisect import bisect_left, bisect_right
+import threading
+
+
+class _Intervals:
+
+    # Intervals [start, start + size) sorted by start, each of which is mapped
+    # to base in the other address space, or to None if it is not mapped, and
+    # to a handle.
+
+    def __init__(self):
+        self.starts = []
+        self.entries = []
+        self.__arrays = None
+
+    def add(self, start, size, base, handle):
+        i = bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.entries.insert(i, (size, base, handle))
+        self.__arrays = None
+
+    def remove(self, start):
+        i = bisect_left(self.starts, start)
+        assert self.starts[i] == start
+        del self.starts[i]
+        del self.entries[i]
+        self.__arrays = None
+
+    def find(self, addr):
+        i = bisect_right(self.starts, addr) - 1
+        if i >= 0:
+            size, base, handle = self.entries[i]
+            offset = addr - self.starts[i]
+            if offset < size:
+                return None if base is None else base + offset, handle
+        raise KeyError(f'0x{addr:x} is not in any allocation')
+
+    def translate_array(self, addrs):
+        import numpy
+        if self.__arrays is None:
+            self.__arrays = (
+                numpy.array(self.starts, dtype=numpy.uint64),
+                numpy.array([size for size, base, handle in self.entries],
+                            dtype=numpy.uint64),
+                numpy.array([0 if base is None else base
+                             for size, base, handle in self.entries],
+                            dtype=numpy.uint64),
+                numpy.array([base is not None
+                             for size, base, handle in self.entries],
+                            dtype=bool),
+            )
+        starts, sizes, bases, mapped = self.__arrays
+
+        addrs = numpy.asarray(addrs, dtype=numpy.uint64)
+        if not len(starts):
+            if addrs.size:
+                addr = int(addrs.flat[0])
+                raise KeyError(f'0x{addr:x} is not in any mapped allocation')
+            return addrs.copy()
+
+        i = numpy.searchsorted(starts, addrs, side='right').astype(numpy.intp)
+        i -= 1
+        found = i >= 0
+        # Any index is valid for the addresses which are not found.
+        i = numpy.where(found, i, 0)
+        offsets = addrs - starts[i]
+        found &= (offsets < sizes[i]) & mapped[i]
+        if not found.all():
+            addr = int(addrs[~found].flat[0])
+            raise KeyError(f'0x{addr:x} is not in any mapped allocation')
+        return bases[i] + offsets
+
+
+class AddressIndex:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__usr = _Intervals()
+        self.__bus = _Intervals()
+        # handle -> (usr_ptr, bus_ptr, size)
+        self.__handles = {}
+
+    def __len__(self):
+        return len(self.__handles)
+
+    def __contains__(self, handle):
+        with self.__lock:
+            return handle in self.__handles
+
+    def add(self, *, handle, bus_ptr, usr_ptr, size):
+        '''Add an allocation, of which usr_ptr is None if it is not mapped.'''
+        with self.__lock:
+            assert handle not in self.__handles
+            self.__handles[handle] = (usr_ptr, bus_ptr, size)
+            self.__bus.add(bus_ptr, size, usr_ptr, handle)
+            if usr_ptr is not None:
+                self.__usr.add(usr_ptr, size, bus_ptr, handle)
+
+    def set_usr_ptr(self, *, handle, usr_ptr):
+        '''Record that an unmapped allocation is mapped at usr_ptr.'''
+        with self.__lock:
+            old, bus_ptr, size = self.__handles[handle]
+            assert old is None
+            self.__handles[handle] = (usr_ptr, bus_ptr, size)
+            self.__bus.remove(bus_ptr)
+            self.__bus.add(bus_ptr, size, usr_ptr, handle)
+            self.__usr.add(usr_ptr, size, bus_ptr, handle)
+
+    def remove(self, *, handle):
+        with self.__lock:
+            usr_ptr, bus_ptr, size = self.__handles.pop(handle)
+            self.__bus.remove(bus_ptr)
+            if usr_ptr is not None:
+                self.__usr.remove(usr_ptr)
+
+    def to_bus(self, usr_addr):
+        '''Return the bus address of a user address inside an allocation.'''
+        with self.__lock:
+            return self.__usr.find(usr_addr)[0]
+
+    def to_usr(self, bus_addr):
+        '''Return the user address of a bus address inside a mapped
+        allocation.'''
+        with self.__lock:
+            usr_addr, handle = self.__bus.find(bus_addr)
+        if usr_addr is None:
+            raise KeyError(f'0x{bus_addr:x} is not mapped to the CPU')
+        return usr_addr
+
+    def owner(self, *, usr_addr=None, bus_addr=None):
+        '''Return the handle of the allocation which contains either a user
+        or a bus address.'''
+        assert (usr_addr is None) != (bus_addr is None)
+        with self.__lock:
+            if usr_addr is not None:
+                return self.__usr.find(usr_addr)[1]
+            return self.__bus.find(bus_addr)[1]
+
+    def to_bus_array(self, usr_addrs):
+        '''The vectorized to_bus, which returns a numpy.uint64 array of the
+        shape of usr_addrs.'''
+        with self.__lock:
+            return self.__usr.translate_array(usr_addrs)
+
+    def to_usr_array(self, bus_addrs):
+        '''The vectorized to_usr, which returns a numpy.uint64 array of the
+        shape of bus_addrs.'''
+        with self.__lock:
+            return self.__bus.translate_array(bus_addrs)
@@ -0,0 +1,168 @@
+'''
+A size-class buffer pool on top of VCSM.
+
+Allocating and freeing a buffer through the drivers costs several ioctls, an
+mmap and a munmap each time.
+VCSMPool keeps freed buffers in size classes keyed by the cache mode and hands
+them out again on the next request of the same class, so that a pipeline which
+repeatedly allocates same-sized buffers only goes to the kernel once.
+
+Size classes are page multiples split into four classes per power of two, so
+the over-allocation is at most 25% of the requested size.
+The amount of memory kept idle in the pool can be capped in total and per
+class; the least recently freed buffers are returned to the driver first.
+The pool registers itself to the VCSM with add_cache, so that all the idle
+buffers are returned under memory pressure and by VCSM.trim_caches.
+'''
+
+
+from collections import OrderedDict
+import resource
+
+from .VCSM import VCSMBuffer
+
+
+class VCSMPool:
+
+    def __init__(self, vcsm, *, max_bytes=None, max_class_bytes=None):
+        assert max_bytes is None or max_bytes >= 0
+        assert max_class_bytes is None or max_class_bytes >= 0
+
+        self.vcsm = vcsm
+        self.max_bytes = max_bytes
+        self.max_class_bytes = max_class_bytes
+
+        # (cached, size) -> OrderedDict of idle buffers, most recent last.
+        self.__classes = {}
+        # All idle buffers in the order they were freed, least recent first.
+        self.__lru = OrderedDict()
+        # handle -> ((cached, size), 4-tuple) of the buffers handed out.
+        self.__live = {}
+        self.__idle_bytes = 0
+        self.__class_bytes = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        vcsm.add_cache(self)
+
+    def close(self):
+        self.vcsm.remove_cache(self)
+        self.trim(max_bytes=0)
+        assert not self.__live, 'Some buffers are not freed yet'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return exc_value is None
+
+    @staticmethod
+    def size_class(size):
+        assert isinstance(size, int) and size >= 1
+        pagesize = resource.getpagesize()
+        granule = max(pagesize, 1 << max((size - 1).bit_length() - 3, 0))
+        return (size + (granule - 1)) & ~(granule - 1)
+
+    def get_driver(self):
+        return self.vcsm.get_driver()
+
+    def get_idle_bytes(self):
+        return self.__idle_bytes
+
+    def malloc_cache(self, *, size, cached, name):
+        key = (cached, self.size_class(size))
+
+        idle = self.__classes.get(key)
+        if idle:
+            handle, mem = idle.popitem()
+            del self.__lru[handle]
+            self.__idle_bytes -= key[1]
+            self.__class_bytes[key] -= key[1]
+            self.hits += 1
+            mem[3].seek(0)
+        else:
+            mem = self.vcsm.malloc_cache(size=key[1], cached=cached, name=name)
+            handle = mem[0]
+            self.misses += 1
+
+        self.__live[handle] = (key, mem)
+        return mem
+
+    def malloc(self, *, size, cached, name):
+        handle, bus_ptr, usr_ptr, usr_buf = \
+            self.malloc_cache(size=size, cached=cached, name=name)
+        return VCSMBuffer(owner=self, handle=handle, bus_ptr=bus_ptr,
+                          usr_ptr=usr_ptr, usr_buf=usr_buf, size=size,
+                          cached=cached)
+
+    def free(self, *, handle, usr_buf):
+        key, mem = self.__live.pop(handle)
+        assert mem[3] is usr_buf
+        size = key[1]
+
+        if (self.max_class_bytes is not None and size > self.max_class_bytes) \
+                or (self.max_bytes is not None and size > self.max_bytes):
+            self.vcsm.free(handle=handle, usr_buf=usr_buf)
+            return
+
+        self.__classes.setdefault(key, OrderedDict())[handle] = mem
+        self.__lru[handle] = key
+        self.__idle_bytes += size
+        self.__class_bytes[key] = self.__class_bytes.get(key, 0) + size
+
+        if self.max_class_bytes is not None:
+            while self.__class_bytes[key] > self.max_class_bytes:
+                self.__evict(key, next(iter(self.__classes[key])))
+        if self.max_bytes is not None:
+            self.trim(max_bytes=self.max_bytes)
+
+    def trim(self, *, max_bytes=0):
+        '''Return the least recently freed buffers to the driver until at most
+        max_bytes are kept idle, and return the number of bytes returned.'''
+        n = 0
+        while self.__idle_bytes > max_bytes:
+            handle, key = next(iter(self.__lru.items()))
+            self.__evict(key, handle)
+            n += key[1]
+        return n
+
+    def clean_invalidate(self, *, op, handle=None, usr_ptr=None, size=None):
+        self.vcsm.clean_invalidate(op=op, handle=handle, usr_ptr=usr_ptr,
+                                   size=size)
+
+    def clean_invalidate_buffer(self, buf, *, op, write=True):
+        return self.vcsm.clean_invalidate_buffer(buf, op=op, write=write)
+
+    def begin_cpu_access(self, buf, *, write=True):
+        return self.vcsm.begin_cpu_access(buf, write=write)
+
+    def end_cpu_access(self, buf):
+        return self.vcsm.end_cpu_access(buf)
+
+    def observe_access(self, buf, *, read_bytes=0, write_bytes=0):
+        self.vcsm.observe_access(buf, read_bytes=read_bytes,
+                                 write_bytes=write_bytes)
+
+    def clean_invalidate_range(self, **kwargs):
+        return self.vcsm.clean_invalidate_range(**kwargs)
+
+    def clean_invalidate_2d(self, **kwargs):
+        return self.vcsm.clean_invalidate_2d(**kwargs)
+
+    def clean_invalidate_many(self, ops):
+        self.vcsm.clean_invalidate_many(ops)
+
+    def invalidate(self, *, handle=None, usr_ptr=None, size=None):
+        self.vcsm.invalidate(handle=handle, usr_ptr=usr_ptr, size=size)
+
+    def clean(self, *, handle=None, usr_ptr=None, size=None):
+        self.vcsm.clean(handle=handle, usr_ptr=usr_ptr, size=size)
+
+    def __evict(self, key, handle):
+        mem = self.__classes[key].pop(handle)
+        del self.__lru[handle]
+        self.__idle_bytes -= key[1]
+        self.__class_bytes[key] -= key[1]
+        self.vcsm.free(handle=mem[0], usr_buf=mem[3])
@@ -0,0 +1,114 @@
+'''
+A producer/consumer ring of equally-sized VCSM buffers.
+
+The producer takes a free slot with acquire_for_write and hands it over with
+publish, and the consumer takes published slots in order with acquire_for_read
+and gives them back with release.
+The cache operation required at each hand-off is performed by the ring
+according to the direction of the data:
+- 'to_device': the CPU produces and the device consumes.
+  The slot is cleaned on publish.
+  It is taken back for CPU write access on acquire_for_write without an
+  invalidate, as the device only reads it and the CPU caches cannot be stale.
+- 'from_device': the device produces and the CPU consumes.
+  The slot is invalidated on acquire_for_read and handed back to the device on
+  release.
+
+When no slot is free, acquire_for_write either waits for the consumer
+('backpressure') or reclaims the oldest published slot which has not been read
+yet ('drop_oldest'), which suits real-time sources.
+Acquiring methods block by default, and raise queue.Full or queue.Empty when
+they do not get a slot without blocking or within the timeout.
+'''
+
+
+from collections import deque
+import queue
+import threading
+
+from . import *
+
+
+class VCSMRing:
+
+    def __init__(self, vcsm, *, slots, size, cached, name,
+                 direction='to_device', policy='backpressure'):
+        assert slots >= 1
+        assert direction in ['to_device', 'from_device']
+        assert policy in ['backpressure', 'drop_oldest']
+
+        self.direction = direction
+        self.policy = policy
+        self.buffers = []
+        try:
+            for i in range(slots):
+                self.buffers.append(vcsm.malloc(size=size, cached=cached,
+                                                name=name))
+        except BaseException:
+            for buf in self.buffers:
+                buf.free()
+            raise
+
+        if direction == 'from_device':
+            for buf in self.buffers:
+                buf.end_cpu_access()
+
+        self.__index = {id(buf): i for i, buf in enumerate(self.buffers)}
+        self.__free = deque(range(slots))
+        self.__ready = deque()
+        self.__cond = threading.Condition()
+        self.dropped = 0
+
+    def close(self):
+        for buf in self.buffers:
+            buf.free()
+        self.buffers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return exc_value is None
+
+    def __wait(self, ready, block, timeout, exc):
+        # Must be called with the condition held.
+        if not block:
+            if not ready():
+                raise exc
+        elif not self.__cond.wait_for(ready, timeout):
+            raise exc
+
+    def acquire_for_write(self, *, block=True, timeout=None):
+        with self.__cond:
+            if not self.__free and self.policy == 'drop_oldest' \
+                    and self.__ready:
+                self.__free.append(self.__ready.popleft())
+                self.dropped += 1
+            self.__wait(lambda: self.__free, block, timeout, queue.Full)
+            buf = self.buffers[self.__free.popleft()]
+        if self.direction == 'to_device':
+            buf.transition(op=CACHE_OP_INVALIDATE, write=True)
+        return buf
+
+    def publish(self, buf):
+        if self.direction == 'to_device':
+            buf.end_cpu_access()
+        with self.__cond:
+            self.__ready.append(self.__index[id(buf)])
+            self.__cond.notify_all()
+
+    def acquire_for_read(self, *, block=True, timeout=None):
+        with self.__cond:
+            self.__wait(lambda: self.__ready, block, timeout, queue.Empty)
+            buf = self.buffers[self.__ready.popleft()]
+        if self.direction == 'from_device':
+            buf.begin_cpu_access(write=False)
+        return buf
+
+    def release(self, buf):
+        if self.direction == 'from_device':
+            buf.end_cpu_access()
+        with self.__cond:
+            self.__free.append(self.__index[id(buf)])
+            self.__cond.notify_all()
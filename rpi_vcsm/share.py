@@ -0,0 +1,186 @@
+'''
+Zero-copy sharing of VCSM buffers between processes.
+
+On VCSM-CMA (and the emulated driver) the handle of a buffer is a file
+descriptor, which can be passed to another process over a Unix domain socket
+with SCM_RIGHTS.
+export_buffer sends the descriptor along with the size, the bus address, the
+offset of the buffer in the allocation of the descriptor (which is not zero for
+the buffers of a VCSMBufferGroup) and a user tag, and VCSMImporter.receive maps
+it in the receiving process, so that both processes access the same memory.
+
+The kernel keeps the memory alive while any process holds a descriptor or a
+mapping of it, so each process frees its buffers independently.
+Within a process, VCSMImporter counts references to each imported buffer, and
+importing the same buffer again shares the existing mapping.
+
+The plain VCSM driver identifies buffers by process-local handles, which cannot
+be shared.
+'''
+
+
+from ctypes import addressof, c_byte
+import mmap
+import os
+import socket
+import struct
+
+from . import *
+from .VCSM import VCSMBuffer, dma_buf
+
+
+# driver, cached, size, bus_ptr, offset, tag length
+HEADER = struct.Struct('<16sIQQQI')
+MAX_TAG_SIZE = 4096
+
+SHAREABLE_DRIVERS = ['vcsm-cma', 'emulated']
+
+
+def _recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data), socket.MSG_WAITALL)
+        if not chunk:
+            raise EOFError('The socket is closed while receiving a buffer')
+        data += chunk
+    return data
+
+
+def export_buffer(sock, buf, *, tag=b''):
+    '''
+    Send a VCSMBuffer to the process at the other end of the stream Unix domain
+    socket sock with a bytes tag.
+    The buffer stays valid in this process and must be freed as usual.
+    '''
+    driver = buf.owner.get_driver()
+    if driver not in SHAREABLE_DRIVERS:
+        raise ValueError(f'Buffers of the {driver} driver cannot be shared')
+    assert len(tag) <= MAX_TAG_SIZE
+
+    header = HEADER.pack(bytes(driver, 'ascii'), buf.cached, buf.size,
+                         buf.bus_ptr, buf.offset, len(tag))
+    socket.send_fds(sock, [header + tag], [buf.handle])
+
+
+class VCSMImporter:
+
+    def __init__(self):
+        # (st_dev, st_ino, offset) -> [refs, handle, bus_ptr, usr_ptr, usr_buf,
+        # mapping]
+        self.__imported = {}
+        # handle -> (st_dev, st_ino, offset)
+        self.__keys = {}
+        # handle -> driver
+        self.__drivers = {}
+
+    def close(self):
+        for refs, handle, bus_ptr, usr_ptr, usr_buf, mapping \
+                in list(self.__imported.values()):
+            self.__release(handle, usr_buf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return exc_value is None
+
+    def receive(self, sock):
+        '''Receive a buffer sent by export_buffer and return a (VCSMBuffer, tag)
+        tuple.'''
+        msg, fds, flags, addr = socket.recv_fds(sock, HEADER.size, 1,
+                                                socket.MSG_WAITALL)
+        if len(msg) < HEADER.size:
+            for fd in fds:
+                os.close(fd)
+            raise EOFError('The socket is closed while receiving a buffer')
+        assert len(fds) == 1
+        fd = fds[0]
+
+        try:
+            driver, cached, size, bus_ptr, offset, tag_size = \
+                HEADER.unpack(msg)
+            driver = driver.rstrip(b'\0').decode('ascii')
+            tag = _recv_exactly(sock, tag_size)
+            handle, usr_ptr, usr_buf = self.__import(fd, driver, size, bus_ptr,
+                                                     offset)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        buf = VCSMBuffer(owner=self, handle=handle, bus_ptr=bus_ptr,
+                         usr_ptr=usr_ptr, usr_buf=usr_buf, size=size,
+                         cached=cached, offset=offset)
+        return buf, tag
+
+    def __import(self, fd, driver, size, bus_ptr, offset):
+        st = os.fstat(fd)
+        key = (st.st_dev, st.st_ino, offset)
+
+        entry = self.__imported.get(key)
+        if entry is not None:
+            os.close(fd)
+            entry[0] += 1
+            return entry[1], entry[3], entry[4]
+
+        # The mapping starts at the page which contains offset.
+        start = offset & ~(mmap.ALLOCATIONGRANULARITY - 1)
+        mapping = mmap.mmap(fileno=fd, length=offset - start + size,
+                            flags=mmap.MAP_SHARED,
+                            prot=mmap.PROT_READ | mmap.PROT_WRITE,
+                            offset=start)
+        if offset == start:
+            usr_buf = mapping
+        else:
+            usr_buf = memoryview(mapping)[offset - start:offset - start + size]
+        if driver == 'vcsm-cma':
+            dma_buf.ioctl_sync(fd=fd,
+                               flags=dma_buf.SYNC_START | dma_buf.SYNC_RW)
+        usr_ptr = addressof(c_byte.from_buffer(mapping)) + offset - start
+
+        self.__imported[key] = [1, fd, bus_ptr, usr_ptr, usr_buf, mapping]
+        self.__keys[fd] = key
+        self.__drivers[fd] = driver
+        return fd, usr_ptr, usr_buf
+
+    def get_refs(self, *, handle):
+        return self.__imported[self.__keys[handle]][0]
+
+    def get_driver(self):
+        return 'imported'
+
+    def free(self, *, handle, usr_buf):
+        entry = self.__imported[self.__keys[handle]]
+        entry[0] -= 1
+        if entry[0] == 0:
+            self.__release(handle, usr_buf)
+
+    def __release(self, handle, usr_buf):
+        key = self.__keys.pop(handle)
+        mapping = self.__imported.pop(key)[5]
+        if self.__drivers.pop(handle) == 'vcsm-cma':
+            dma_buf.ioctl_sync(fd=handle,
+                               flags=dma_buf.SYNC_END | dma_buf.SYNC_RW)
+        if usr_buf is not mapping:
+            usr_buf.release()
+        mapping.close()
+        os.close(handle)
+
+    def clean_invalidate(self, *, op, handle=None, usr_ptr=None, size=None):
+        if op == CACHE_OP_NOP or self.__drivers[handle] != 'vcsm-cma':
+            return
+        elif op == CACHE_OP_INVALIDATE:
+            flags = dma_buf.SYNC_START | dma_buf.SYNC_RW
+        else:
+            flags = dma_buf.SYNC_END | dma_buf.SYNC_RW
+        dma_buf.ioctl_sync(fd=handle, flags=flags)
+
+    def clean_invalidate_buffer(self, buf, *, op, write=True):
+        if not buf.transition(op=op, write=write):
+            return False
+        self.clean_invalidate(op=op, handle=buf.handle)
+        return True
+
+    def observe_access(self, buf, *, read_bytes=0, write_bytes=0):
+        # Imported buffers have no names to observe.
+        pass
@@ -0,0 +1,179 @@
+'''
+Instrumentation of allocations and cache operations.
+
+VCSMStats records the count and a latency histogram of each operation, and the
+live and peak bytes held for each driver and for each allocation name.
+Latencies are put into fixed log2 buckets of nanoseconds which are allocated
+up front, and the bytes held by each name at the overall peak are tracked
+incrementally, so recording an event does not allocate memory besides the
+record of the live buffer, and collecting can be left enabled in production.
+Updates are locked, so the numbers stay exact when several threads record at
+once.
+
+Pass an instance to VCSM(stats=...) to collect, and call snapshot to read the
+numbers or export to pass them to the registered exporters.
+'''
+
+
+import threading
+from time import perf_counter_ns
+
+
+OPS = ('alloc', 'free', 'clean_invalidate', 'ioctl', 'mmap', 'sync')
+BUCKETS = 40
+
+
+class VCSMStats:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # op -> [count, total_ns, max_ns, histogram...]
+        self.__ops = {op: [0] * (3 + BUCKETS) for op in OPS}
+        # (driver, handle) -> (name, size)
+        self.__live = {}
+        # driver -> [live, peak]
+        self.__drivers = {}
+        # name -> [live, peak, epoch, bytes at the overall peak]
+        # The bytes at the overall peak are valid if epoch is the current
+        # peak epoch, and are the live bytes otherwise, as the name has not
+        # changed since the peak.
+        self.__names = {}
+        self.__total = 0
+        self.__peak_total = 0
+        self.__peak_epoch = 0
+        self.__exporters = []
+
+    def record(self, op, ns):
+        s = self.__ops[op]
+        with self.__lock:
+            s[0] += 1
+            s[1] += ns
+            if ns > s[2]:
+                s[2] = ns
+            s[3 + min(ns.bit_length(), BUCKETS - 1)] += 1
+
+    def timed(self, op, func):
+        '''Return a wrapper of func which records its latency as op.'''
+        record = self.record
+
+        def wrapper(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(op, perf_counter_ns() - start)
+
+        return wrapper
+
+    def __add(self, driver, name, size):
+        # Must be called with the lock held.
+        d = self.__drivers.get(driver)
+        if d is None:
+            d = self.__drivers[driver] = [0, 0]
+        d[0] += size
+        if d[0] > d[1]:
+            d[1] = d[0]
+
+        n = self.__names.get(name)
+        if n is None:
+            n = self.__names[name] = [0, 0, self.__peak_epoch, 0]
+        elif n[2] != self.__peak_epoch:
+            # The first change since the peak: save the bytes at the peak.
+            n[2] = self.__peak_epoch
+            n[3] = n[0]
+        n[0] += size
+        if n[0] > n[1]:
+            n[1] = n[0]
+
+        self.__total += size
+        if self.__total > self.__peak_total:
+            self.__peak_total = self.__total
+            # All the names are at the peak now.
+            self.__peak_epoch += 1
+
+    def record_alloc(self, *, driver, handle, name, size):
+        with self.__lock:
+            self.__live[(driver, handle)] = (name, size)
+            self.__add(driver, name, size)
+
+    def record_free(self, *, driver, handle):
+        with self.__lock:
+            name, size = self.__live.pop((driver, handle))
+            self.__add(driver, name, -size)
+
+    def __bytes_at_peak(self, n):
+        return n[3] if n[2] == self.__peak_epoch else n[0]
+
+    def snapshot(self):
+        with self.__lock:
+            return self.__snapshot()
+
+    def __snapshot(self):
+        ops = {}
+        for op, s in self.__ops.items():
+            histogram = s[3:]
+            ops[op] = {
+                'count': s[0],
+                'total_ns': s[1],
+                'max_ns': s[2],
+                'histogram': histogram,
+                'p50_ns': self.__percentile(histogram, s[0], 0.50),
+                'p90_ns': self.__percentile(histogram, s[0], 0.90),
+                'p99_ns': self.__percentile(histogram, s[0], 0.99),
+            }
+        return {
+            'ops': ops,
+            'bytes': {
+                'driver': {
+                    driver: {'live': live, 'peak': peak}
+                    for driver, (live, peak) in self.__drivers.items()
+                },
+                'name': {
+                    name: {'live': n[0], 'peak': n[1]}
+                    for name, n in self.__names.items()
+                },
+            },
+            'live_bytes': self.__total,
+            'peak_bytes': self.__peak_total,
+            'peak_bytes_by_name': {
+                name: self.__bytes_at_peak(n)
+                for name, n in self.__names.items()
+                if self.__bytes_at_peak(n)
+            },
+        }
+
+    @staticmethod
+    def __percentile(histogram, count, q):
+        # The upper bound of the bucket which contains the q-th quantile.
+        if count == 0:
+            return 0
+        rank = q * count
+        n = 0
+        for i, c in enumerate(histogram):
+            n += c
+            if n >= rank:
+                return (1 << i) - 1
+        return (1 << (len(histogram) - 1)) - 1
+
+    def reset(self):
+        '''Clear the operation counters and bring the peaks down to the current
+        live bytes.'''
+        with self.__lock:
+            for s in self.__ops.values():
+                s[:] = [0] * len(s)
+            for d in self.__drivers.values():
+                d[1] = d[0]
+            for n in self.__names.values():
+                n[1] = n[0]
+            self.__peak_total = self.__total
+            self.__peak_epoch += 1
+
+    def add_exporter(self, exporter):
+        '''Register a callable which is passed a snapshot on export.'''
+        self.__exporters.append(exporter)
+
+    def export(self):
+        snapshot = self.snapshot()
+        for exporter in self.__exporters:
+            exporter(snapshot)
+        return snapshot
@@ -0,0 +1,144 @@
+'''
+Bulk copies into and out of VCSM buffers.
+
+copy_in and copy_out accept any object which supports the buffer protocol and
+copy it directly from or to the mapped memory without intermediate bytes.
+ctypes.memmove releases the GIL, so large copies are split into cache-line
+aligned chunks, which are copied in parallel on a thread pool to use the memory
+bandwidth of all the cores.
+Copies smaller than the threshold are done directly on the calling thread.
+'''
+
+
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import byref, memmove, pythonapi, py_object, PYFUNCTYPE, POINTER, \
+    Structure, c_char_p, c_int, c_ssize_t, c_void_p
+import os
+import threading
+
+
+CACHE_LINE = 64
+THRESHOLD = 2 ** 20
+
+_PyBUF_SIMPLE = 0
+_PyBUF_WRITABLE = 1
+
+
+class Py_buffer(Structure):
+    _fields_ = [
+        ('buf', c_void_p),
+        ('obj', c_void_p),
+        ('len', c_ssize_t),
+        ('itemsize', c_ssize_t),
+        ('readonly', c_int),
+        ('ndim', c_int),
+        ('format', c_char_p),
+        ('shape', POINTER(c_ssize_t)),
+        ('strides', POINTER(c_ssize_t)),
+        ('suboffsets', POINTER(c_ssize_t)),
+        ('internal', c_void_p),
+    ]
+
+
+PyObject_GetBuffer = PYFUNCTYPE(c_int, py_object, POINTER(Py_buffer), c_int)(
+    ('PyObject_GetBuffer', pythonapi))
+PyBuffer_Release = PYFUNCTYPE(None, POINTER(Py_buffer))(
+    ('PyBuffer_Release', pythonapi))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=os.cpu_count(),
+                    thread_name_prefix='rpi_vcsm.transfer')
+    return _executor
+
+
+def _memory(buffer):
+    # Returns (usr_ptr, size) of a VCSMBuffer or a malloc_cache tuple.
+    if isinstance(buffer, tuple):
+        handle, bus_ptr, usr_ptr, usr_buf = buffer
+        return usr_ptr, len(usr_buf)
+    return buffer.usr_ptr, buffer.size
+
+
+def _copy(dst, src, n, threads, threshold):
+    if threads is None:
+        threads = os.cpu_count()
+    if n < threshold or threads <= 1:
+        memmove(dst, src, n)
+        return
+
+    # Split at cache line boundaries of the destination so that no line is
+    # written by two threads.
+    chunk = -(-n // threads)
+    bounds = [0]
+    for i in range(1, threads):
+        b = ((dst + i * chunk + (CACHE_LINE - 1)) & ~(CACHE_LINE - 1)) - dst
+        if bounds[-1] < b < n:
+            bounds.append(b)
+    bounds.append(n)
+
+    executor = get_executor()
+    futures = [executor.submit(memmove, dst + start, src + start, end - start)
+               for start, end in zip(bounds[:-1], bounds[1:])]
+    for future in futures:
+        future.result()
+
+
+def _transfer(buffer, obj, offset, writable, threads, threshold):
+    usr_ptr, size = _memory(buffer)
+    view = Py_buffer()
+    PyObject_GetBuffer(obj, byref(view),
+                       _PyBUF_WRITABLE if writable else _PyBUF_SIMPLE)
+    try:
+        n = view.len
+        # Checked explicitly since memmove writes out of the mapping otherwise.
+        if offset < 0 or offset + n > size:
+            raise ValueError(f'{n} bytes at offset {offset} are out of the'
+                             f' buffer of {size} bytes')
+        if writable:
+            _copy(view.buf, usr_ptr + offset, n, threads, threshold)
+        else:
+            _copy(usr_ptr + offset, view.buf, n, threads, threshold)
+    finally:
+        PyBuffer_Release(byref(view))
+    return n
+
+
+def copy_in(buffer, src, *, offset=0, threads=None, threshold=THRESHOLD):
+    '''
+    Copy the whole of src into buffer from offset, where buffer is a
+    VCSMBuffer or a tuple returned by VCSM.malloc_cache.
+    A VCSMBuffer is taken for CPU write access before the copy, and the copy
+    is reported to the observer of its VCSM.
+    Returns the number of bytes copied.
+    '''
+    if isinstance(buffer, tuple):
+        return _transfer(buffer, src, offset, False, threads, threshold)
+    buffer.begin_cpu_access(write=True)
+    n = _transfer(buffer, src, offset, False, threads, threshold)
+    buffer.owner.observe_access(buffer, write_bytes=n)
+    return n
+
+
+def copy_out(buffer, dst, *, offset=0, threads=None, threshold=THRESHOLD):
+    '''
+    Fill the whole of dst with the contents of buffer from offset, where buffer
+    is a VCSMBuffer or a tuple returned by VCSM.malloc_cache.
+    A VCSMBuffer is taken for CPU read access before the copy, and the copy
+    is reported to the observer of its VCSM.
+    Returns the number of bytes copied.
+    '''
+    if isinstance(buffer, tuple):
+        return _transfer(buffer, dst, offset, True, threads, threshold)
+    buffer.begin_cpu_access(write=False)
+    n = _transfer(buffer, dst, offset, True, threads, threshold)
+    buffer.owner.observe_access(buffer, read_bytes=n)
+    return n
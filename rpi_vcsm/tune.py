@@ -0,0 +1,246 @@
+'''
+Selection of the cache mode of buffers from their access patterns.
+
+The cost of accessing a buffer from the CPU and of synchronizing it with the
+device differs by large factors between CACHE_NONE, CACHE_HOST, CACHE_VC and
+CACHE_BOTH, and depends on the board and the driver.
+calibrate measures, for each mode, the CPU read and write costs per byte and
+the latencies of clean and invalidate with the benchmarks of rpi_vcsm.bench,
+and load_calibration caches the result on disk for each board, kernel and
+driver.
+
+CacheTuner estimates the cost of an access profile, which is the number of
+bytes the CPU reads and writes and the number of hand-offs between the CPU and
+the device (a clean and an invalidate each) per iteration, for each mode and
+recommends the cheapest one.
+Hand-offs through the tuple API always issue the cache operations, while those
+of VCSMBuffers are elided by their ownership state with CACHE_NONE, so they
+are counted apart.
+Profiles are declared for allocation names, or observed by reporting the
+accesses of a few iterations, and malloc and malloc_cache apply the
+recommendation when cached is not given.
+The tuner also observes the VCSM for the names which are not reported: each
+cache operation on a buffer counts as half a hand-off and half an iteration,
+and the copies of rpi_vcsm.transfer count as CPU accesses.
+The cost of the device-side cache (CACHE_VC) cannot be measured from the CPU,
+so it is not taken into account.
+'''
+
+
+import json
+import os
+import platform
+import threading
+
+from . import *
+from .bench import CACHED, bench_cache_op, bench_throughput, percentile
+
+
+def calibrate(vcsm, *, size=2 ** 20, repeat=5):
+    '''
+    Return a dict of mode name -> {'read': ns per byte, 'write': ns per byte,
+    'clean': ns, 'invalidate': ns} measured on vcsm with buffers of size
+    bytes.
+    '''
+    calibration = {}
+    for name, cached in CACHED.items():
+        throughput = bench_throughput(vcsm, cached=cached, size=size,
+                                      repeat=repeat)
+        cache_op = bench_cache_op(vcsm, cached=cached, size=size,
+                                  repeat=repeat)
+        calibration[name] = {
+            # MB/s is bytes/us.
+            'read': 1e3 / percentile(sorted(throughput['read']), 50),
+            'write': 1e3 / percentile(sorted(throughput['write']), 50),
+            'clean': percentile(sorted(cache_op['clean']), 50),
+            'invalidate': percentile(sorted(cache_op['invalidate']), 50),
+        }
+    return calibration
+
+
+def get_board():
+    try:
+        with open('/proc/device-tree/model') as f:
+            return f.read().rstrip('\0\n')
+    except OSError:
+        return platform.machine()
+
+
+def get_default_path():
+    cache = os.environ.get('XDG_CACHE_HOME',
+                           os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache, 'rpi_vcsm', 'calibration.json')
+
+
+def load_calibration(vcsm, *, path=None, recalibrate=False, **kwargs):
+    '''
+    Return the calibration of the board, the kernel and the driver of vcsm
+    cached in the JSON file at path, which defaults to
+    $XDG_CACHE_HOME/rpi_vcsm/calibration.json.
+    If it is not cached or recalibrate is True, calibrate with the keyword
+    arguments and cache the result.
+    '''
+    if path is None:
+        path = get_default_path()
+    key = f'{get_board()}:{platform.release()}:{vcsm.get_driver()}'
+
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if not recalibrate and key in cache:
+        return cache[key]
+
+    cache[key] = calibrate(vcsm, **kwargs)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, path)
+    return cache[key]
+
+
+class AccessProfile:
+
+    '''
+    Accesses to a buffer per iteration: read_bytes and write_bytes by the CPU,
+    and syncs and tracked_syncs hand-offs between the CPU and the device
+    through the tuple API and through VCSMBuffer respectively.
+    '''
+
+    __slots__ = ('read_bytes', 'write_bytes', 'syncs', 'tracked_syncs')
+
+    def __init__(self, *, read_bytes=0, write_bytes=0, syncs=0,
+                 tracked_syncs=0):
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+        self.syncs = syncs
+        self.tracked_syncs = tracked_syncs
+
+    def __repr__(self):
+        return f'<AccessProfile read_bytes={self.read_bytes}' \
+               f' write_bytes={self.write_bytes} syncs={self.syncs}' \
+               f' tracked_syncs={self.tracked_syncs}>'
+
+
+class CacheTuner:
+
+    '''
+    If calibration is None, it is loaded with load_calibration from path.
+    A profile of a name is observed from min_iterations iterations, and
+    allocations of names of which profiles are unknown use default.
+    If observe is True, the tuner is set as the observer of vcsm.
+    '''
+
+    def __init__(self, vcsm, *, calibration=None, path=None,
+                 min_iterations=3, default=CACHE_HOST, observe=True):
+        if calibration is None:
+            calibration = load_calibration(vcsm, path=path)
+        self.vcsm = vcsm
+        self.calibration = calibration
+        self.min_iterations = min_iterations
+        self.default = default
+        self.__profiles = {}
+        self.__lock = threading.Lock()
+        # name -> [iterations, read_bytes, write_bytes, syncs, tracked_syncs]
+        self.__observed = {}
+        # The names reported by observe, of which the observations of the VCSM
+        # are ignored.
+        self.__manual = set()
+        if observe:
+            vcsm.observer = self
+
+    def estimate(self, profile):
+        '''Return a dict of CACHE_* -> estimated ns per iteration.'''
+        costs = {}
+        for name, cached in CACHED.items():
+            c = self.calibration[name]
+            sync = c['clean'] + c['invalidate']
+            cost = profile.read_bytes * c['read'] \
+                + profile.write_bytes * c['write'] + profile.syncs * sync
+            # VCSMBuffers with CACHE_NONE elide their cache operations.
+            if cached != CACHE_NONE:
+                cost += profile.tracked_syncs * sync
+            costs[cached] = cost
+        return costs
+
+    def recommend(self, profile):
+        '''Return the CACHE_* of which cost for profile is the lowest.'''
+        costs = self.estimate(profile)
+        return min(costs, key=costs.get)
+
+    def declare(self, name, profile):
+        self.__profiles[name] = profile
+
+    def __add(self, name, manual, iterations, read_bytes, write_bytes, syncs,
+              tracked_syncs):
+        with self.__lock:
+            if manual and name not in self.__manual:
+                self.__manual.add(name)
+                self.__observed.pop(name, None)
+            elif not manual and name in self.__manual:
+                return
+            o = self.__observed.setdefault(name, [0, 0, 0, 0, 0])
+            o[0] += iterations
+            o[1] += read_bytes
+            o[2] += write_bytes
+            o[3] += syncs
+            o[4] += tracked_syncs
+
+    def observe(self, name, *, read_bytes=0, write_bytes=0, syncs=0,
+                tracked_syncs=0):
+        '''
+        Report the accesses of an iteration to buffers of name.
+        From then on, the observations of the VCSM for name are discarded and
+        ignored, so that the iterations are counted from the reports only.
+        '''
+        self.__add(name, True, 1, read_bytes, write_bytes, syncs,
+                   tracked_syncs)
+
+    def observe_sync(self, name, *, op, tracked):
+        '''Called by the VCSM with a cache operation on a buffer of name.'''
+        # A flush is a whole hand-off.
+        n = 1 if op == CACHE_OP_FLUSH else 0.5
+        if tracked:
+            self.__add(name, False, n, 0, 0, 0, n)
+        else:
+            self.__add(name, False, n, 0, 0, n, 0)
+
+    def observe_access(self, name, *, read_bytes=0, write_bytes=0):
+        '''Called by the VCSM with CPU accesses to a buffer of name.'''
+        self.__add(name, False, 0, read_bytes, write_bytes, 0, 0)
+
+    def get_profile(self, name):
+        '''Return the declared or observed profile of name, or None if it is
+        not known yet.'''
+        profile = self.__profiles.get(name)
+        if profile is not None:
+            return profile
+        with self.__lock:
+            o = self.__observed.get(name)
+            if o is None or o[0] < self.min_iterations:
+                return None
+            iterations, read_bytes, write_bytes, syncs, tracked_syncs = o
+        return AccessProfile(read_bytes=read_bytes / iterations,
+                             write_bytes=write_bytes / iterations,
+                             syncs=syncs / iterations,
+                             tracked_syncs=tracked_syncs / iterations)
+
+    def get_cached(self, name):
+        '''Return the recommended CACHE_* for name, or the default.'''
+        profile = self.get_profile(name)
+        if profile is None:
+            return self.default
+        return self.recommend(profile)
+
+    def malloc_cache(self, *, size, name, cached=None, **kwargs):
+        if cached is None:
+            cached = self.get_cached(name)
+        return self.vcsm.malloc_cache(size=size, cached=cached, name=name,
+                                      **kwargs)
+
+    def malloc(self, *, size, name, cached=None, **kwargs):
+        if cached is None:
+            cached = self.get_cached(name)
+        return self.vcsm.malloc(size=size, cached=cached, name=name, **kwargs)
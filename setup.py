@@ -10,6 +10,9 @@ setup(
     install_requires=[
         'ioctl-opt ~= 1.2',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     description='A library for the VCSM (VideoCore Shared Memory service) and VCSM-CMA (contiguous memory allocator) kernel drivers',
     author='Yukimasa Sugizaki',
     author_email='ysugi@idein.jp',
@@ -0,0 +1,48 @@
+
+import asyncio
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.aio import AsyncVCSM
+
+
+class Test(unittest.TestCase):
+
+    def test_ops(self, *, size=4 * 2 ** 20):
+
+        async def main():
+            async with AsyncVCSM(force='emulated', max_workers=2) as avcsm:
+                async with await avcsm.malloc(size=size,
+                                              cached=rpi_vcsm.CACHE_HOST,
+                                              name='test') as buf:
+                    src = b'\x5a' * size
+                    self.assertEqual(await buf.copy_in(src), size)
+                    self.assertTrue(await buf.clean())
+                    self.assertTrue(await buf.invalidate())
+                    dst = bytearray(size)
+                    self.assertEqual(await buf.copy_out(dst), size)
+                    self.assertEqual(src, dst)
+                    self.assertEqual(buf.size, size)
+                return avcsm.vcsm.raw.ioctl_counts
+
+        self.assertEqual(asyncio.run(main()), {'alloc': 1, 'sync': 4})
+
+    def test_cancel(self):
+
+        async def main():
+            vcsm = rpi_vcsm.VCSM.VCSM(force='emulated',
+                                      emulated_latency={'alloc': 0.1})
+            async with AsyncVCSM(vcsm) as avcsm:
+                task = asyncio.create_task(
+                    avcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                                 name='test'))
+                await asyncio.sleep(0.01)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            ioctl_counts = vcsm.raw.ioctl_counts
+            vcsm.close()
+            return ioctl_counts
+
+        # The buffer is allocated and then freed in the background.
+        self.assertEqual(asyncio.run(main()), {'alloc': 1, 'sync': 2})
@@ -5,6 +5,7 @@ import sys
 import unittest
 
 import rpi_vcsm.VCSM
+from rpi_vcsm.transfer import copy_in, copy_out
 
 
 class Test(unittest.TestCase):
@@ -47,7 +48,7 @@ class Test(unittest.TestCase):
 
         print()
 
-        for force in ['vcsm', 'vcsm-cma']:
+        for force in ['vcsm', 'vcsm-cma', 'emulated']:
             try:
                 vcsm = rpi_vcsm.VCSM.VCSM(force=force)
             except FileNotFoundError:
@@ -78,12 +79,27 @@ class Test(unittest.TestCase):
 
                     self.assertEqual(src, dst)
 
+                    mem = (handle, bus_ptr, usr_ptr, usr_buf)
+                    dst = bytearray(size)
+
+                    start = monotonic()
+                    copy_in(mem, src, threshold=0)
+                    t_copy_in = monotonic() - start
+
+                    start = monotonic()
+                    copy_out(mem, dst, threshold=0)
+                    t_copy_out = monotonic() - start
+
+                    self.assertEqual(src, dst)
+
                     vcsm.free(handle=handle, usr_buf=usr_buf)
 
                     print('driver = %-8s,' % force,
                           'cached = %-4s:' % cached_to_str[cached],
                           'read =', size / t_read * 1e-6, 'MB/s,',
-                          'write =', size / t_write * 1e-6, 'MB/s')
+                          'write =', size / t_write * 1e-6, 'MB/s,',
+                          'copy_out =', size / t_copy_out * 1e-6, 'MB/s,',
+                          'copy_in =', size / t_copy_in * 1e-6, 'MB/s')
 
             vcsm.close()
 
@@ -116,3 +132,29 @@ class Test(unittest.TestCase):
                 random.seed(i)
                 self.assertEqual(usr_buf.read(), randbytes(size))
                 vcsm.free(handle=handle, usr_buf=usr_buf)
+
+    def test_clean_invalidate_range(self):
+
+        with rpi_vcsm.VCSM.VCSM() as vcsm:
+            width, height, stride = 1920, 1080, 2048
+            size = stride * height
+
+            handle, bus_ptr, usr_ptr, usr_buf = \
+                vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                  name='test')
+
+            partial = vcsm.get_driver() == 'vcsm'
+            self.assertEqual(
+                vcsm.clean_invalidate_range(op=rpi_vcsm.CACHE_OP_CLEAN,
+                                            offset=stride * 100,
+                                            length=stride * 10,
+                                            handle=handle, usr_ptr=usr_ptr,
+                                            size=size), partial)
+            self.assertEqual(
+                vcsm.clean_invalidate_2d(op=rpi_vcsm.CACHE_OP_INVALIDATE,
+                                         rows=64, row_bytes=256, stride=stride,
+                                         offset=stride * 100 + 512,
+                                         handle=handle, usr_ptr=usr_ptr,
+                                         size=size), partial)
+
+            vcsm.free(handle=handle, usr_buf=usr_buf)
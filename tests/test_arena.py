@@ -0,0 +1,68 @@
+
+import random
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.arena import FreeList, VCSMArena
+
+
+class Test(unittest.TestCase):
+
+    def test_free_list(self):
+
+        free_list = FreeList(1024)
+
+        a = free_list.alloc(100)
+        b = free_list.alloc(100, 64)
+        c = free_list.alloc(100, 256)
+        self.assertEqual((a, b, c), (0, 128, 256))
+        self.assertEqual(free_list.ranges(),
+                         [(100, 28), (228, 28), (356, 668)])
+        self.assertIsNone(free_list.alloc(1000))
+
+        free_list.free(b, 100)
+        free_list.free(a, 100)
+        self.assertEqual(free_list.ranges(), [(0, 256), (356, 668)])
+        free_list.free(c, 100)
+        self.assertEqual(free_list.ranges(), [(0, 1024)])
+        self.assertEqual(free_list.free_bytes, 1024)
+
+    def test_random(self, *, maxsize=65536, n=100):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMArena(vcsm, size=n * maxsize, cached=rpi_vcsm.CACHE_HOST,
+                          name='test', alignment=256) as arena:
+
+            mem_list = []
+            random.seed(42)
+
+            for i in range(n):
+                size = random.randint(1, maxsize)
+                offset, bus_ptr, usr_ptr, usr_view = arena.alloc(size=size)
+                self.assertEqual(offset % 256, 0)
+                self.assertEqual(bus_ptr, arena.bus_ptr + offset)
+                self.assertEqual(usr_ptr, arena.usr_ptr + offset)
+                usr_view[:] = bytes([i]) * len(usr_view)
+                mem_list.append((i, offset, usr_view))
+
+            random.shuffle(mem_list)
+
+            for i, offset, usr_view in mem_list:
+                self.assertEqual(bytes(usr_view), bytes([i]) * len(usr_view))
+                arena.free(offset=offset)
+
+            self.assertEqual(arena.get_free_bytes(), n * maxsize)
+
+    def test_clean_invalidate(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMArena(vcsm, size=65536, cached=rpi_vcsm.CACHE_HOST,
+                          name='test') as arena:
+
+            offset, bus_ptr, usr_ptr, usr_view = arena.alloc(size=1000)
+            sync = vcsm.raw.ioctl_counts['sync']
+            arena.clean(offset=offset)
+            arena.invalidate(offset=offset)
+            arena.clean()
+            self.assertEqual(vcsm.raw.ioctl_counts['sync'], sync + 3)
+            arena.free(offset=offset)
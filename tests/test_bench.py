@@ -0,0 +1,78 @@
+
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from rpi_vcsm import bench
+
+
+class Test(unittest.TestCase):
+
+    def test_percentile(self):
+
+        samples = list(range(1, 101))
+        self.assertEqual(bench.percentile(samples, 50), 50)
+        self.assertEqual(bench.percentile(samples, 99), 99)
+        self.assertEqual(bench.percentile([7], 90), 7)
+        self.assertEqual(bench.parse_size('64K'), 65536)
+
+    def test_baseline(self):
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'baseline.json')
+            argv = ['--driver', 'emulated', '--cached', 'host',
+                    '--sizes', '4K,64K', '--repeat', '3']
+            self.assertEqual(bench.main(argv + ['--output', path]), 0)
+            self.assertEqual(bench.main(argv + ['--output', os.devnull,
+                                                '--baseline', path,
+                                                '--threshold', '1000']), 0)
+            with open(path) as f:
+                results = json.load(f)['results']
+            benches = {r['bench'] for r in results}
+            self.assertEqual(benches, {'alloc', 'free', 'clean', 'invalidate',
+                                       'read', 'write', 'copy', 'churn_alloc',
+                                       'churn_free'})
+            for r in results:
+                self.assertLessEqual(r['min'], r['p50'])
+                self.assertLessEqual(r['p50'], r['p99'])
+                self.assertLessEqual(r['p99'], r['max'])
+
+            slower = [dict(r) for r in results]
+            for r in slower:
+                r['p50'] = r['p50'] * 2 if r['unit'] == 'ns' \
+                    else r['p50'] / 2
+            self.assertEqual(bench.compare(results, results, threshold=0.1),
+                             [])
+            self.assertEqual(
+                len(bench.compare(slower, results, threshold=0.1)),
+                len(results))
+
+            f = io.StringIO()
+            bench.write(results, f, fmt='csv')
+            lines = f.getvalue().splitlines()
+            self.assertEqual(lines[0], ','.join(bench.FIELDS))
+            self.assertEqual(len(lines), len(results) + 1)
+
+    def test_startup(self):
+
+        argv = ['--driver', 'emulated', '--cached', 'none', '--sizes', '4K',
+                '--repeat', '2', '--startup', '--output', os.devnull]
+        self.assertEqual(bench.main(argv), 0)
+        results = bench.run(drivers=['emulated'], cached=[], repeat=2,
+                            startup=True, log=io.StringIO())
+        self.assertEqual([r['bench'] for r in results], ['import', 'open'])
+        for r in results:
+            self.assertGreater(r['min'], 0)
+
+    def test_calls(self):
+
+        results = bench.run(drivers=[], repeat=2, calls=True,
+                            log=io.StringIO())
+        self.assertEqual([r['bench'] for r in results],
+                         ['alloc_args', 'alloc_args_built', 'sync_args',
+                          'sync_args_built', 'sync_many'])
+        for r in results:
+            self.assertEqual(r['n'], 2)
+            self.assertGreater(r['min'], 0)
@@ -0,0 +1,191 @@
+
+import resource
+import sys
+import tempfile
+import unittest
+
+import rpi_vcsm.VCSM
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Test(unittest.TestCase):
+
+    def test_memoryview(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            with vcsm.malloc(size=1000, cached=rpi_vcsm.CACHE_HOST,
+                             name='test') as buf:
+                self.assertEqual(len(buf), 1000)
+
+                with buf.as_memoryview() as view:
+                    self.assertEqual(len(view), 1000)
+                    view[:] = b'\x5a' * 1000
+                buf.usr_buf.seek(0)
+                self.assertEqual(buf.usr_buf.read(1000), b'\x5a' * 1000)
+
+                with buf.view as view:
+                    self.assertEqual(bytes(view), b'\x5a' * 1000)
+                    self.assertEqual(bytes(memoryview(view)[:2]), b'\x5a' * 2)
+                if sys.version_info >= (3, 12):
+                    with memoryview(buf) as view:
+                        self.assertEqual(bytes(view), b'\x5a' * 1000)
+
+                buf.clean()
+                buf.invalidate()
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_ndarray(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            buf = vcsm.malloc(size=64 * 48 * 4, cached=rpi_vcsm.CACHE_HOST,
+                              name='test')
+
+            a = buf.as_ndarray((48, 64), dtype='uint32')
+            a[:] = numpy.arange(48 * 64).reshape(48, 64)
+            b = buf.as_ndarray((24, 64), dtype='uint32',
+                               strides=(64 * 4 * 2, 4), offset=64 * 4)
+            self.assertTrue((b == a[1::2]).all())
+            self.assertEqual(a.ctypes.data, buf.usr_ptr)
+
+            del a, b
+            buf.free()
+
+    def test_coherency(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            buf = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                              name='test')
+            sync = vcsm.raw.ioctl_counts['sync']
+
+            self.assertTrue(buf.clean())
+            self.assertFalse(buf.clean())
+            self.assertTrue(buf.invalidate())
+            self.assertFalse(buf.invalidate())
+            self.assertTrue(buf.end_cpu_access())
+            self.assertTrue(buf.begin_cpu_access(write=False))
+            self.assertFalse(buf.end_cpu_access())
+            self.assertEqual(buf.state, buf.DEVICE)
+
+            vcsm.clean_invalidate_many([(buf, rpi_vcsm.CACHE_OP_CLEAN),
+                                        (buf, rpi_vcsm.CACHE_OP_INVALIDATE)])
+            self.assertEqual(buf.state, buf.CPU_DIRTY)
+
+            self.assertEqual(vcsm.cache_op_counts,
+                             {'issued': 5, 'elided': 4})
+            self.assertEqual(vcsm.raw.ioctl_counts['sync'], sync + 5)
+            buf.free()
+
+            buf = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_NONE,
+                              name='test')
+            self.assertFalse(buf.clean())
+            self.assertFalse(buf.invalidate())
+            self.assertEqual(vcsm.raw.ioctl_counts['sync'], sync + 7)
+            buf.free()
+
+    def test_file(self, *, size=3 * 2 ** 20 + 123):
+
+        data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+
+        with tempfile.NamedTemporaryFile() as f, \
+                rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            f.write(data)
+            f.flush()
+
+            with vcsm.load_file(f.name, cached=rpi_vcsm.CACHE_HOST,
+                                name='test', chunk_size=2 ** 20) as buf:
+                self.assertEqual(buf.size, size)
+                self.assertEqual(buf.state, buf.DEVICE)
+                self.assertEqual(bytes(buf.as_memoryview()), data)
+
+                f.seek(0)
+                self.assertEqual(buf.readinto_from(f, offset=100,
+                                                   length=1000), 1000)
+                self.assertEqual(bytes(buf.as_memoryview()[100:1100]),
+                                 data[:1000])
+
+                f.truncate(0)
+                self.assertEqual(buf.write_to(f, file_offset=10, offset=5,
+                                              length=size - 5,
+                                              chunk_size=2 ** 20), size - 5)
+                f.seek(10)
+                self.assertEqual(f.read(1000), data[5:100] + data[:905])
+
+            f.truncate(0)
+            with self.assertRaises(ValueError):
+                vcsm.load_file(f.name, cached=rpi_vcsm.CACHE_HOST,
+                               name='test')
+
+    def test_mapping(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated', thread_cache=2) as vcsm:
+            counts = vcsm.raw.ioctl_counts
+
+            buf = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                              name='test', map='lazy')
+            self.assertEqual(counts, {'alloc': 1, 'sync': 0})
+            self.assertFalse(buf.is_mapped())
+            self.assertFalse(buf.clean())
+            self.assertFalse(buf.invalidate())
+
+            self.assertFalse(buf.begin_cpu_access())
+            self.assertTrue(buf.is_mapped())
+            self.assertEqual(counts, {'alloc': 1, 'sync': 1})
+            buf.as_memoryview()[0] = 1
+            self.assertTrue(buf.end_cpu_access())
+            buf.free()
+
+            # The mapped buffer is cached apart from unmapped ones.
+            buf = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                              name='test', map='never')
+            self.assertEqual(counts, {'alloc': 2, 'sync': 2})
+            with self.assertRaises(ValueError):
+                buf.as_memoryview()
+            buf.free()
+
+            buf = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                              name='test', map='lazy')
+            self.assertEqual(counts, {'alloc': 2, 'sync': 2})
+            self.assertFalse(buf.is_mapped())
+            buf.free()
+
+    def test_malloc_many(self, *, count=16, size=1000):
+
+        page = resource.getpagesize()
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            counts = vcsm.raw.ioctl_counts
+
+            group = vcsm.malloc_many(count=count, size=size,
+                                     cached=rpi_vcsm.CACHE_HOST, name='test',
+                                     alignment=256)
+            self.assertEqual(counts['alloc'], 1)
+            self.assertEqual(len(group), count)
+            for i, buf in enumerate(group):
+                self.assertEqual(len(buf), size)
+                self.assertEqual(buf.bus_ptr, group.bus_ptr + i * 1024)
+                self.assertEqual(buf.usr_ptr, group.usr_ptr + i * 1024)
+                buf.as_memoryview()[:] = bytes([i]) * size
+            group.usr_buf.seek(1024 * 3)
+            self.assertEqual(group.usr_buf.read(size), b'\x03' * size)
+
+            # The allocation is alive until all the buffers are freed.
+            for buf in group[:count - 1]:
+                buf.free()
+            self.assertEqual(group.get_live_count(), 1)
+            self.assertEqual(vcsm.get_used_bytes(),
+                             -(-1024 * count // page) * page)
+            self.assertEqual(group[-1].as_memoryview()[0], count - 1)
+            group[-1].free()
+            self.assertEqual(vcsm.get_used_bytes(), 0)
+
+            with vcsm.malloc_many(count=2, size=size,
+                                  cached=rpi_vcsm.CACHE_HOST,
+                                  name='test') as group:
+                group[0].free()
+                self.assertEqual(group[1].bus_ptr - group[0].bus_ptr, page)
+            self.assertEqual(group.get_live_count(), 0)
+            self.assertEqual(vcsm.get_used_bytes(), 0)
@@ -0,0 +1,79 @@
+
+import struct
+import unittest
+
+import rpi_vcsm.VCSM
+
+try:
+    import numpy
+    from rpi_vcsm import descriptor
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class Test(unittest.TestCase):
+
+    def test_build(self, *, n=4, bus_ptr=0xc0001000):
+
+        src = numpy.arange(n, dtype=numpy.uint32) * 0x100 + 0xc1000000
+        entries = descriptor.build({'ti': 0x330, 'source_ad': src,
+                                    'dest_ad': 0x7e203004, 'txfr_len': 64},
+                                   count=n, bus_ptr=bus_ptr)
+
+        expected = b''.join(
+            struct.pack('<8I', 0x330, 0xc1000000 + i * 0x100, 0x7e203004, 64,
+                        0, bus_ptr + (i + 1) * 32 if i < n - 1 else 0, 0, 0)
+            for i in range(n))
+        self.assertEqual(entries.tobytes(), expected)
+
+        entries = descriptor.build({}, count=n, bus_ptr=bus_ptr, chain='ring')
+        self.assertEqual(entries['nextconbk'][-1], bus_ptr)
+
+        # Entries are padded to the alignment.
+        dtype = numpy.dtype([('addr', '<u4'), ('next', '<u4')])
+        entries = descriptor.build({'addr': [1, 2]}, count=2, bus_ptr=0x1000,
+                                   dtype=dtype, alignment=16,
+                                   next_field='next')
+        self.assertEqual(entries.tobytes(),
+                         struct.pack('<4I4I', 1, 0x1010, 0, 0, 2, 0, 0, 0))
+
+    def test_table(self, *, n=1000):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                descriptor.DescriptorTable(vcsm, count=n) as table:
+            sync = vcsm.raw.ioctl_counts['sync']
+            dest = numpy.arange(n, dtype=numpy.uint32) * 4096
+            self.assertEqual(table.write(ti=0x330, dest_ad=dest,
+                                         txfr_len=4096), table.bus_ptr)
+            self.assertEqual(vcsm.raw.ioctl_counts['sync'], sync + 1)
+
+            table.usr_buf.seek(0)
+            self.assertEqual(
+                table.usr_buf.read(table.size),
+                descriptor.build({'ti': 0x330, 'dest_ad': dest,
+                                  'txfr_len': 4096},
+                                 count=n, bus_ptr=table.bus_ptr).tobytes())
+            self.assertEqual(table.entries['nextconbk'][0],
+                             table.get_bus_ptr(1))
+
+    def test_close(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            table = descriptor.DescriptorTable(vcsm, count=4)
+            table.write(ti=0x330)
+            ti = table.entries['ti']
+            # The buffer is freed when the last view of the entries is gone.
+            table.close()
+            table.close()
+            self.assertEqual(vcsm.index.owner(bus_addr=table.bus_ptr),
+                             table.handle)
+            self.assertEqual(ti.tolist(), [0x330] * 4)
+            del ti
+            with self.assertRaises(KeyError):
+                vcsm.index.owner(bus_addr=table.bus_ptr)
+
+            with descriptor.DescriptorTable(vcsm, count=4) as table:
+                pass
+            with self.assertRaises(KeyError):
+                vcsm.index.owner(bus_addr=table.bus_ptr)
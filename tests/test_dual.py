@@ -0,0 +1,101 @@
+
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.dual import DualVCSM
+
+
+class Test(unittest.TestCase):
+
+    def test_placement(self, *, size=2 ** 16):
+
+        vcsm = rpi_vcsm.VCSM.VCSM(force='emulated')
+        vcsm_cma = rpi_vcsm.VCSM.VCSM(force='emulated', budget=4 * size)
+        pools = {'vcsm': vcsm, 'vcsm-cma': vcsm_cma}
+
+        with vcsm, vcsm_cma, \
+                DualVCSM(vcsm=vcsm, vcsm_cma=vcsm_cma, size_threshold=size,
+                         names={'isp-*': 'vcsm'}) as dual:
+
+            def place(size, name):
+                return dual.place(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                  name=name)
+
+            self.assertEqual(place(size - 1, 'tensor'), 'vcsm-cma')
+            self.assertEqual(place(size, 'tensor'), 'vcsm')
+            self.assertEqual(place(1, 'isp-out'), 'vcsm')
+
+            small = [dual.malloc(size=size // 2, cached=rpi_vcsm.CACHE_HOST,
+                                 name='tensor') for i in range(8)]
+            self.assertEqual([buf.owner for buf in small],
+                             [vcsm_cma] * 8)
+
+            # The CMA budget is exhausted and the allocation spills.
+            buf = dual.malloc(size=size // 2, cached=rpi_vcsm.CACHE_HOST,
+                              name='tensor')
+            self.assertIs(buf.owner, vcsm)
+            self.assertEqual(dual.get_usage(), {
+                'vcsm': {'used': size // 2, 'headroom': None},
+                'vcsm-cma': {'used': 4 * size, 'headroom': 0},
+            })
+
+            # Tuples are routed by their handles or user addresses.
+            mem = dual.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                    name='tensor')
+            handle, bus_ptr, usr_ptr, usr_buf = mem
+            self.assertIs(dual.get_pool(usr_ptr=usr_ptr), vcsm)
+            dual.clean(handle=handle, usr_ptr=usr_ptr, size=size)
+            dual.clean_invalidate_many([(mem, rpi_vcsm.CACHE_OP_CLEAN),
+                                        (buf, rpi_vcsm.CACHE_OP_CLEAN),
+                                        (small[0], rpi_vcsm.CACHE_OP_CLEAN)])
+            dual.free(handle=handle, usr_buf=usr_buf)
+
+            for b in small + [buf]:
+                b.free()
+            for driver, pool in pools.items():
+                self.assertEqual(pool.get_used_bytes(), 0)
+
+            with self.assertRaises(ValueError):
+                dual.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                  name='tensor', map='never')
+            for driver, pool in pools.items():
+                self.assertEqual(pool.get_used_bytes(), 0)
+
+            dual = DualVCSM(vcsm=vcsm, vcsm_cma=vcsm_cma, spill=False)
+            with self.assertRaises(OSError):
+                dual.malloc(size=5 * size, cached=rpi_vcsm.CACHE_HOST,
+                            name='tensor')
+
+    def test_routing(self, *, size=4096):
+
+        vcsm = rpi_vcsm.VCSM.VCSM(force='emulated')
+        vcsm_cma = rpi_vcsm.VCSM.VCSM(force='emulated')
+
+        with vcsm, vcsm_cma, \
+                DualVCSM(vcsm=vcsm, vcsm_cma=vcsm_cma,
+                         names={'isp-*': 'vcsm'}) as dual:
+            mems = {
+                vcsm: dual.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                        name='isp-out'),
+                vcsm_cma: dual.malloc_cache(size=size,
+                                            cached=rpi_vcsm.CACHE_HOST,
+                                            name='tensor'),
+            }
+            for pool, (handle, bus_ptr, usr_ptr, usr_buf) in mems.items():
+                self.assertIs(dual.get_pool(handle=handle), pool)
+                self.assertIs(dual.get_pool(usr_ptr=usr_ptr + size - 1), pool)
+
+                # The operation is issued on the owner only, without usr_ptr.
+                syncs = [p.raw.ioctl_counts['sync'] for p in mems]
+                dual.clean(handle=handle)
+                self.assertEqual(
+                    [p.raw.ioctl_counts['sync'] - s
+                     for p, s in zip(mems, syncs)],
+                    [int(p is pool) for p in mems])
+
+            with self.assertRaises(KeyError):
+                dual.get_pool(handle=-1)
+            for pool, (handle, bus_ptr, usr_ptr, usr_buf) in mems.items():
+                dual.free(handle=handle, usr_buf=usr_buf)
+                with self.assertRaises(KeyError):
+                    dual.get_pool(handle=handle)
@@ -0,0 +1,137 @@
+
+from time import monotonic
+import unittest
+
+import rpi_vcsm.VCSM
+
+
+class Test(unittest.TestCase):
+
+    def test_alloc(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+
+            self.assertEqual(vcsm.get_driver(), 'emulated')
+
+            mem_list = [vcsm.malloc_cache(size=size,
+                                          cached=rpi_vcsm.CACHE_HOST,
+                                          name='test')
+                        for size in [1, 4096, 100000]]
+            self.assertEqual([mem[1] for mem in mem_list],
+                             [0xc0000000, 0xc0001000, 0xc0002000])
+            self.assertEqual(vcsm.raw.ioctl_counts, {'alloc': 3, 'sync': 3})
+
+            handle, bus_ptr, usr_ptr, usr_buf = mem_list[2]
+            usr_buf.write(b'\x5a' * 100000)
+            vcsm.clean(handle=handle)
+            vcsm.invalidate(handle=handle)
+            usr_buf.seek(0)
+            self.assertEqual(usr_buf.read(), b'\x5a' * 100000)
+            self.assertEqual(vcsm.raw.ioctl_counts['sync'], 5)
+
+            for handle, bus_ptr, usr_ptr, usr_buf in mem_list:
+                vcsm.free(handle=handle, usr_buf=usr_buf)
+            self.assertEqual(vcsm.raw.ioctl_counts, {'alloc': 3, 'sync': 8})
+
+            # Freed bus addresses are reused.
+            handle, bus_ptr, usr_ptr, usr_buf = \
+                vcsm.malloc_cache(size=8192, cached=rpi_vcsm.CACHE_NONE,
+                                  name='test')
+            self.assertEqual(bus_ptr, 0xc0000000)
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+
+    def test_alloc_error(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            # The bus range is released if the memfd cannot be created.
+            with self.assertRaises(ValueError):
+                vcsm.malloc_cache(size=4096, cached=rpi_vcsm.CACHE_NONE,
+                                  name='te\0st')
+            handle, bus_ptr, usr_ptr, usr_buf = \
+                vcsm.malloc_cache(size=4096, cached=rpi_vcsm.CACHE_NONE,
+                                  name='test')
+            self.assertEqual(bus_ptr, 0xc0000000)
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+
+    def test_latency(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated',
+                                emulated_latency={'alloc': 0.01}) as vcsm:
+            start = monotonic()
+            handle, bus_ptr, usr_ptr, usr_buf = \
+                vcsm.malloc_cache(size=4096, cached=rpi_vcsm.CACHE_NONE,
+                                  name='test')
+            self.assertGreaterEqual(monotonic() - start, 0.01)
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+
+    def test_clean_invalidate_many(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+
+            mem_list = [vcsm.malloc_cache(size=65536,
+                                          cached=rpi_vcsm.CACHE_HOST,
+                                          name='test') for i in range(8)]
+            counts = dict(vcsm.raw.ioctl_counts)
+
+            # Unmapped buffers are skipped.
+            unmapped = vcsm.malloc_cache(size=65536,
+                                         cached=rpi_vcsm.CACHE_HOST,
+                                         name='test', map='never')
+            vcsm.clean_invalidate_many(
+                [(mem, rpi_vcsm.CACHE_OP_CLEAN) for mem in mem_list] +
+                [(mem_list[0], rpi_vcsm.CACHE_OP_NOP),
+                 (unmapped, rpi_vcsm.CACHE_OP_CLEAN)])
+            self.assertEqual(vcsm.raw.ioctl_counts['sync'],
+                             counts['sync'] + 8)
+
+            for handle, bus_ptr, usr_ptr, usr_buf in mem_list + [unmapped]:
+                vcsm.free(handle=handle, usr_buf=usr_buf)
+
+    def test_clean_invalidate_range(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            handle, bus_ptr, usr_ptr, usr_buf = \
+                vcsm.malloc_cache(size=65536, cached=rpi_vcsm.CACHE_HOST,
+                                  name='test')
+
+            # Emulating VCSM-CMA, the whole buffer is synced instead.
+            self.assertFalse(
+                vcsm.clean_invalidate_range(op=rpi_vcsm.CACHE_OP_CLEAN,
+                                            offset=4096, length=4096,
+                                            handle=handle))
+            self.assertFalse(
+                vcsm.clean_invalidate_2d(op=rpi_vcsm.CACHE_OP_CLEAN, rows=16,
+                                         row_bytes=64, stride=1024,
+                                         handle=handle, size=65536))
+            self.assertEqual(vcsm.raw.ioctl_counts['sync'], 3)
+
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+
+    def test_deferred_free(self, *, n=8, latency=0.02, size=2 ** 16):
+
+        vcsm = rpi_vcsm.VCSM.VCSM(force='emulated', deferred_free=True,
+                                  emulated_latency={'sync': latency},
+                                  budget=n * size)
+        raw = vcsm.raw
+
+        mems = [vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                  name='test') for i in range(n)]
+        syncs = raw.ioctl_counts['sync']
+        start = monotonic()
+        for handle, bus_ptr, usr_ptr, usr_buf in mems[:n // 2]:
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+        self.assertLess(monotonic() - start, latency * n / 2)
+
+        # Queued buffers are returned first under memory pressure.
+        mem = vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                name='test')
+        self.assertGreater(raw.ioctl_counts['sync'], syncs + 1)
+        self.assertLessEqual(vcsm.get_used_bytes(), n * size)
+
+        for handle, bus_ptr, usr_ptr, usr_buf in mems[n // 2:] + [mem]:
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+        self.assertGreater(vcsm.get_deferred_bytes(), 0)
+        vcsm.close()
+        self.assertEqual(vcsm.get_deferred_bytes(), 0)
+        self.assertEqual(vcsm.get_used_bytes(), 0)
+        self.assertEqual(raw.ioctl_counts['sync'], syncs + n + 2)
@@ -0,0 +1,96 @@
+
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.VCSM import VCSMBuffer
+from rpi_vcsm.image import VCSMImage, layout
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Test(unittest.TestCase):
+
+    def test_layout(self):
+
+        planes, size = layout('YUV420', 1920, 1080, stride_alignment=64,
+                              plane_alignment=4096)
+        self.assertEqual(planes, [
+            ('Y', 0, 1920, 1080, 1, 1920),
+            ('U', 2076672, 960, 540, 1, 960),
+            ('V', 2596864, 960, 540, 1, 960),
+        ])
+        self.assertEqual(size, 2596864 + 960 * 540)
+
+        planes, size = layout('NV12', 33, 17, stride_alignment=32)
+        self.assertEqual(planes, [
+            ('Y', 0, 33, 17, 1, 64),
+            ('UV', 1088, 17, 9, 2, 64),
+        ])
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_image(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMImage(vcsm, format='NV12', width=640, height=480,
+                          cached=rpi_vcsm.CACHE_HOST, name='test') as image:
+            y = image.as_ndarray('Y')
+            uv = image.as_ndarray(1)
+            self.assertEqual(y.shape, (480, 640))
+            self.assertEqual(uv.shape, (240, 320, 2))
+
+            y[:] = 16
+            uv[..., 0] = 128
+            uv[..., 1] = 255
+            plane = image.get_plane('UV')
+            self.assertEqual(plane.bus_ptr, image.bus_ptr + 640 * 480)
+            image.usr_buf.seek(plane.offset)
+            self.assertEqual(image.usr_buf.read(4), b'\x80\xff\x80\xff')
+
+            # The dma-buf sync operates on the whole buffer, and redundant
+            # operations are elided by the states of the planes.
+            sync = vcsm.raw.ioctl_counts['sync']
+            self.assertFalse(image.clean(plane='Y'))
+            self.assertEqual([p.state for p in image.planes],
+                             [VCSMBuffer.DEVICE] * 2)
+            self.assertFalse(image.clean())
+            self.assertFalse(image.invalidate(write=False))
+            self.assertFalse(image.invalidate(plane='UV'))
+            self.assertEqual(vcsm.raw.ioctl_counts['sync'], sync + 2)
+            self.assertEqual([p.state for p in image.planes],
+                             [VCSMBuffer.CPU_DIRTY] * 2)
+            del y, uv
+
+    def test_planes(self):
+
+        # The plain VCSM driver operates on the rows of a plane, which is
+        # recorded here on the emulated driver.
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMImage(vcsm, format='NV12', width=64, height=32,
+                          cached=rpi_vcsm.CACHE_HOST, name='test') as image:
+            ops = []
+            vcsm.get_driver = lambda: 'vcsm'
+            vcsm.clean_invalidate = \
+                lambda *, op, **kwargs: ops.append((op, None))
+            vcsm.clean_invalidate_2d = \
+                lambda *, op, offset, **kwargs: ops.append((op, offset))
+            uv = image.get_plane('UV').offset
+
+            self.assertFalse(image.clean())
+            # A plane written by the CPU is cleaned even though the other
+            # plane is still owned by the device.
+            self.assertTrue(image.invalidate(plane='Y'))
+            self.assertTrue(image.clean(plane='Y'))
+            self.assertTrue(image.invalidate(plane='UV', write=False))
+            self.assertTrue(image.clean(plane='UV'))
+            self.assertFalse(image.clean())
+            self.assertFalse(image.invalidate())
+            self.assertEqual(ops, [
+                (rpi_vcsm.CACHE_OP_CLEAN, None),
+                (rpi_vcsm.CACHE_OP_INVALIDATE, 0),
+                (rpi_vcsm.CACHE_OP_CLEAN, 0),
+                (rpi_vcsm.CACHE_OP_INVALIDATE, uv),
+                (rpi_vcsm.CACHE_OP_INVALIDATE, None),
+            ])
@@ -0,0 +1,67 @@
+
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.index import AddressIndex
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Test(unittest.TestCase):
+
+    def test_index(self):
+
+        index = AddressIndex()
+        index.add(handle=1, bus_ptr=0xc0001000, usr_ptr=0x7f0000, size=0x1000)
+        index.add(handle=2, bus_ptr=0xc0000000, usr_ptr=0x100000, size=0x1000)
+        index.add(handle=3, bus_ptr=0xc0010000, usr_ptr=None, size=0x2000)
+
+        self.assertEqual(index.to_bus(0x7f0010), 0xc0001010)
+        self.assertEqual(index.to_bus(0x100fff), 0xc0000fff)
+        self.assertEqual(index.to_usr(0xc0000010), 0x100010)
+        self.assertEqual(index.owner(usr_addr=0x7f0fff), 1)
+        self.assertEqual(index.owner(bus_addr=0xc0011000), 3)
+        for addr in [0xfffff, 0x101000, 0x7f1000]:
+            with self.assertRaises(KeyError):
+                index.to_bus(addr)
+        with self.assertRaises(KeyError):
+            index.to_usr(0xc0010000)
+
+        index.set_usr_ptr(handle=3, usr_ptr=0x200000)
+        self.assertEqual(index.to_usr(0xc0010008), 0x200008)
+        index.remove(handle=1)
+        with self.assertRaises(KeyError):
+            index.to_bus(0x7f0010)
+        self.assertEqual(len(index), 2)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_array(self, *, n=64):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            mems = [vcsm.malloc_cache(size=4096 * (i + 1),
+                                      cached=rpi_vcsm.CACHE_HOST, name='test')
+                    for i in range(n)]
+
+            usr = numpy.array([mem[2] + i for i, mem in enumerate(mems)],
+                              dtype=numpy.uint64)
+            bus = vcsm.index.to_bus_array(usr.reshape(8, 8))
+            self.assertEqual(bus.shape, (8, 8))
+            for i, (handle, bus_ptr, usr_ptr, usr_buf) in enumerate(mems):
+                self.assertEqual(bus.flat[i], bus_ptr + i)
+                self.assertEqual(vcsm.to_bus(usr_ptr + i), bus_ptr + i)
+                self.assertEqual(vcsm.to_usr(bus_ptr + i), usr_ptr + i)
+                self.assertEqual(vcsm.owner(usr_addr=usr_ptr), handle)
+            numpy.testing.assert_array_equal(vcsm.index.to_usr_array(bus),
+                                             usr.reshape(8, 8))
+
+            handle, bus_ptr, usr_ptr, usr_buf = mems.pop()
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+            with self.assertRaises(KeyError):
+                vcsm.index.to_bus_array(numpy.array([usr_ptr]))
+
+            for handle, bus_ptr, usr_ptr, usr_buf in mems:
+                vcsm.free(handle=handle, usr_buf=usr_buf)
+            self.assertEqual(len(vcsm.index), 0)
@@ -0,0 +1,121 @@
+
+import os
+import tempfile
+import unittest
+
+from ioctl_opt import IOR, IOW
+
+from rpi_vcsm import CACHE_OP_CLEAN, CACHE_OP_NOP
+from rpi_vcsm.VCSM import VCSM, dma_buf, raw_vcsm, raw_vcsm_cma, probe_driver
+
+
+class Test(unittest.TestCase):
+
+    def test_ioctl(self):
+
+        # The precomputed numbers must be those which ioctl_opt computes from
+        # the structures.
+        for cls, ior in [
+                (raw_vcsm, [
+                    ('ALLOC', 'ALLOC', 'alloc'),
+                    ('LOCK', 'LOCK', 'lock_unlock'),
+                    ('UNLOCK', 'UNLOCK', 'lock_unlock'),
+                    ('FREE', 'FREE', 'free'),
+                    ('MAP_VC_ADDR_FR_HDL', 'MAPPED_VC_ADDR_FROM_HDL', 'map'),
+                    ('CLEAN_INVALID2', 'CLEAN_INVALID2', 'clean_invalid2'),
+                ]),
+                (raw_vcsm_cma, [
+                    ('ALLOC', 'ALLOC', 'alloc'),
+                    ('CLEAN_INVALID2', 'CLEAN_INVALID2', 'clean_invalid2'),
+                ])]:
+            prefix = f'_{cls.__name__}__'
+            magic = getattr(cls, prefix + 'MAGIC')
+            for ioctl, cmd, st in ior:
+                with self.subTest(cls=cls.__name__, ioctl=ioctl):
+                    self.assertEqual(
+                        getattr(cls, prefix + 'IOCTL_' + ioctl),
+                        IOR(magic, getattr(cls, prefix + 'CMD_' + cmd),
+                            getattr(cls, prefix + 'st_' + st)))
+
+        self.assertEqual(
+            dma_buf._dma_buf__IOCTL_SYNC,
+            IOW(dma_buf._dma_buf__MAGIC, dma_buf._dma_buf__CMD_SYNC,
+                dma_buf._dma_buf__st_sync))
+
+    def test_clean_invalid_many(self, *, n=600):
+
+        with tempfile.TemporaryFile() as f:
+            raw = raw_vcsm(path=f'/proc/self/fd/{f.fileno()}')
+            requests = []
+
+            def ioctl(fd, request, s):
+                requests.append((s.op_count, [
+                    (b.invalidate_mode, b.block_count, b.start_address,
+                     b.block_size) for b in s.s]))
+
+            raw._ioctl = ioctl
+            ops = [(CACHE_OP_CLEAN, 0x10000 + i * 4096, 4096)
+                   for i in range(n)]
+            raw.clean_invalid_many(ops=ops + [(CACHE_OP_NOP, 0, 4096)])
+            raw.close()
+
+        # op_count is a byte, so the blocks are split into ioctls of up to 255.
+        self.assertEqual([op_count for op_count, blocks in requests],
+                         [255, 255, 90])
+        self.assertEqual(
+            [b for op_count, blocks in requests for b in blocks],
+            [(op, 1, usr_ptr, size) for op, usr_ptr, size in ops])
+
+    def test_clean_invalid_rows(self, *, rows=2 ** 17 + 5, stride=128):
+
+        with tempfile.TemporaryFile() as f:
+            raw = raw_vcsm(path=f'/proc/self/fd/{f.fileno()}')
+            requests = []
+
+            def ioctl(fd, request, s):
+                requests.append([
+                    (b.block_count, b.start_address, b.block_size,
+                     b.inter_block_stride) for b in s.s])
+
+            raw._ioctl = ioctl
+            raw.clean_invalid(op=CACHE_OP_CLEAN, usr_ptr=0x10000, size=64,
+                              block_count=rows, inter_block_stride=stride)
+            with self.assertRaises(ValueError):
+                raw.clean_invalid(op=CACHE_OP_CLEAN, usr_ptr=0x10000,
+                                  size=64, block_count=0)
+            raw.close()
+
+        # block_count is 16-bit, so the rows are split into several blocks.
+        n = 2 ** 16 - 1
+        self.assertEqual(requests, [[
+            (n, 0x10000, 64, stride),
+            (n, 0x10000 + n * stride, 64, stride),
+            (7, 0x10000 + 2 * n * stride, 64, stride),
+        ]])
+
+    def test_probe_driver(self):
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'vcsm-cma')
+            self.assertEqual(probe_driver(path_vcsm_cma=path), 'vcsm')
+            # A device which appears later is found.
+            open(path, 'w').close()
+            self.assertEqual(probe_driver(path_vcsm_cma=path), 'vcsm-cma')
+
+            # The device found is cached until it is probed again.
+            os.remove(path)
+            self.assertEqual(probe_driver(path_vcsm_cma=path), 'vcsm-cma')
+            self.assertEqual(probe_driver(path_vcsm_cma=path, reprobe=True),
+                             'vcsm')
+            self.assertEqual(probe_driver(path_vcsm_cma=path), 'vcsm')
+
+            # VCSM falls back to the plain driver if the device is gone since
+            # it was probed.
+            open(path, 'w').close()
+            self.assertEqual(probe_driver(path_vcsm_cma=path), 'vcsm-cma')
+            os.remove(path)
+            path_vcsm = os.path.join(d, 'vcsm')
+            with self.assertRaises(FileNotFoundError) as cm:
+                VCSM(path_vcsm=path_vcsm, path_vcsm_cma=path)
+            self.assertEqual(cm.exception.filename, path_vcsm)
+            self.assertEqual(probe_driver(path_vcsm_cma=path), 'vcsm')
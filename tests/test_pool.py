@@ -0,0 +1,70 @@
+
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.pool import VCSMPool
+
+
+class Test(unittest.TestCase):
+
+    def test_size_class(self):
+
+        self.assertEqual(VCSMPool.size_class(1), 4096)
+        self.assertEqual(VCSMPool.size_class(4096), 4096)
+        self.assertEqual(VCSMPool.size_class(4097), 8192)
+        self.assertEqual(VCSMPool.size_class(2 ** 20 + 1), 1310720)
+        self.assertEqual(VCSMPool.size_class(32000000), 33554432)
+
+    def test_reuse(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMPool(vcsm, max_bytes=2 ** 20) as pool:
+
+            handle, bus_ptr, usr_ptr, usr_buf = \
+                pool.malloc_cache(size=100000, cached=rpi_vcsm.CACHE_HOST,
+                                  name='test')
+            pool.free(handle=handle, usr_buf=usr_buf)
+
+            mem = pool.malloc_cache(size=100001, cached=rpi_vcsm.CACHE_HOST,
+                                    name='test')
+            self.assertEqual(mem[:3], (handle, bus_ptr, usr_ptr))
+            self.assertEqual((pool.hits, pool.misses), (1, 1))
+            pool.free(handle=mem[0], usr_buf=mem[3])
+
+            mem = pool.malloc_cache(size=100000, cached=rpi_vcsm.CACHE_NONE,
+                                    name='test')
+            self.assertEqual((pool.hits, pool.misses), (1, 2))
+            pool.free(handle=mem[0], usr_buf=mem[3])
+
+            self.assertEqual(pool.get_idle_bytes(), 2 * 114688)
+
+    def test_trim(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMPool(vcsm, max_bytes=3 * 65536,
+                         max_class_bytes=2 * 65536) as pool:
+
+            mem_list = [pool.malloc_cache(size=65536,
+                                          cached=rpi_vcsm.CACHE_HOST,
+                                          name='test') for i in range(4)]
+            for mem in mem_list:
+                pool.free(handle=mem[0], usr_buf=mem[3])
+            self.assertEqual(pool.get_idle_bytes(), 2 * 65536)
+
+            self.assertEqual(pool.trim(max_bytes=65536), 65536)
+            self.assertEqual(pool.get_idle_bytes(), 65536)
+
+    def test_pressure(self, *, size=65536):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated', budget=2 * size) as vcsm, \
+                VCSMPool(vcsm) as pool:
+            mem = pool.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                    name='test')
+            pool.free(handle=mem[0], usr_buf=mem[3])
+            self.assertEqual(pool.get_idle_bytes(), size)
+
+            # The idle buffers of the pool are released to make room.
+            mem = vcsm.malloc_cache(size=2 * size, cached=rpi_vcsm.CACHE_HOST,
+                                    name='test')
+            self.assertEqual(pool.get_idle_bytes(), 0)
+            vcsm.free(handle=mem[0], usr_buf=mem[3])
@@ -0,0 +1,129 @@
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import rpi_vcsm.VCSM
+
+
+class Test(unittest.TestCase):
+
+    def test_budget(self, *, size=2 ** 20):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated', budget=3 * size,
+                                thread_cache=2) as vcsm:
+            self.assertEqual(vcsm.get_headroom(), 3 * size)
+
+            mems = [vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                      name='test') for i in range(3)]
+            self.assertEqual(vcsm.get_used_bytes(), 3 * size)
+            self.assertEqual(vcsm.get_headroom(), 0)
+            with self.assertRaises(OSError):
+                vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                  name='test')
+
+            # The cached buffers are released to make room for a new size.
+            for handle, bus_ptr, usr_ptr, usr_buf in mems[:2]:
+                vcsm.free(handle=handle, usr_buf=usr_buf)
+            self.assertEqual(vcsm.get_used_bytes(), 3 * size)
+            mem = vcsm.malloc_cache(size=2 * size,
+                                    cached=rpi_vcsm.CACHE_HOST, name='test')
+            self.assertEqual(vcsm.get_used_bytes(), 3 * size)
+
+            # A callback evicts a buffer.
+            evicted = []
+
+            def evict(n):
+                evicted.append(n)
+                vcsm.free(handle=mem[0], usr_buf=mem[3])
+
+            mem2 = vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_NONE,
+                                     name='test', pressure=evict)
+            self.assertEqual(evicted, [size])
+
+            # Another thread frees a buffer while blocking.
+            timer = threading.Timer(
+                0.1, vcsm.free, kwargs={'handle': mem2[0], 'usr_buf': mem2[3]})
+            timer.start()
+            mem3 = vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_NONE,
+                                     name='test', pressure='block', timeout=5)
+            timer.join()
+            # The buffer cached by the timer thread is released on its exit.
+            self.assertEqual(vcsm.get_used_bytes(), 2 * size)
+
+            start = time.monotonic()
+            with self.assertRaises(OSError):
+                vcsm.malloc_cache(size=2 * size, cached=rpi_vcsm.CACHE_NONE,
+                                  name='test', pressure='block', timeout=0.1)
+            self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+            for handle, bus_ptr, usr_ptr, usr_buf in [mems[2], mem3]:
+                vcsm.free(handle=handle, usr_buf=usr_buf)
+
+    def test_low_water(self):
+
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('MemTotal:        3882640 kB\n'
+                    'CmaTotal:         524288 kB\n'
+                    'CmaFree:            8192 kB\n')
+            f.flush()
+
+            self.assertEqual(rpi_vcsm.VCSM.read_cma_info(f.name),
+                             (524288 * 1024, 8192 * 1024))
+            self.assertIsNone(rpi_vcsm.VCSM.read_cma_info(os.devnull))
+
+            with rpi_vcsm.VCSM.VCSM(force='emulated', low_water=2 ** 22,
+                                    path_meminfo=f.name) as vcsm:
+                self.assertEqual(vcsm.get_headroom(), 2 ** 22)
+                handle, bus_ptr, usr_ptr, usr_buf = \
+                    vcsm.malloc_cache(size=2 ** 22,
+                                      cached=rpi_vcsm.CACHE_HOST, name='test')
+                vcsm.free(handle=handle, usr_buf=usr_buf)
+                with self.assertRaises(OSError):
+                    vcsm.malloc_cache(size=2 ** 22 + 1,
+                                      cached=rpi_vcsm.CACHE_HOST, name='test')
+
+    def test_close(self, *, size=2 ** 20):
+
+        # close wakes an allocation blocking without a timeout.
+        vcsm = rpi_vcsm.VCSM.VCSM(force='emulated', budget=size)
+        held = vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                 name='test')
+        errors = []
+
+        def blocked():
+            try:
+                vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                                  name='test', pressure='block')
+            except ValueError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=blocked)
+        thread.start()
+        time.sleep(0.05)
+        vcsm.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+        # Buffers can be freed while close waits for an allocation.
+        vcsm = rpi_vcsm.VCSM.VCSM(force='emulated',
+                                  emulated_latency={'alloc': 0.2})
+        handle, bus_ptr, usr_ptr, usr_buf = \
+            vcsm.malloc_cache(size=size, cached=rpi_vcsm.CACHE_HOST,
+                              name='test')
+        thread = threading.Thread(target=vcsm.malloc_cache,
+                                  kwargs={'size': size, 'name': 'test',
+                                          'cached': rpi_vcsm.CACHE_HOST})
+        thread.start()
+        time.sleep(0.05)
+        closer = threading.Thread(target=vcsm.close)
+        closer.start()
+        time.sleep(0.05)
+        vcsm.free(handle=handle, usr_buf=usr_buf)
+        closer.join()
+        thread.join()
+        with self.assertRaises(ValueError):
+            vcsm.free(handle=handle, usr_buf=usr_buf)
@@ -0,0 +1,70 @@
+
+import os
+import queue
+import threading
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.ring import VCSMRing
+
+
+class Test(unittest.TestCase):
+
+    def test_threads(self, *, n=200):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMRing(vcsm, slots=4, size=4096,
+                         cached=rpi_vcsm.CACHE_HOST, name='test') as ring:
+            received = []
+
+            # The consumer stands for the device, which reads the memory
+            # behind the CPU caches through the memfd of the emulated driver.
+            def consumer():
+                for i in range(n):
+                    buf = ring.acquire_for_read(timeout=10)
+                    self.assertEqual(buf.state, buf.DEVICE)
+                    received.append(os.pread(buf.handle, 1, 0)[0])
+                    ring.release(buf)
+
+            thread = threading.Thread(target=consumer)
+            thread.start()
+            for i in range(n):
+                buf = ring.acquire_for_write(timeout=10)
+                buf.as_memoryview()[0] = i % 256
+                ring.publish(buf)
+            thread.join()
+
+            self.assertEqual(received, [i % 256 for i in range(n)])
+            self.assertEqual(ring.dropped, 0)
+            # One clean on each publish, and no invalidate on reuse.
+            self.assertEqual(vcsm.cache_op_counts['issued'], n)
+
+    def test_policy(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            with VCSMRing(vcsm, slots=2, size=4096,
+                          cached=rpi_vcsm.CACHE_HOST, name='test') as ring:
+                with self.assertRaises(queue.Empty):
+                    ring.acquire_for_read(block=False)
+                ring.publish(ring.acquire_for_write())
+                ring.publish(ring.acquire_for_write())
+                with self.assertRaises(queue.Full):
+                    ring.acquire_for_write(timeout=0.01)
+
+            with VCSMRing(vcsm, slots=2, size=4096,
+                          cached=rpi_vcsm.CACHE_HOST, name='test',
+                          direction='from_device',
+                          policy='drop_oldest') as ring:
+                # The device writes the slots it owns.
+                for i in range(5):
+                    buf = ring.acquire_for_write(block=False)
+                    self.assertEqual(buf.state, buf.DEVICE)
+                    os.pwrite(buf.handle, bytes([i]), 0)
+                    ring.publish(buf)
+                self.assertEqual(ring.dropped, 3)
+
+                buf = ring.acquire_for_read()
+                self.assertEqual(buf.state, buf.CPU_CLEAN)
+                self.assertEqual(buf.as_memoryview()[0], 3)
+                ring.release(buf)
+                self.assertEqual(buf.state, buf.DEVICE)
@@ -0,0 +1,104 @@
+
+import os
+import socket
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.share import VCSMImporter, export_buffer
+
+
+class Test(unittest.TestCase):
+
+    def test_share(self):
+
+        a, b = socket.socketpair()
+        with a, b, rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMImporter() as importer:
+            buf = vcsm.malloc(size=10000, cached=rpi_vcsm.CACHE_HOST,
+                              name='test')
+            export_buffer(a, buf, tag=b'frame 0')
+            export_buffer(a, buf)
+
+            imported, tag = importer.receive(b)
+            self.assertEqual(tag, b'frame 0')
+            self.assertEqual((imported.size, imported.bus_ptr,
+                              imported.cached),
+                             (buf.size, buf.bus_ptr, buf.cached))
+            again, tag = importer.receive(b)
+            self.assertEqual(tag, b'')
+            self.assertEqual(again.usr_ptr, imported.usr_ptr)
+            self.assertEqual(importer.get_refs(handle=imported.handle), 2)
+
+            with buf.as_memoryview() as view:
+                view[:] = b'\x5a' * buf.size
+            buf.free()
+
+            # The memory is alive until the importer drops it.
+            imported.begin_cpu_access(write=False)
+            self.assertEqual(bytes(imported.as_memoryview()),
+                             b'\x5a' * buf.size)
+            imported.free()
+            self.assertEqual(importer.get_refs(handle=again.handle), 1)
+            again.free()
+
+    def test_group(self):
+
+        a, b = socket.socketpair()
+        with a, b, rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                VCSMImporter() as importer:
+            for alignment in [None, 64]:
+                with vcsm.malloc_many(count=3, size=1000,
+                                      cached=rpi_vcsm.CACHE_HOST,
+                                      name='test',
+                                      alignment=alignment) as group:
+                    for i, buf in enumerate(group):
+                        with buf.as_memoryview() as view:
+                            view[:] = bytes([i + 1]) * buf.size
+                        export_buffer(a, buf)
+
+                    # Each slot is mapped at its offset in the allocation.
+                    for i, buf in enumerate(group):
+                        imported, tag = importer.receive(b)
+                        self.assertEqual(imported.offset, buf.offset)
+                        self.assertEqual(imported.bus_ptr, buf.bus_ptr)
+                        self.assertEqual(bytes(imported.as_memoryview()),
+                                         bytes([i + 1]) * buf.size)
+                        imported.free()
+
+    def test_fork(self):
+
+        a, b = socket.socketpair()
+        with a, b, rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            buf = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                              name='test')
+
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    with VCSMImporter() as importer:
+                        imported, tag = importer.receive(b)
+                        with imported.as_memoryview() as view:
+                            view[:len(tag)] = tag
+                        imported.free()
+                    b.send(b'done')
+                finally:
+                    os._exit(0)
+
+            export_buffer(a, buf, tag=b'hello from the child')
+            self.assertEqual(a.recv(4), b'done')
+            os.waitpid(pid, 0)
+            self.assertEqual(bytes(buf.as_memoryview()[:20]),
+                             b'hello from the child')
+            buf.free()
+
+    def test_plain_vcsm(self):
+
+        class Owner:
+            def get_driver(self):
+                return 'vcsm'
+
+        buf = rpi_vcsm.VCSM.VCSMBuffer(owner=Owner(), handle=1, bus_ptr=0,
+                                       usr_ptr=0, usr_buf=None, size=1,
+                                       cached=rpi_vcsm.CACHE_NONE)
+        with self.assertRaises(ValueError):
+            export_buffer(None, buf)
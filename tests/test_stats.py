@@ -0,0 +1,82 @@
+
+import threading
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.stats import VCSMStats
+
+
+class Test(unittest.TestCase):
+
+    def test_stats(self):
+
+        stats = VCSMStats()
+        exported = []
+        stats.add_exporter(exported.append)
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated', stats=stats) as vcsm:
+            a = vcsm.malloc(size=10000, cached=rpi_vcsm.CACHE_HOST,
+                            name='a')
+            b = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST, name='b')
+            a.clean()
+            a.free()
+            c = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST, name='b')
+
+            snapshot = stats.export()
+            self.assertEqual(exported, [snapshot])
+
+            ops = snapshot['ops']
+            self.assertEqual(ops['alloc']['count'], 3)
+            self.assertEqual(ops['free']['count'], 1)
+            self.assertEqual(ops['clean_invalidate']['count'], 1)
+            self.assertEqual(ops['mmap']['count'], 3)
+            self.assertEqual(ops['ioctl']['count'], 3)
+            self.assertEqual(ops['sync']['count'], 5)
+            self.assertEqual(sum(ops['alloc']['histogram']), 3)
+            self.assertLessEqual(ops['alloc']['p50_ns'],
+                                 ops['alloc']['p99_ns'])
+
+            self.assertEqual(snapshot['bytes']['driver'],
+                             {'emulated': {'live': 8192, 'peak': 16384}})
+            self.assertEqual(snapshot['bytes']['name'],
+                             {'a': {'live': 0, 'peak': 12288},
+                              'b': {'live': 8192, 'peak': 8192}})
+            self.assertEqual(snapshot['peak_bytes_by_name'],
+                             {'a': 12288, 'b': 4096})
+
+            stats.reset()
+            snapshot = stats.snapshot()
+            self.assertEqual(snapshot['ops']['alloc']['count'], 0)
+            self.assertEqual(snapshot['peak_bytes'], 8192)
+
+            b.free()
+            c.free()
+            self.assertEqual(stats.snapshot()['live_bytes'], 0)
+
+    def test_threads(self, *, n_threads=8, n=2000):
+
+        stats = VCSMStats()
+
+        def run(i):
+            for j in range(n):
+                stats.record_alloc(driver='emulated', handle=(i, j),
+                                   name=f'{i % 2}', size=4096)
+                stats.record('alloc', 100)
+                if j % 2:
+                    stats.record_free(driver='emulated', handle=(i, j - 1))
+                    stats.record_free(driver='emulated', handle=(i, j))
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(n_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['ops']['alloc']['count'], n_threads * n)
+        self.assertEqual(snapshot['live_bytes'], 0)
+        self.assertEqual(snapshot['bytes']['driver']['emulated']['live'], 0)
+        self.assertLessEqual(snapshot['peak_bytes'], n_threads * 2 * 4096)
+        self.assertEqual(sum(snapshot['peak_bytes_by_name'].values()),
+                         snapshot['peak_bytes'])
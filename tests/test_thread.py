@@ -0,0 +1,139 @@
+
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+import random
+import threading
+import unittest
+
+import rpi_vcsm.VCSM
+import rpi_vcsm.stats
+
+
+class Test(unittest.TestCase):
+
+    def test_stress(self, *, n_threads=8, n=200):
+
+        vcsm = rpi_vcsm.VCSM.VCSM(force='emulated', thread_cache=4,
+                                  global_cache=8)
+
+        def worker(seed):
+            rng = random.Random(seed)
+            held = []
+            cleans = 0
+            for i in range(n):
+                if held and (len(held) > 6 or rng.random() < 0.5):
+                    value, buf = held.pop(rng.randrange(len(held)))
+                    self.assertEqual(bytes(buf.as_memoryview()),
+                                     bytes([value]) * buf.size)
+                    buf.free()
+                    continue
+                buf = vcsm.malloc(size=rng.choice([4096, 10000, 65536]),
+                                  cached=rpi_vcsm.CACHE_HOST, name='test')
+                value = rng.randrange(256)
+                with buf.as_memoryview() as view:
+                    view[:] = bytes([value]) * buf.size
+                buf.clean()
+                cleans += 1
+                held.append((value, buf))
+            for value, buf in held:
+                buf.free()
+            return cleans
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            cleans = sum(future.result()
+                         for future in [executor.submit(worker, seed)
+                                        for seed in range(n_threads)])
+
+        raw = vcsm.raw
+        vcsm.close()
+        # Every buffer taken from the driver is returned on close.
+        self.assertEqual(raw.ioctl_counts['sync'],
+                         2 * raw.ioctl_counts['alloc'] + cleans)
+        self.assertLess(raw.ioctl_counts['alloc'], n_threads * n / 2)
+
+        with self.assertRaises(ValueError):
+            vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST, name='test')
+
+    def test_close_waits(self):
+
+        vcsm = rpi_vcsm.VCSM.VCSM(force='emulated',
+                                  emulated_latency={'alloc': 0.2})
+        result = []
+
+        def worker():
+            result.append(vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                                      name='test'))
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        sleep(0.05)
+        start = monotonic()
+        vcsm.close()
+        self.assertGreater(monotonic() - start, 0.1)
+        thread.join()
+        self.assertEqual(len(result), 1)
+        with self.assertRaises(ValueError):
+            result[0].free()
+
+    def test_cache_op_counts(self, *, n_threads=8, n=2000):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+
+            def worker():
+                with vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                                 name='test') as buf:
+                    for i in range(n):
+                        buf.clean()
+                        buf.clean()
+                        buf.invalidate()
+
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                for future in [executor.submit(worker)
+                               for i in range(n_threads)]:
+                    future.result()
+
+            # No count is lost to the other threads.
+            self.assertEqual(vcsm.cache_op_counts,
+                             {'issued': 2 * n * n_threads,
+                              'elided': n * n_threads})
+
+    def test_trim_caches(self):
+
+        stats = rpi_vcsm.stats.VCSMStats()
+        with rpi_vcsm.VCSM.VCSM(force='emulated', thread_cache=4,
+                                stats=stats) as vcsm:
+            freed = threading.Event()
+            done = threading.Event()
+
+            def worker():
+                vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                            name='a').free()
+                freed.set()
+                done.wait()
+                vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                            name='a').free()
+
+            # The cache of another live thread is trimmed.
+            thread = threading.Thread(target=worker)
+            thread.start()
+            freed.wait()
+            self.assertEqual(vcsm.get_used_bytes(), 4096)
+            self.assertEqual(vcsm.trim_caches(), 4096)
+            self.assertEqual(vcsm.get_used_bytes(), 0)
+
+            # The cache of a thread is released when it exits.
+            done.set()
+            thread.join()
+            self.assertEqual(vcsm.get_used_bytes(), 0)
+            self.assertEqual(vcsm.raw.ioctl_counts['alloc'], 2)
+
+            # A buffer reused from the cache is attributed to the new name.
+            vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                        name='a').free()
+            buf = vcsm.malloc(size=4096, cached=rpi_vcsm.CACHE_HOST,
+                              name='b')
+            self.assertEqual(vcsm.raw.ioctl_counts['alloc'], 3)
+            names = stats.snapshot()['bytes']['name']
+            self.assertEqual(names['a']['live'], 0)
+            self.assertEqual(names['b']['live'], 4096)
+            buf.free()
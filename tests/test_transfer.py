@@ -0,0 +1,49 @@
+
+import random
+import sys
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm.transfer import copy_in, copy_out
+
+
+class Test(unittest.TestCase):
+
+    def test_copy(self, *, size=8 * 2 ** 20 + 12345):
+
+        # random.randbytes() is introduced in Python 3.9.
+        def randbytes(n):
+            return random.getrandbits(8 * n).to_bytes(n, sys.byteorder)
+
+        random.seed(42)
+        src = randbytes(size)
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            buf = vcsm.malloc(size=size + 100, cached=rpi_vcsm.CACHE_HOST,
+                              name='test')
+
+            for threads, threshold in [(1, 0), (3, 0), (None, 2 ** 30)]:
+                with self.subTest(threads=threads, threshold=threshold):
+                    self.assertEqual(copy_in(buf, src, offset=100,
+                                             threads=threads,
+                                             threshold=threshold), size)
+                    dst = bytearray(size)
+                    self.assertEqual(copy_out(buf, dst, offset=100,
+                                              threads=threads,
+                                              threshold=threshold), size)
+                    self.assertEqual(src, dst)
+
+            mem = (buf.handle, buf.bus_ptr, buf.usr_ptr, buf.usr_buf)
+            copy_in(mem, memoryview(src)[:1000])
+            dst = bytearray(1000)
+            copy_out(mem, dst)
+            self.assertEqual(src[:1000], dst)
+
+            with self.assertRaises(BufferError):
+                copy_out(buf, src)
+            with self.assertRaises(ValueError):
+                copy_in(buf, src, offset=101)
+            with self.assertRaises(ValueError):
+                copy_out(buf, dst, offset=-1)
+
+            buf.free()
@@ -0,0 +1,123 @@
+
+import os
+import tempfile
+import unittest
+
+import rpi_vcsm.VCSM
+from rpi_vcsm import tune
+from rpi_vcsm.transfer import copy_in, copy_out
+
+
+class Test(unittest.TestCase):
+
+    def test_calibration(self):
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm, \
+                tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'calibration.json')
+            calibration = tune.load_calibration(vcsm, path=path,
+                                                size=2 ** 16, repeat=2)
+            self.assertEqual(set(calibration), {'none', 'host', 'vc', 'both'})
+            for c in calibration.values():
+                self.assertGreater(c['read'], 0)
+                self.assertGreater(c['clean'], 0)
+
+            # The cached calibration is reused.
+            mtime = os.stat(path).st_mtime_ns
+            self.assertEqual(tune.load_calibration(vcsm, path=path),
+                             calibration)
+            self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+    def test_recommend(self):
+
+        # Uncached memory is slow to read from the CPU but needs no sync.
+        calibration = {
+            'none': {'read': 10.0, 'write': 1.0, 'clean': 0, 'invalidate': 0},
+            'host': {'read': 1.0, 'write': 1.0, 'clean': 50000,
+                     'invalidate': 50000},
+            'vc': {'read': 10.0, 'write': 1.0, 'clean': 0, 'invalidate': 0},
+            'both': {'read': 1.0, 'write': 1.0, 'clean': 60000,
+                     'invalidate': 60000},
+        }
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            tuner = tune.CacheTuner(vcsm, calibration=calibration,
+                                    min_iterations=2)
+
+            self.assertEqual(tuner.recommend(tune.AccessProfile(
+                read_bytes=2 ** 20, syncs=1)), rpi_vcsm.CACHE_HOST)
+            self.assertEqual(tuner.recommend(tune.AccessProfile(
+                write_bytes=2 ** 20, syncs=1)), rpi_vcsm.CACHE_NONE)
+            self.assertEqual(tuner.recommend(tune.AccessProfile()),
+                             rpi_vcsm.CACHE_NONE)
+
+            tuner.declare('weights', tune.AccessProfile(read_bytes=2 ** 20))
+            self.assertEqual(tuner.get_cached('weights'), rpi_vcsm.CACHE_HOST)
+
+            self.assertEqual(tuner.get_cached('frame'), rpi_vcsm.CACHE_HOST)
+            for i in range(2):
+                tuner.observe('frame', write_bytes=2 ** 16, syncs=1)
+            self.assertEqual(tuner.get_cached('frame'), rpi_vcsm.CACHE_NONE)
+            with tuner.malloc(size=2 ** 16, name='frame') as buf:
+                self.assertEqual(buf.cached, rpi_vcsm.CACHE_NONE)
+
+    def test_observe(self, *, size=2 ** 16):
+
+        # The syncs of uncached buffers cost as much as those of cached ones
+        # when they are issued.
+        calibration = {
+            'none': {'read': 10.0, 'write': 1.0, 'clean': 60000,
+                     'invalidate': 60000},
+            'host': {'read': 1.0, 'write': 1.0, 'clean': 50000,
+                     'invalidate': 50000},
+            'vc': {'read': 10.0, 'write': 1.0, 'clean': 60000,
+                   'invalidate': 60000},
+            'both': {'read': 1.0, 'write': 1.0, 'clean': 60000,
+                     'invalidate': 60000},
+        }
+
+        with rpi_vcsm.VCSM.VCSM(force='emulated') as vcsm:
+            tuner = tune.CacheTuner(vcsm, calibration=calibration,
+                                    min_iterations=2)
+            self.assertIs(vcsm.observer, tuner)
+
+            # A VCSMBuffer written by the CPU and handed off to the device,
+            # whose syncs are elided with CACHE_NONE.
+            with tuner.malloc(size=size, name='frame') as buf:
+                for i in range(3):
+                    copy_in(buf, bytes(size))
+                    buf.end_cpu_access()
+                copy_out(buf, bytearray(64))
+            profile = tuner.get_profile('frame')
+            # The three cleans and the three invalidates before the second and
+            # the third copy_in and copy_out make three hand-offs.
+            self.assertEqual(profile.write_bytes, size)
+            self.assertAlmostEqual(profile.read_bytes, 64 / 3)
+            self.assertEqual(profile.syncs, 0)
+            self.assertEqual(profile.tracked_syncs, 1)
+            self.assertEqual(tuner.get_cached('frame'), rpi_vcsm.CACHE_NONE)
+
+            # The tuple API issues the syncs with CACHE_NONE too.
+            handle, bus_ptr, usr_ptr, usr_buf = tuner.malloc_cache(
+                size=size, name='tensor')
+            for i in range(2):
+                vcsm.invalidate(handle=handle, usr_ptr=usr_ptr, size=size)
+                vcsm.clean(handle=handle, usr_ptr=usr_ptr, size=size)
+            vcsm.free(handle=handle, usr_buf=usr_buf)
+            profile = tuner.get_profile('tensor')
+            self.assertEqual(profile.syncs, 1)
+            self.assertEqual(profile.tracked_syncs, 0)
+            self.assertEqual(tuner.get_cached('tensor'), rpi_vcsm.CACHE_HOST)
+
+            # The iterations of a name reported by hand are not counted again
+            # from the VCSM.
+            with tuner.malloc(size=4096, name='f') as buf:
+                buf.end_cpu_access()
+                for i in range(4):
+                    tuner.observe('f', write_bytes=4096, syncs=1)
+                    buf.begin_cpu_access()
+                    buf.end_cpu_access()
+            profile = tuner.get_profile('f')
+            self.assertEqual(profile.write_bytes, 4096)
+            self.assertEqual(profile.syncs, 1)
+            self.assertEqual(profile.tracked_syncs, 0)